@@ -0,0 +1,94 @@
+"""
+Micro-benchmark: preprocess_image fast decode path vs. the original full decode
+
+Usage:
+    python -m benchmarks.bench_preprocess [--repeat 3] [--output bench_preprocess.json]
+"""
+import argparse
+import io
+import json
+import time
+from typing import Callable, Dict
+
+import numpy as np
+from PIL import Image
+
+from src.image_processor import JPEG_QUALITY, MAX_SIZE, preprocess_image
+
+# Camera-like sensor sizes (4:3) for 12, 24 and 48 megapixels
+SIZES = {
+    '12MP': (4000, 3000),
+    '24MP': (5656, 4242),
+    '48MP': (8000, 6000),
+}
+
+
+def legacy_preprocess_image(uploaded_file) -> bytes:
+    """The original implementation: full decode, RGB convert, LANCZOS, re-encode"""
+    image = Image.open(uploaded_file)
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+    if max(image.size) > MAX_SIZE:
+        ratio = MAX_SIZE / max(image.size)
+        new_size = tuple([int(dim * ratio) for dim in image.size])
+        image = image.resize(new_size, Image.Resampling.LANCZOS)
+    img_byte_arr = io.BytesIO()
+    image.save(img_byte_arr, format='JPEG', quality=JPEG_QUALITY)
+    return img_byte_arr.getvalue()
+
+
+def synthetic_photo(size) -> bytes:
+    """Encode a noisy gradient as a camera-quality JPEG of the given size"""
+    width, height = size
+    rng = np.random.default_rng(0)
+    x = np.linspace(0, 255, width, dtype=np.float32)
+    y = np.linspace(0, 255, height, dtype=np.float32)[:, None]
+    pixels = np.stack([x + 0 * y, y + 0 * x, (x + y) / 2], axis=-1)
+    pixels += rng.normal(0, 12, pixels.shape).astype(np.float32)
+    image = Image.fromarray(np.clip(pixels, 0, 255).astype(np.uint8), 'RGB')
+    
+    buffer = io.BytesIO()
+    image.save(buffer, format='JPEG', quality=92)
+    return buffer.getvalue()
+
+
+def best_time(fn: Callable[[bytes], bytes], data: bytes, repeat: int) -> float:
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn(io.BytesIO(data))
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def run(repeat: int) -> Dict[str, Dict[str, float]]:
+    results = {}
+    for label, size in SIZES.items():
+        data = synthetic_photo(size)
+        legacy = best_time(legacy_preprocess_image, data, repeat)
+        fast = best_time(preprocess_image, data, repeat)
+        megapixels = size[0] * size[1] / 1e6
+        results[label] = {
+            'legacy_seconds': round(legacy, 4),
+            'fast_seconds': round(fast, 4),
+            'speedup': round(legacy / fast, 2),
+            'fast_megapixels_per_second': round(megapixels / fast, 1),
+        }
+        print(f"{label}: legacy {legacy * 1000:.0f} ms, fast {fast * 1000:.0f} ms ({legacy / fast:.1f}x)")
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--output', help="Write results as JSON to this file")
+    args = parser.parse_args()
+    
+    results = run(args.repeat)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,269 @@
+"""
+End-to-end benchmark of GeminiService against the local stub backend
+
+Usage:
+    python -m benchmarks.bench_service [--requests 400] [--concurrency 16] \
+        [--output bench_service.json] [--baseline previous.json]
+
+Measures throughput and p50/p95/p99 latency for single-image analysis,
+comparisons and streaming (time to first chunk), cache hit ratios for a
+Zipfian mix of repeated requests, behaviour under 429s and server errors,
+and preprocess_image megapixels per second. No network access is needed;
+results are written as JSON so runs can be compared between releases.
+"""
+import argparse
+import io
+import json
+import platform
+import random
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Sequence
+
+import numpy as np
+from PIL import Image
+
+from src.cache import DiskCache, LRUCache, ResponseCache
+from src.gemini_service import GeminiService
+from src.image_processor import preprocess_image
+from src.metrics import metrics
+from src.rate_limiter import RateLimiter
+
+from .bench_preprocess import SIZES, synthetic_photo
+from .stub_backend import StubConfig, StubGenerativeModel
+
+QUESTION = "Describe the scene"
+
+
+def distinct_images(count: int, size: int = 64) -> List[bytes]:
+    """Small JPEGs with distinct content, so each one is a separate cache entry"""
+    images = []
+    for i in range(count):
+        # Noise rather than flat colours: nearby flat colours can encode to identical JPEGs
+        pixels = np.random.default_rng(i).integers(0, 256, (size, size, 3), dtype=np.uint8)
+        buffer = io.BytesIO()
+        Image.fromarray(pixels, 'RGB').save(buffer, format='JPEG')
+        images.append(buffer.getvalue())
+    return images
+
+
+def make_service(backend: StubGenerativeModel, cache_dir: str, memory_bytes: int = 32 * 1024 * 1024,
+                 concurrency: int = 16) -> GeminiService:
+    """A service with a fresh two-tier cache and a limiter tuned for sub-second backoff"""
+    cache = ResponseCache(
+        LRUCache(memory_bytes, sizeof=lambda value: len(json.dumps(value))),
+        DiskCache(Path(cache_dir) / 'responses.sqlite3', max_bytes=256 * 1024 * 1024, ttl_seconds=3600)
+    )
+    limiter = RateLimiter(
+        requests_per_minute=1_000_000, tokens_per_minute=1e9,
+        initial_concurrency=concurrency, max_concurrency=concurrency,
+        max_attempts=5, base_delay=0.01, max_delay=0.2
+    )
+    return GeminiService("stub", cache=cache, limiter=limiter, model=backend)
+
+
+def summarize(latencies: Sequence[float], elapsed: float) -> Dict[str, float]:
+    """Throughput and latency percentiles (milliseconds) of one scenario"""
+    values = np.asarray(latencies) * 1000
+    return {
+        'requests': len(latencies),
+        'throughput_per_second': round(len(latencies) / elapsed, 1) if elapsed else 0.0,
+        'p50_ms': round(float(np.percentile(values, 50)), 2),
+        'p95_ms': round(float(np.percentile(values, 95)), 2),
+        'p99_ms': round(float(np.percentile(values, 99)), 2),
+    }
+
+
+def run_timed(calls: Sequence[Callable[[], Any]], concurrency: int) -> Dict[str, float]:
+    """Run calls on a thread pool, recording per-call latency and failures"""
+    latencies = []
+    failures = [0]
+    
+    def timed(call):
+        start = time.perf_counter()
+        try:
+            call()
+        except Exception:
+            failures[0] += 1
+        latencies.append(time.perf_counter() - start)
+    
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(timed, calls))
+    summary = summarize(latencies, time.perf_counter() - start)
+    summary['failures'] = failures[0]
+    return summary
+
+
+def bench_analyze(config: StubConfig, requests: int, concurrency: int) -> Dict[str, Dict[str, float]]:
+    """Cold-cache throughput and latency of analyze_image, comparisons and streaming"""
+    images = distinct_images(requests + 1)
+    results = {}
+    with tempfile.TemporaryDirectory() as cache_dir:
+        service = make_service(StubGenerativeModel(config), cache_dir, concurrency=concurrency)
+        results['analyze_image'] = run_timed(
+            [lambda image=image: service.analyze_image(image, QUESTION) for image in images[:requests]],
+            concurrency
+        )
+    with tempfile.TemporaryDirectory() as cache_dir:
+        service = make_service(StubGenerativeModel(config), cache_dir, concurrency=concurrency)
+        results['comparison'] = run_timed(
+            [lambda a=a, b=b: service.analyze_images_comparison(a, b, QUESTION)
+             for a, b in zip(images[:requests], images[1:requests + 1])],
+            concurrency
+        )
+    with tempfile.TemporaryDirectory() as cache_dir:
+        service = make_service(StubGenerativeModel(config), cache_dir, concurrency=concurrency)
+        first_chunk = []
+        
+        def stream(image):
+            start = time.perf_counter()
+            for i, _ in enumerate(service.analyze_image_stream(image, QUESTION)):
+                if i == 0:
+                    first_chunk.append(time.perf_counter() - start)
+        
+        results['stream'] = run_timed([lambda image=image: stream(image) for image in images[:requests]],
+                                      concurrency)
+        ttft = summarize(first_chunk, 0)
+        results['stream'].update({f"ttft_{key}": ttft[key] for key in ('p50_ms', 'p95_ms', 'p99_ms')})
+    return results
+
+
+def zipf_workload(catalog: int, requests: int, exponent: float, seed: int = 0) -> List[int]:
+    """Indices into a catalog drawn with probability proportional to rank**-exponent"""
+    weights = 1 / np.arange(1, catalog + 1) ** exponent
+    return random.Random(seed).choices(range(catalog), weights=weights, k=requests)
+
+
+def bench_zipf(config: StubConfig, requests: int, concurrency: int, catalog: int,
+               exponents: Sequence[float]) -> Dict[str, Dict[str, float]]:
+    """Cache hit ratio and latency for repeated (image, question) pairs with Zipfian popularity"""
+    images = distinct_images(catalog)
+    results = {}
+    for exponent in exponents:
+        with tempfile.TemporaryDirectory() as cache_dir:
+            backend = StubGenerativeModel(config)
+            service = make_service(backend, cache_dir, concurrency=concurrency)
+            before = metrics.snapshot()['counters']
+            summary = run_timed(
+                [lambda index=index: service.analyze_image(images[index], QUESTION)
+                 for index in zipf_workload(catalog, requests, exponent)],
+                concurrency
+            )
+            after = metrics.snapshot()['counters']
+            hits = after.get('cache_hits', 0) - before.get('cache_hits', 0)
+            misses = after.get('cache_misses', 0) - before.get('cache_misses', 0)
+            summary.update({
+                'hit_ratio': round(hits / (hits + misses), 3) if hits + misses else 0.0,
+                # Matches distinct_keys while concurrent misses are coalesced
+                'backend_calls': backend.stats()['calls'],
+                'distinct_keys': len(set(zipf_workload(catalog, requests, exponent))),
+            })
+            results[f"s={exponent}"] = summary
+    return results
+
+
+def bench_overload(config: StubConfig, requests: int, concurrency: int,
+                   throttle_rate: float, error_rate: float) -> Dict[str, float]:
+    """Latency and success rate while the backend throttles and fails a share of calls"""
+    images = distinct_images(requests)
+    with tempfile.TemporaryDirectory() as cache_dir:
+        backend = StubGenerativeModel(config, throttle_rate=throttle_rate, error_rate=error_rate)
+        service = make_service(backend, cache_dir, concurrency=concurrency)
+        summary = run_timed([lambda image=image: service.analyze_image(image, QUESTION) for image in images],
+                            concurrency)
+        summary.update(backend.stats())
+        summary['success_rate'] = round(1 - summary['failures'] / requests, 3)
+    return summary
+
+
+def bench_preprocess(repeat: int, sizes: Optional[Sequence[str]] = None) -> Dict[str, Dict[str, float]]:
+    """preprocess_image throughput in source megapixels per second"""
+    results = {}
+    for label in sizes or SIZES:
+        width, height = SIZES[label]
+        data = synthetic_photo((width, height))
+        timings = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            preprocess_image(io.BytesIO(data))
+            timings.append(time.perf_counter() - start)
+        best = min(timings)
+        results[label] = {
+            'seconds': round(best, 4),
+            'megapixels_per_second': round(width * height / 1e6 / best, 1),
+        }
+    return results
+
+
+def run(requests: int = 400, concurrency: int = 16, latency: float = 0.05, catalog: int = 200,
+        zipf_exponents: Sequence[float] = (0.8, 1.1), throttle_rate: float = 0.1, error_rate: float = 0.02,
+        preprocess_repeat: int = 3, preprocess_sizes: Optional[Sequence[str]] = None) -> Dict[str, Any]:
+    """Run every scenario and return the results with the settings used"""
+    config = StubConfig(latency_seconds=latency, seed=0)
+    settings = {
+        'requests': requests, 'concurrency': concurrency, 'latency_seconds': latency,
+        'catalog': catalog, 'zipf_exponents': list(zipf_exponents),
+        'throttle_rate': throttle_rate, 'error_rate': error_rate,
+    }
+    return {
+        'meta': {
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'settings': settings,
+        },
+        'results': {
+            **bench_analyze(config, requests, concurrency),
+            'zipf_cache': bench_zipf(config, requests, concurrency, catalog, zipf_exponents),
+            'overload': bench_overload(config, requests, concurrency, throttle_rate, error_rate),
+            'preprocess': bench_preprocess(preprocess_repeat, preprocess_sizes),
+        },
+    }
+
+
+def _flatten(tree: Dict[str, Any], prefix: str = '') -> Dict[str, float]:
+    flat = {}
+    for key, value in tree.items():
+        if isinstance(value, dict):
+            flat.update(_flatten(value, f"{prefix}{key}."))
+        elif isinstance(value, (int, float)):
+            flat[f"{prefix}{key}"] = value
+    return flat
+
+
+def compare(current: Dict[str, Any], baseline: Dict[str, Any]) -> Dict[str, float]:
+    """Relative change of every numeric result present in both runs"""
+    now, before = _flatten(current['results']), _flatten(baseline['results'])
+    return {
+        key: round(now[key] / before[key] - 1, 3)
+        for key in sorted(now.keys() & before.keys()) if before[key]
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--requests', type=int, default=400)
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--latency', type=float, default=0.05, help="Median stub latency in seconds")
+    parser.add_argument('--catalog', type=int, default=200, help="Distinct images in the Zipfian workload")
+    parser.add_argument('--output', default='bench_service.json', help="Write results as JSON to this file")
+    parser.add_argument('--baseline', help="Earlier results file to compare against")
+    args = parser.parse_args()
+    
+    results = run(args.requests, args.concurrency, args.latency, args.catalog)
+    print(json.dumps(results['results'], indent=2))
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    
+    if args.baseline:
+        with open(args.baseline) as f:
+            changes = compare(results, json.load(f))
+        for key, change in changes.items():
+            print(f"{key}: {change:+.1%}")
+
+
+if __name__ == '__main__':
+    main()
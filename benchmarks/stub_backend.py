@@ -0,0 +1,115 @@
+"""
+Local stand-in for the Gemini model, for benchmarks and tests without network access
+
+StubGenerativeModel implements the parts of ``genai.GenerativeModel`` that
+GeminiService uses (``generate_content`` with and without ``stream=True`` and
+``generate_content_async``) and simulates configurable latency, streaming,
+429 throttling and server errors. Pass it to ``GeminiService(model=...)``.
+"""
+import asyncio
+import json
+import random
+import threading
+import time
+from dataclasses import dataclass, replace
+from types import SimpleNamespace
+from typing import Any, Dict, Iterator, List, Optional, Sequence
+
+from google.api_core.exceptions import InternalServerError, ResourceExhausted
+
+# Tokens billed per inline image, matching Gemini 1.5 for images up to 384 px
+IMAGE_TOKENS = 258
+
+
+@dataclass
+class StubConfig:
+    """Simulated backend behaviour"""
+    latency_seconds: float = 0.05      # Median time to the complete response
+    latency_sigma: float = 0.3         # Log-normal spread of the latency
+    ttft_fraction: float = 0.2         # Share of the latency spent before the first chunk
+    chunks: int = 8                    # Chunks per streamed answer
+    throttle_rate: float = 0.0         # Fraction of calls rejected with 429
+    error_rate: float = 0.0            # Fraction of calls failing with 500
+    output_tokens: int = 64
+    seed: Optional[int] = None
+
+
+class StubGenerativeModel:
+    """Thread- and asyncio-safe fake model; counts calls, throttles and errors"""
+    
+    def __init__(self, config: Optional[StubConfig] = None, **overrides):
+        self.config = replace(config if config is not None else StubConfig(), **overrides)
+        self._random = random.Random(self.config.seed)
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.throttled = 0
+        self.failed = 0
+    
+    def _admit(self) -> float:
+        """Count a call, raise its simulated failure if any, and return its latency"""
+        with self._lock:
+            self.calls += 1
+            roll = self._random.random()
+            latency = self.config.latency_seconds * self._random.lognormvariate(0, self.config.latency_sigma)
+            if roll < self.config.throttle_rate:
+                self.throttled += 1
+                raise ResourceExhausted("Stub backend: quota exceeded")
+            if roll < self.config.throttle_rate + self.config.error_rate:
+                self.failed += 1
+                raise InternalServerError("Stub backend: internal error")
+        return latency
+    
+    def _answer(self, contents: Sequence[Any], generation_config: Optional[Dict[str, Any]] = None) -> str:
+        prompt = ' '.join(str(contents[-1]).split())
+        answer = f"Stub answer for {len(contents) - 1} image(s) to: {prompt[:60]}"
+        # Structured requests get JSON matching the requested response schema
+        if (generation_config or {}).get('response_mime_type') == 'application/json':
+            return json.dumps({'answer': answer, 'details': "Stub details", 'confidence': 'High'})
+        return f"{answer}\nConfidence: High"
+    
+    def _usage(self, contents: Sequence[Any]) -> SimpleNamespace:
+        images = sum(1 for part in contents if isinstance(part, dict))
+        prompt_tokens = images * IMAGE_TOKENS + len(str(contents[-1])) // 4
+        return SimpleNamespace(
+            prompt_token_count=prompt_tokens,
+            candidates_token_count=self.config.output_tokens,
+            total_token_count=prompt_tokens + self.config.output_tokens
+        )
+    
+    def _response(self, contents: Sequence[Any], generation_config: Optional[Dict[str, Any]]) -> SimpleNamespace:
+        return SimpleNamespace(text=self._answer(contents, generation_config), usage_metadata=self._usage(contents),
+                               resolve=lambda: None)
+    
+    def _stream(self, contents: Sequence[Any], latency: float,
+                generation_config: Optional[Dict[str, Any]]) -> Iterator[SimpleNamespace]:
+        answer = self._answer(contents, generation_config)
+        count = max(1, self.config.chunks)
+        step = -(-len(answer) // count)
+        pieces = [answer[i:i + step] for i in range(0, len(answer), step)]
+        interval = latency * (1 - self.config.ttft_fraction) / len(pieces)
+        for i, piece in enumerate(pieces):
+            if i:
+                time.sleep(interval)
+            last = i == len(pieces) - 1
+            # Like the real API, usage metadata arrives with the final chunk
+            yield SimpleNamespace(text=piece, usage_metadata=self._usage(contents) if last else None)
+    
+    def generate_content(self, contents: List[Any], stream: bool = False,
+                         generation_config: Optional[Dict[str, Any]] = None, **kwargs):
+        latency = self._admit()
+        if not stream:
+            time.sleep(latency)
+            return self._response(contents, generation_config)
+        # The real SDK returns once the first chunk has arrived
+        time.sleep(latency * self.config.ttft_fraction)
+        return self._stream(contents, latency, generation_config)
+    
+    async def generate_content_async(self, contents: List[Any],
+                                     generation_config: Optional[Dict[str, Any]] = None, **kwargs):
+        latency = self._admit()
+        await asyncio.sleep(latency)
+        return self._response(contents, generation_config)
+    
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {'calls': self.calls, 'throttled': self.throttled, 'failed': self.failed}
@@ -1,7 +1,13 @@
+import os
+import time
 import streamlit as st
-from image_processor import preprocess_image
-from gemini_service import GeminiService
-from utils import load_env_variables
+from image_processor import PAYLOAD_PROFILES, ImageTooLargeError, preprocess_image_cached, select_profile
+from gemini_service import MODEL_NAME, get_gemini_service, select_generation_profile
+from metrics import JsonLogSink, metrics, start_metrics_server
+from preprocess_pool import get_preprocess_executor
+from speculation import SPECULATION_BUDGET, SpeculativeAnalyzer, speculation_enabled
+from utils import configure_logging, load_env_variables
+from video import VIDEO_TYPES, extract_burst_keyframes, extract_video_keyframes
 from datetime import datetime
 
 # Configure Streamlit theme
@@ -129,7 +135,256 @@ st.markdown("""
     </style>
 """, unsafe_allow_html=True)
 
+def render_streamed_answer(title: str, chunks) -> str:
+    """Render answer chunks into an analysis section as they arrive and return the full text"""
+    placeholder = st.empty()
+    answer = ""
+    for chunk in chunks:
+        answer += chunk
+        placeholder.markdown(
+            f"""
+            <div class="analysis-section">
+                <div class="section-title">{title}</div>
+                <div class="section-content">{answer}</div>
+            </div>
+            """, 
+            unsafe_allow_html=True
+        )
+    return answer
+
+def render_fanout_answers(gemini_service, results) -> str:
+    """Render one analysis section per (question, response) as each completes and return the combined text"""
+    answers = []
+    for question, response in results:
+        text = gemini_service.render_text(response)
+        st.markdown(
+            f"""
+            <div class="analysis-section">
+                <div class="section-title">🔍 {question}</div>
+                <div class="section-content">{text}</div>
+            </div>
+            """, 
+            unsafe_allow_html=True
+        )
+        answers.append(f"{question}: {text}")
+    return "\n\n".join(answers)
+
+# Progress-bar levels for the confidence the model reports with each answer
+CONFIDENCE_LEVELS = {'High': 0.9, 'Medium': 0.6, 'Low': 0.3}
+
+# Spans shown in the sidebar performance panel, in pipeline order
+PERFORMANCE_SPANS = [
+    ("Preprocess queue", 'preprocess_queue_wait_seconds'),
+    ("Decode", 'preprocess_decode_seconds'),
+    ("Resize", 'preprocess_resize_seconds'),
+    ("Encode", 'preprocess_encode_seconds'),
+    ("Cache lookup", 'cache_lookup_seconds'),
+    ("Network", 'network_seconds'),
+    ("First token", 'ttft_seconds'),
+]
+
+@st.cache_resource
+def start_metrics_exporters():
+    """Start the optional Prometheus endpoint and JSON log sink once per process"""
+    port = os.getenv('CLARITY_METRICS_PORT')
+    if port:
+        start_metrics_server(int(port))
+    if os.getenv('CLARITY_METRICS_JSON_LOG'):
+        metrics.add_sink(JsonLogSink())
+    return True
+
+def preprocess_upload(uploaded_file, profile) -> bytes:
+    """Preprocess an upload in the worker pool, stopping the run with a message if it is too large"""
+    try:
+        return preprocess_image_cached(uploaded_file, profile, executor=get_preprocess_executor())
+    except ImageTooLargeError as e:
+        st.error(f"This image is too large to process: {str(e)}")
+        st.stop()
+
+def session_speculator(gemini_service) -> SpeculativeAnalyzer:
+    """Return this session's speculative analyzer, which preprocesses through the worker pool"""
+    speculator = st.session_state.get('speculator')
+    if speculator is None or speculator.service is not gemini_service:
+        speculator = SpeculativeAnalyzer(
+            gemini_service,
+            budget=int(os.getenv('CLARITY_SPECULATION_BUDGET', SPECULATION_BUDGET)),
+            preprocess=lambda raw, profile: preprocess_image_cached(raw, profile, executor=get_preprocess_executor())
+        )
+        st.session_state.speculator = speculator
+    return speculator
+
+def render_run_details(response, elapsed: float):
+    """Render the confidence bar and the measured details of one analysis"""
+    confidence = response.get('confidence')
+    if confidence in CONFIDENCE_LEVELS:
+        col1, col2 = st.columns([3, 1])
+        with col1:
+            st.markdown('<div class="section-title">✨ Confidence Level</div>', unsafe_allow_html=True)
+            st.progress(CONFIDENCE_LEVELS[confidence], text=f"{confidence} Confidence")
+    
+    usage = response.get('usage') or {}
+    items = [
+        ("Model", "Gemini 1.5 Flash"),
+        ("Processing Time", f"{elapsed:.2f}s"),
+    ]
+    if response.get('ttft_seconds') is not None:
+        items.append(("First Token", f"{response['ttft_seconds']:.2f}s"))
+    if 'input_tokens' in usage:
+        items.append(("Tokens", f"{usage['input_tokens']} in / {usage.get('output_tokens', 0)} out"))
+    items.append(("Status", "Cached" if response.get('cached') else "Success"))
+    
+    rows = "".join(
+        f"""
+        <div class="details-item">
+            <span class="details-label">{label}</span>
+            <span class="details-value">{value}</span>
+        </div>
+        """
+        for label, value in items
+    )
+    st.markdown(f'<div class="details-container">{rows}</div>', unsafe_allow_html=True)
+
+def render_performance_panel():
+    """Show per-stage p50/p95 latency and cache counters for this process"""
+    snapshot = metrics.snapshot()
+    observations = snapshot['observations']
+    counters = snapshot['counters']
+    
+    with st.expander("Performance"):
+        for label, name in PERFORMANCE_SPANS:
+            if name in observations:
+                summary = observations[name]
+                st.markdown(
+                    f"**{label}:** p50 {summary['p50'] * 1000:.0f} ms · "
+                    f"p95 {summary['p95'] * 1000:.0f} ms ({summary['count']})"
+                )
+        hits = counters.get('cache_hits', 0)
+        misses = counters.get('cache_misses', 0)
+        if hits or misses:
+            st.markdown(f"**Cache:** {hits:.0f} hits / {misses:.0f} misses ({hits / (hits + misses):.0%})")
+        queued = snapshot['gauges'].get('preprocess_pool_queued')
+        if queued is not None:
+            st.markdown(
+                f"**Preprocess workers:** {snapshot['gauges']['preprocess_pool_pending']} busy or queued "
+                f"({queued} waiting), {snapshot['gauges']['preprocess_pool_rejected']} rejected"
+            )
+        coalesced = snapshot['gauges'].get('response_cache_in_flight_coalesced')
+        if coalesced:
+            st.markdown(f"**Coalesced requests:** {coalesced}")
+        speculative = counters.get('speculative_requests')
+        if speculative:
+            st.markdown(
+                f"**Speculative requests:** {speculative:.0f} "
+                f"({counters.get('speculative_cancelled', 0):.0f} prompts cancelled)"
+            )
+        if 'input_tokens' in counters:
+            st.markdown(
+                f"**Tokens:** {counters['input_tokens']:.0f} in / {counters.get('output_tokens', 0):.0f} out"
+            )
+
+@st.cache_data(show_spinner=False, max_entries=8)
+def video_keyframes(video: bytes, suffix: str, profile_name: str):
+    """Keyframes of a clip, memoized by content so reruns do not decode it again"""
+    return extract_video_keyframes(video, PAYLOAD_PROFILES[profile_name], suffix=suffix)
+
+def is_video(uploaded_file) -> bool:
+    return uploaded_file.name.rsplit('.', 1)[-1].lower() in VIDEO_TYPES
+
+def render_video(gemini_service, uploaded_file, analysis_mode: str):
+    """Ask about a short clip through its scene-change keyframes, in one request"""
+    st.markdown('<p class="sub-header">Ask about the video</p>', unsafe_allow_html=True)
+    question = st.text_input("Video question:", placeholder="What happens in this clip?", key="video_question")
+    
+    profile = select_profile(analysis_mode, question or "")
+    with st.spinner("✨ Selecting keyframes..."):
+        try:
+            keyframes = video_keyframes(uploaded_file.getvalue(), '.' + uploaded_file.name.rsplit('.', 1)[-1],
+                                        profile.name)
+        except ValueError as e:
+            st.error(f"Could not read this video: {str(e)}")
+            return
+    st.image([keyframe.image for keyframe in keyframes],
+             caption=[f"{keyframe.timestamp:.1f}s" for keyframe in keyframes], width=120)
+    
+    if question and st.button("Analyze Video", type="primary"):
+        with st.spinner("✨ Analyzing video..."):
+            try:
+                start = time.perf_counter()
+                response = gemini_service.analyze_frames(
+                    [keyframe.image for keyframe in keyframes], question,
+                    timestamps=[keyframe.timestamp for keyframe in keyframes],
+                    profile=select_generation_profile(analysis_mode)
+                )
+                elapsed = time.perf_counter() - start
+                
+                st.markdown('<h3 class="analysis-header">Analysis Results</h3>', unsafe_allow_html=True)
+                st.markdown(
+                    f"""
+                    <div class="analysis-section">
+                        <div class="section-title">🔍 Video Analysis</div>
+                        <div class="section-content">{gemini_service.render_text(response)}</div>
+                    </div>
+                    """, 
+                    unsafe_allow_html=True
+                )
+                render_run_details(response, elapsed)
+            except Exception as e:
+                st.error(f"An error occurred: {str(e)}")
+
+def render_gallery(gemini_service, gallery_files, analysis_mode: str):
+    """Compare every uploaded gallery image in one grouped or pairwise analysis"""
+    st.markdown('<p class="sub-header">Compare the gallery</p>', unsafe_allow_html=True)
+    st.image(gallery_files, caption=[f"Image {i}" for i in range(1, len(gallery_files) + 1)], width=160)
+    
+    question = st.text_input("Gallery question:", placeholder="What would you like to compare across these images?",
+                             key="gallery_question")
+    burst = st.toggle("Analyze as a burst sequence", key="gallery_burst",
+                      help="Send only the distinct shots, in upload order, as one sequence")
+    pairwise = not burst and st.toggle("Compare every pair", key="gallery_pairwise")
+    
+    if question and st.button("Compare All", type="primary"):
+        with st.spinner("✨ Comparing gallery..."):
+            try:
+                profile = select_profile(analysis_mode, question)
+                if burst:
+                    keyframes = extract_burst_keyframes([gallery_file.getvalue() for gallery_file in gallery_files],
+                                                        profile, executor=get_preprocess_executor())
+                    response = dict(
+                        gemini_service.analyze_frames(
+                            [keyframe.image for keyframe in keyframes], question,
+                            profile=select_generation_profile(analysis_mode)
+                        ),
+                        shots=[keyframe.index + 1 for keyframe in keyframes]
+                    )
+                else:
+                    images = [preprocess_upload(gallery_file, profile) for gallery_file in gallery_files]
+                    response = gemini_service.analyze_gallery(
+                        images, question, mode='pairwise' if pairwise else 'grouped',
+                        profile=select_generation_profile(analysis_mode)
+                    )
+                
+                st.markdown('<h3 class="analysis-header">Analysis Results</h3>', unsafe_allow_html=True)
+                st.markdown(
+                    f"""
+                    <div class="analysis-section">
+                        <div class="section-title">🔍 Gallery Analysis</div>
+                        <div class="section-content">{gemini_service.render_text(response)}</div>
+                    </div>
+                    """, 
+                    unsafe_allow_html=True
+                )
+                if 'shots' in response:
+                    st.caption(f"Distinct shots sent: images {', '.join(map(str, response['shots']))}")
+                if 'descriptions' in response:
+                    with st.expander("Image Descriptions"):
+                        for item in response['descriptions']:
+                            st.markdown(f"**Image {item['image']}:** {item['description']}")
+            except Exception as e:
+                st.error(f"An error occurred: {str(e)}")
+
 def main():
+    configure_logging()
+    
     # Initialize chat history if not exists
     if 'chat_history' not in st.session_state:
         st.session_state.chat_history = []
@@ -137,9 +392,10 @@ def main():
     # Title with custom styling
     st.markdown('<h1 class="main-header">Clarity - Intelligent Image Analysis</h1>', unsafe_allow_html=True)
     
-    # Initialize Gemini service
+    # Reuse the process-wide Gemini service across reruns and sessions
     api_key = load_env_variables()["GOOGLE_API_KEY"]
-    gemini_service = GeminiService(api_key)
+    gemini_service = get_gemini_service(api_key)
+    start_metrics_exporters()
     
     # Move sidebar settings outside of the columns
     with st.sidebar:
@@ -151,26 +407,47 @@ def main():
         )
         if st.toggle("Compare Images", key="compare_toggle"):
             st.session_state.uploaded_file2 = st.file_uploader("Upload second image", type=["jpg", "jpeg", "png"], key="file2")
+        gallery_files = []
+        if st.toggle("Gallery Mode", key="gallery_toggle"):
+            gallery_files = st.file_uploader(
+                "Upload images to compare", type=["jpg", "jpeg", "png"],
+                accept_multiple_files=True, key="gallery_files"
+            ) or []
+        tiling = st.toggle(
+            "High-Resolution Tiling", key="tiling_toggle",
+            help="Analyze large scans and documents as overlapping full-resolution tiles"
+        )
+        speculate = st.toggle(
+            "Pre-analyze Uploads", value=speculation_enabled(), key="speculation_toggle",
+            help="Answer the likely quick prompts in the background as soon as an image is uploaded"
+        )
+        render_performance_panel()
     
     # Create two columns for layout
     col1, col2 = st.columns([1, 1])
     
     with col1:
-        uploaded_file = st.file_uploader("Upload an image", type=["jpg", "jpeg", "png"])
+        uploaded_file = st.file_uploader("Upload an image or a short video", type=["jpg", "jpeg", "png"] + VIDEO_TYPES)
         
-        if uploaded_file:
+        if uploaded_file and is_video(uploaded_file):
+            st.video(uploaded_file)
+        elif uploaded_file:
             st.image(uploaded_file, caption="Uploaded Image", use_column_width=True)
     
+    # Start on the likely first questions while the user is still choosing one;
+    # a new upload or mode cancels what has not started for the previous one
+    speculator = session_speculator(gemini_service)
+    if (speculate and uploaded_file and not is_video(uploaded_file)
+            and not st.session_state.get('uploaded_file2')):
+        speculator.speculate(uploaded_file.getvalue(), analysis_mode)
+    else:
+        speculator.cancel()
+    
     with col2:
         if uploaded_file:
-            # Process image without slider values
-            processed_image = preprocess_image(uploaded_file)
-            
-            if st.session_state.get('uploaded_file2'):
-                # Process both images without slider values
-                processed_image1 = preprocess_image(uploaded_file)
-                processed_image2 = preprocess_image(st.session_state.uploaded_file2)
-                
+            if is_video(uploaded_file):
+                render_video(gemini_service, uploaded_file, analysis_mode)
+            elif st.session_state.get('uploaded_file2'):
                 # Display second image
                 st.image(st.session_state.uploaded_file2, caption="Second Image", use_column_width=True)
                 
@@ -207,57 +484,50 @@ def main():
                     question = st.text_input("Or type your own comparison question:", 
                                            placeholder="What would you like to compare between these images?")
                 
+                # Upload size and quality follow the mode and question; preprocessing
+                # is memoized by content, so reruns reuse the result
+                profile = select_profile(analysis_mode, question or "")
+                processed_image1 = preprocess_upload(uploaded_file, profile)
+                processed_image2 = preprocess_upload(st.session_state.uploaded_file2, profile)
+                # Answer length and sampling follow the analysis mode as well
+                generation = select_generation_profile(analysis_mode)
+                
                 if question and st.button("Compare", type="primary"):
                     with st.spinner("✨ Comparing images..."):
                         try:
-                            response = gemini_service.analyze_images_comparison(
-                                processed_image1, 
-                                processed_image2, 
-                                question
-                            )
+                            start = time.perf_counter()
+                            stream_result = {}
                             
                             # Analysis Results Container
                             st.markdown('<h3 class="analysis-header">Analysis Results</h3>', unsafe_allow_html=True)
                             
-                            # Main Analysis
-                            st.markdown(
-                                f"""
-                                <div class="analysis-section">
-                                    <div class="section-title">🔍 Comparison Analysis</div>
-                                    <div class="section-content">{response["answer"]}</div>
-                                </div>
-                                """, 
-                                unsafe_allow_html=True
-                            )
-                            
-                            # Confidence Level
-                            col1, col2 = st.columns([3, 1])
-                            with col1:
-                                st.markdown('<div class="section-title">✨ Confidence Level</div>', unsafe_allow_html=True)
-                                st.progress(0.85, text="High Confidence")
+                            # Main Analysis: one parallel request per selected question,
+                            # otherwise rendered as it streams in
+                            if len(comparison_prompts) > 1:
+                                answer = render_fanout_answers(
+                                    gemini_service,
+                                    gemini_service.compare_prompts(
+                                        processed_image1, processed_image2, comparison_prompts, profile=generation
+                                    )
+                                )
+                            else:
+                                answer = render_streamed_answer(
+                                    "🔍 Comparison Analysis",
+                                    gemini_service.analyze_images_comparison_stream(
+                                        processed_image1, 
+                                        processed_image2, 
+                                        question,
+                                        result=stream_result,
+                                        profile=generation
+                                    )
+                                )
+                            response = dict(stream_result, answer=answer, model=MODEL_NAME)
+                            elapsed = time.perf_counter() - start
                             
-                            # Details
-                            st.markdown(
-                                """
-                                <div class="details-container">
-                                    <div class="details-item">
-                                        <span class="details-label">Model</span>
-                                        <span class="details-value">Gemini 1.5 Flash</span>
-                                    </div>
-                                    <div class="details-item">
-                                        <span class="details-label">Processing Time</span>
-                                        <span class="details-value">0.8s</span>
-                                    </div>
-                                    <div class="details-item">
-                                        <span class="details-label">Status</span>
-                                        <span class="details-value">Success</span>
-                                    </div>
-                                </div>
-                                """,
-                                unsafe_allow_html=True
-                            )
+                            # Confidence and measured timings
+                            render_run_details(response, elapsed)
                             
-                            if 'raw_response' in response:
+                            if 'model' in response:
                                 with st.expander("Additional Details"):
                                     st.markdown("""
                                         <div style='background-color: var(--surface-color); padding: 15px; border-radius: 8px;'>
@@ -266,10 +536,6 @@ def main():
                                         </div>
                                     """, unsafe_allow_html=True)
                             
-                            if 'confidence' in response:
-                                confidence = float(response['confidence'])
-                                st.progress(confidence, text=f"Confidence: {confidence*100:.0f}%")
-                            
                             if response:
                                 st.session_state.chat_history.append({
                                     'question': question,
@@ -290,9 +556,6 @@ def main():
                         except Exception as e:
                             st.error(f"An error occurred: {str(e)}")
             else:
-                # Process image without slider values
-                processed_image = preprocess_image(uploaded_file)
-                
                 st.markdown('<p class="sub-header">Ask about the image</p>', unsafe_allow_html=True)
                 question = st.text_input("", placeholder="What would you like to know about this image?")
                 
@@ -303,54 +566,67 @@ def main():
                 )
                 if quick_prompts:
                     question = " & ".join(quick_prompts)
+                if tiling and len(quick_prompts) > 1:
+                    st.info("High-resolution tiling applies to a single question; the selected quick "
+                            "prompts are answered from the downsampled image.")
+                
+                # Upload size and quality follow the mode and question; preprocessing
+                # is memoized by content, so reruns reuse the result
+                processed_image = preprocess_upload(uploaded_file, select_profile(analysis_mode, question or ""))
+                # Answer length and sampling follow the analysis mode as well
+                generation = select_generation_profile(analysis_mode)
                 
                 if question and st.button("Analyze", type="primary"):
                     with st.spinner("✨ Analyzing image..."):
                         try:
-                            response = gemini_service.analyze_image(processed_image, question)
+                            start = time.perf_counter()
+                            stream_result = {}
                             
                             # Analysis Results Container
                             st.markdown('<h3 class="analysis-header">Analysis Results</h3>', unsafe_allow_html=True)
                             
-                            # Main Analysis
-                            st.markdown(
-                                f"""
-                                <div class="analysis-section">
-                                    <div class="section-title">🔍 Analysis</div>
-                                    <div class="section-content">{response["answer"]}</div>
-                                </div>
-                                """, 
-                                unsafe_allow_html=True
-                            )
+                            # Main Analysis: one parallel request per selected prompt,
+                            # otherwise rendered as it streams in
+                            if len(quick_prompts) > 1:
+                                # Each prompt is sent at the payload profile it gets on its own,
+                                # so answers cached for single prompts are reused
+                                prompt_images = {
+                                    prompt: preprocess_upload(uploaded_file, select_profile(analysis_mode, prompt))
+                                    for prompt in quick_prompts
+                                }
+                                answer = render_fanout_answers(
+                                    gemini_service,
+                                    gemini_service.analyze_prompts(prompt_images, quick_prompts, profile=generation)
+                                )
+                            elif tiling:
+                                # Tiles are cut from the original upload, not the downsampled image
+                                stream_result = gemini_service.analyze_image_tiled(
+                                    uploaded_file, question, profile=generation,
+                                    executor=get_preprocess_executor()
+                                )
+                                answer = render_streamed_answer(
+                                    "🔍 Tiled Analysis", [gemini_service.render_text(stream_result)]
+                                )
+                                with st.expander(f"Tile Answers ({len(stream_result['tiles'])})"):
+                                    for tile in stream_result['tiles']:
+                                        left, upper, right, lower = tile['box']
+                                        st.markdown(
+                                            f"**Tile {tile['tile']}** ({left}-{right} x {upper}-{lower}): {tile['answer']}"
+                                        )
+                            else:
+                                answer = render_streamed_answer(
+                                    "🔍 Analysis",
+                                    gemini_service.analyze_image_stream(
+                                        processed_image, question, result=stream_result, profile=generation
+                                    )
+                                )
+                            response = dict(stream_result, answer=answer, model=MODEL_NAME)
+                            elapsed = time.perf_counter() - start
                             
-                            # Confidence Level
-                            col1, col2 = st.columns([3, 1])
-                            with col1:
-                                st.markdown('<div class="section-title">✨ Confidence Level</div>', unsafe_allow_html=True)
-                                st.progress(0.85, text="High Confidence")
+                            # Confidence and measured timings
+                            render_run_details(response, elapsed)
                             
-                            # Details
-                            st.markdown(
-                                """
-                                <div class="details-container">
-                                    <div class="details-item">
-                                        <span class="details-label">Model</span>
-                                        <span class="details-value">Gemini 1.5 Flash</span>
-                                    </div>
-                                    <div class="details-item">
-                                        <span class="details-label">Processing Time</span>
-                                        <span class="details-value">0.8s</span>
-                                    </div>
-                                    <div class="details-item">
-                                        <span class="details-label">Status</span>
-                                        <span class="details-value">Success</span>
-                                    </div>
-                                </div>
-                                """,
-                                unsafe_allow_html=True
-                            )
-                            
-                            if 'raw_response' in response:
+                            if 'model' in response:
                                 with st.expander("Additional Details"):
                                     st.markdown("""
                                         <div style='background-color: var(--surface-color); padding: 15px; border-radius: 8px;'>
@@ -359,10 +635,6 @@ def main():
                                         </div>
                                     """, unsafe_allow_html=True)
                             
-                            if 'confidence' in response:
-                                confidence = float(response['confidence'])
-                                st.progress(confidence, text=f"Confidence: {confidence*100:.0f}%")
-                            
                             if response:
                                 st.session_state.chat_history.append({
                                     'question': question,
@@ -390,6 +662,9 @@ def main():
                 unsafe_allow_html=True
             )
 
+    if len(gallery_files) >= 2:
+        render_gallery(gemini_service, gallery_files, analysis_mode)
+    
     # Footer
     st.markdown("""
         <div class="footer">
@@ -0,0 +1,254 @@
+"""
+Headless batch analysis over directories of images
+
+Usage:
+    python -m src.batch INPUT -q "Describe the scene" -q "List main objects" -o results.jsonl
+
+INPUT is a directory (searched recursively for jpg/jpeg/png files) or a
+manifest: a text file with one image path per line, or a JSONL file of
+{"path": ..., "questions": [...]} objects. Results are appended to the output
+JSONL as they complete, and (path, question) pairs already answered in it
+are skipped, so an interrupted run can simply be restarted.
+"""
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+try:
+    from .gemini_service import MODEL_NAME, get_gemini_service
+    from .image_processor import preprocess_image
+    from .utils import configure_logging, load_env_variables
+except ImportError:
+    from gemini_service import MODEL_NAME, get_gemini_service
+    from image_processor import preprocess_image
+    from utils import configure_logging, load_env_variables
+
+logger = logging.getLogger(__name__)
+
+IMAGE_EXTENSIONS = {'.jpg', '.jpeg', '.png'}
+
+
+@dataclass
+class BatchJob:
+    """One image and the questions still to be asked about it"""
+    path: str
+    questions: List[str]
+
+
+@dataclass
+class BatchStats:
+    """Counters reported at the end of a batch run"""
+    images: int = 0
+    requests: int = 0
+    failures: int = 0
+    skipped: int = 0
+    elapsed_seconds: float = 0.0
+    _lock: threading.Lock = field(default_factory=threading.Lock, repr=False, compare=False)
+    
+    @property
+    def images_per_second(self) -> float:
+        return self.images / self.elapsed_seconds if self.elapsed_seconds else 0.0
+    
+    def as_dict(self) -> Dict[str, float]:
+        return {
+            'images': self.images,
+            'requests': self.requests,
+            'failures': self.failures,
+            'skipped': self.skipped,
+            'elapsed_seconds': round(self.elapsed_seconds, 3),
+            'images_per_second': round(self.images_per_second, 3),
+        }
+
+
+def discover_inputs(source: Path, questions: List[str]) -> Iterator[BatchJob]:
+    """
+    Yield a BatchJob per image in a directory or manifest
+    
+    Args:
+        source: Directory of images, text manifest or JSONL manifest
+        questions: Default questions for entries that do not list their own
+    """
+    if source.is_dir():
+        for path in sorted(source.rglob('*')):
+            if path.suffix.lower() in IMAGE_EXTENSIONS:
+                yield BatchJob(str(path), list(questions))
+        return
+    
+    base = source.parent
+    with open(source) as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            if source.suffix == '.jsonl':
+                entry = json.loads(line)
+                yield BatchJob(str(base / entry['path']), list(entry.get('questions') or questions))
+            else:
+                yield BatchJob(str(base / line), list(questions))
+
+
+def load_completed(output_path: Path) -> Set[Tuple[str, str]]:
+    """Return the (path, question) pairs already answered successfully in output_path"""
+    completed = set()
+    if not output_path.exists():
+        return completed
+    
+    with open(output_path) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # A partially written last line from an interrupted run
+                continue
+            if not record.get('error'):
+                completed.add((record['path'], record['question']))
+    return completed
+
+
+def _preprocess_path(path: str) -> bytes:
+    """Process-pool worker: load and preprocess one image file"""
+    return preprocess_image(path)
+
+
+def run_batch(service, jobs: Iterable[BatchJob], output_path: Path,
+              preprocess_workers: int = os.cpu_count() or 1, concurrency: int = 8) -> BatchStats:
+    """
+    Preprocess images in a process pool and analyze them with bounded concurrency
+    
+    Workers are spawned rather than forked: the service has gRPC and SQLite
+    threads running, and forking a threaded process is unsafe.
+    
+    Args:
+        service: GeminiService used for the API calls
+        jobs: Images and questions to process
+        output_path: JSONL file results are appended to
+        preprocess_workers: Number of preprocessing processes
+        concurrency: Maximum number of API calls in flight
+    
+    Returns:
+        BatchStats for the run
+    """
+    stats = BatchStats()
+    completed = load_completed(output_path)
+    write_lock = threading.Lock()
+    # Bounds queued API work so preprocessing cannot run far ahead of the network
+    api_slots = threading.BoundedSemaphore(concurrency * 2)
+    start = time.perf_counter()
+    
+    def analyze(out, path: str, image: bytes, question: str) -> None:
+        request_start = time.perf_counter()
+        record = {'path': path, 'question': question, 'model': MODEL_NAME}
+        try:
+            result = service.analyze_image(image, question)
+            record['answer'] = result['answer']
+            record['details'] = result.get('details')
+            record['confidence'] = result.get('confidence')
+            record['error'] = None
+        except Exception as e:
+            logger.error(f"Batch request failed for {path}: {str(e)}")
+            record['answer'] = None
+            record['error'] = str(e)
+        finally:
+            api_slots.release()
+        record['seconds'] = round(time.perf_counter() - request_start, 3)
+        
+        with write_lock:
+            out.write(json.dumps(record) + '\n')
+            out.flush()
+            with stats._lock:
+                stats.requests += 1
+                if record['error']:
+                    stats.failures += 1
+    
+    def preprocessing_failed(out, path: str, questions: List[str], error: Exception) -> None:
+        # One error record per question, so the output covers every input and --resume retries them
+        records = [
+            {'path': path, 'question': question, 'model': MODEL_NAME, 'answer': None,
+             'error': f"Preprocessing failed: {str(error)}", 'seconds': 0.0}
+            for question in questions
+        ]
+        with write_lock:
+            out.writelines(json.dumps(record) + '\n' for record in records)
+            out.flush()
+            with stats._lock:
+                stats.failures += len(records)
+    
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+    with open(output_path, 'a') as out, \
+            ProcessPoolExecutor(max_workers=preprocess_workers,
+                                mp_context=multiprocessing.get_context('spawn')) as preprocess_pool, \
+            ThreadPoolExecutor(max_workers=concurrency) as api_pool:
+        pending = []
+        for job in jobs:
+            remaining = [q for q in job.questions if (job.path, q) not in completed]
+            stats.skipped += len(job.questions) - len(remaining)
+            if remaining:
+                pending.append((job.path, remaining, preprocess_pool.submit(_preprocess_path, job.path)))
+            # Keep a bounded window of preprocessing jobs in flight
+            while pending and (len(pending) > preprocess_workers * 2 or pending[0][2].done()):
+                _dispatch(pending.pop(0), api_pool, api_slots, analyze, preprocessing_failed, out, stats)
+        for item in pending:
+            _dispatch(item, api_pool, api_slots, analyze, preprocessing_failed, out, stats)
+    
+    stats.elapsed_seconds = time.perf_counter() - start
+    return stats
+
+
+def _dispatch(item, api_pool, api_slots, analyze, preprocessing_failed, out, stats: BatchStats) -> None:
+    """Wait for one preprocessed image and queue its API calls, or record why it failed"""
+    path, questions, future = item
+    try:
+        image = future.result()
+    except Exception as e:
+        logger.error(f"Preprocessing failed for {path}: {str(e)}")
+        preprocessing_failed(out, path, questions, e)
+        return
+    
+    with stats._lock:
+        stats.images += 1
+    for question in questions:
+        api_slots.acquire()
+        api_pool.submit(analyze, out, path, image, question)
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Analyze a directory or manifest of images with Gemini")
+    parser.add_argument('input', type=Path, help="Image directory, text manifest or JSONL manifest")
+    parser.add_argument('-q', '--question', action='append', default=[], help="Question to ask (repeatable)")
+    parser.add_argument('--questions-file', type=Path, help="File with one question per line")
+    parser.add_argument('-o', '--output', type=Path, default=Path('results.jsonl'), help="Output JSONL file")
+    parser.add_argument('--preprocess-workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--concurrency', type=int, default=8, help="Maximum API calls in flight")
+    args = parser.parse_args(argv)
+    configure_logging()
+    
+    questions = list(args.question)
+    if args.questions_file:
+        questions += [q.strip() for q in args.questions_file.read_text().splitlines() if q.strip()]
+    if not questions:
+        parser.error("at least one --question or --questions-file is required")
+    
+    service = get_gemini_service(load_env_variables()["GOOGLE_API_KEY"])
+    stats = run_batch(
+        service,
+        discover_inputs(args.input, questions),
+        args.output,
+        preprocess_workers=args.preprocess_workers,
+        concurrency=args.concurrency
+    )
+    
+    logger.info(f"Batch finished: {stats.as_dict()}")
+    print(json.dumps(stats.as_dict()))
+    return 1 if stats.failures else 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
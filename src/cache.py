@@ -0,0 +1,433 @@
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional, Tuple, Union
+
+logger = logging.getLogger(__name__)
+
+
+class LRUCache:
+    """Thread-safe LRU cache bounded by the total size of its values"""
+    
+    def __init__(self, max_bytes: int, sizeof: Callable[[Any], int] = len,
+                 ttl_seconds: Optional[float] = None):
+        """
+        Args:
+            max_bytes: Total size budget for all cached values
+            sizeof: Function returning the size in bytes of a cached value
+            ttl_seconds: Lifetime of an entry after it is written; None never expires
+        """
+        self.max_bytes = max_bytes
+        self._sizeof = sizeof
+        self.ttl_seconds = ttl_seconds
+        self._entries: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+    
+    def _live_entry(self, key: Hashable) -> Optional[tuple]:
+        """Return key's entry, dropping it if it has expired; call with the lock held"""
+        entry = self._entries.get(key)
+        if entry is not None and entry[2] is not None and entry[2] <= time.time():
+            del self._entries[key]
+            self._bytes -= entry[1]
+            self.expirations += 1
+            return None
+        return entry
+    
+    def get(self, key: Hashable) -> Optional[Any]:
+        """Return the cached value for key, or None on a miss or an expired entry"""
+        with self._lock:
+            entry = self._live_entry(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+    
+    def put(self, key: Hashable, value: Any, expires_at: Optional[float] = None) -> None:
+        """
+        Store value under key, evicting least recently used entries to fit
+        
+        The entry expires at expires_at (a time.time() value) if given,
+        otherwise ttl_seconds from now.
+        """
+        size = self._sizeof(value)
+        if size > self.max_bytes:
+            return
+        if expires_at is None and self.ttl_seconds is not None:
+            expires_at = time.time() + self.ttl_seconds
+        
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= old[1]
+            self._entries[key] = (value, size, expires_at)
+            self._bytes += size
+            
+            while self._bytes > self.max_bytes:
+                _, (_, evicted_size, _) = self._entries.popitem(last=False)
+                self._bytes -= evicted_size
+                self.evictions += 1
+    
+    def clear(self) -> None:
+        """Drop all entries; counters are kept"""
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+    
+    def stats(self) -> Dict[str, int]:
+        """Return hit/miss/eviction counters and current residency"""
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'max_bytes': self.max_bytes,
+            }
+    
+    def __contains__(self, key: Hashable) -> bool:
+        with self._lock:
+            return self._live_entry(key) is not None
+    
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._entries)
+
+
+class DiskCache:
+    """SQLite-backed JSON store with TTLs and a total size cap
+    
+    The database runs in WAL mode so every worker process on a host can read
+    and write it concurrently, and each write is a single transaction, so a
+    crash never leaves a partially written entry behind.
+    """
+    
+    def __init__(self, path: Union[str, Path], max_bytes: int, ttl_seconds: float):
+        """
+        Args:
+            path: SQLite database file; parent directories are created
+            max_bytes: Total size budget for all stored values
+            ttl_seconds: Lifetime of an entry after it is written
+        """
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self._local = threading.local()
+        
+        with self._connect() as conn:
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS responses (
+                    key TEXT PRIMARY KEY,
+                    value TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    expires_at REAL NOT NULL,
+                    accessed_at REAL NOT NULL
+                )
+                """
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed_at)")
+    
+    def _connect(self) -> sqlite3.Connection:
+        """Return this thread's connection, opening it on first use"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+    
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        """Return the stored value for key, or None if missing or expired"""
+        entry = self.get_entry(key)
+        return entry[0] if entry is not None else None
+    
+    def get_entry(self, key: str) -> Optional[Tuple[Dict[str, Any], float]]:
+        """Return (value, expires_at) for key, or None if missing or expired"""
+        now = time.time()
+        try:
+            with self._connect() as conn:
+                row = conn.execute(
+                    "SELECT value, expires_at FROM responses WHERE key = ? AND expires_at > ?",
+                    (key, now)
+                ).fetchone()
+                if row is None:
+                    return None
+                conn.execute("UPDATE responses SET accessed_at = ? WHERE key = ?", (now, key))
+            return json.loads(row[0]), row[1]
+        except (sqlite3.Error, ValueError) as e:
+            logger.warning(f"Disk cache read failed: {str(e)}")
+            return None
+    
+    def put(self, key: str, value: Dict[str, Any]) -> None:
+        """Store value under key, evicting expired then least recently used entries"""
+        payload = json.dumps(value)
+        size = len(payload.encode('utf-8'))
+        if size > self.max_bytes:
+            return
+        
+        now = time.time()
+        try:
+            with self._connect() as conn:
+                conn.execute(
+                    "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)",
+                    (key, payload, size, now + self.ttl_seconds, now)
+                )
+                conn.execute("DELETE FROM responses WHERE expires_at <= ?", (now,))
+                
+                total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+                if total > self.max_bytes:
+                    self._evict(conn, total - self.max_bytes)
+        except sqlite3.Error as e:
+            logger.warning(f"Disk cache write failed: {str(e)}")
+    
+    @staticmethod
+    def _evict(conn: sqlite3.Connection, excess: int) -> None:
+        """Delete least recently used rows until at least excess bytes are freed"""
+        freed = 0
+        doomed = []
+        for key, size in conn.execute("SELECT key, size FROM responses ORDER BY accessed_at"):
+            if freed >= excess:
+                break
+            doomed.append((key,))
+            freed += size
+        conn.executemany("DELETE FROM responses WHERE key = ?", doomed)
+    
+    def stats(self) -> Dict[str, int]:
+        """Return the number of stored entries and their total size"""
+        with self._connect() as conn:
+            entries, total = conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses"
+            ).fetchone()
+        return {'entries': entries, 'bytes': total, 'max_bytes': self.max_bytes}
+
+
+class ResponseCache:
+    """
+    Two-tier response cache: an in-memory LRU in front of a DiskCache
+    
+    Memory entries expire together with their disk copy, so a long-running
+    process never serves an answer the disk tier has already expired.
+    """
+    
+    def __init__(self, memory: LRUCache, disk: Optional[DiskCache] = None):
+        self.memory = memory
+        self.disk = disk
+    
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        """Look key up in memory, then on disk, promoting disk hits to memory"""
+        value = self.memory.get(key)
+        if value is None and self.disk is not None:
+            entry = self.disk.get_entry(key)
+            if entry is not None:
+                value, expires_at = entry
+                self.memory.put(key, value, expires_at=expires_at)
+        return value
+    
+    def put(self, key: str, value: Dict[str, Any]) -> None:
+        """Write value through both tiers"""
+        expires_at = time.time() + self.disk.ttl_seconds if self.disk is not None else None
+        self.memory.put(key, value, expires_at=expires_at)
+        if self.disk is not None:
+            self.disk.put(key, value)
+    
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        """Return per-tier statistics"""
+        return {
+            'memory': self.memory.stats(),
+            'disk': self.disk.stats() if self.disk is not None else {},
+        }
+
+
+class SingleFlight:
+    """
+    Collapses concurrent calls with the same key into one execution
+    
+    The first caller for a key (the leader) runs the function; callers that
+    arrive while it is in flight wait and receive the same result, or the
+    same exception.
+    """
+    
+    class _Call:
+        __slots__ = ('done', 'result', 'error', 'waiters')
+        
+        def __init__(self):
+            self.done = threading.Event()
+            self.result = None
+            self.error: Optional[BaseException] = None
+            self.waiters = 0
+    
+    def __init__(self):
+        self._calls: Dict[Hashable, 'SingleFlight._Call'] = {}
+        self._lock = threading.Lock()
+        self.leaders = 0
+        self.coalesced = 0
+    
+    def do(self, key: Hashable, fn: Callable[[], Any]) -> Any:
+        """Return fn(), sharing one execution among concurrent callers for key"""
+        with self._lock:
+            call = self._calls.get(key)
+            if call is not None:
+                call.waiters += 1
+                self.coalesced += 1
+                leader = False
+            else:
+                call = self._calls[key] = self._Call()
+                self.leaders += 1
+                leader = True
+        
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+        
+        try:
+            call.result = fn()
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+    
+    def join(self, key: Hashable) -> Any:
+        """Wait for the call in flight for key and return its result; None if nothing is in flight"""
+        with self._lock:
+            call = self._calls.get(key)
+            if call is None:
+                return None
+            call.waiters += 1
+            self.coalesced += 1
+        
+        call.done.wait()
+        if call.error is not None:
+            raise call.error
+        return call.result
+    
+    def waiters(self, key: Hashable) -> int:
+        """Number of callers currently waiting on the in-flight call for key"""
+        with self._lock:
+            call = self._calls.get(key)
+            return call.waiters if call is not None else 0
+    
+    def stats(self) -> Dict[str, int]:
+        """Return in-flight keys, their waiting callers, and lifetime leader/coalesced counts"""
+        with self._lock:
+            return {
+                'in_flight': len(self._calls),
+                'waiting': sum(call.waiters for call in self._calls.values()),
+                'leaders': self.leaders,
+                'coalesced': self.coalesced,
+            }
+
+
+class AsyncSingleFlight:
+    """
+    Asyncio counterpart of SingleFlight
+    
+    The first caller for a key on an event loop starts the coroutine as a
+    task; callers that arrive while it runs await the same task. A caller
+    that is cancelled stops waiting without disturbing the others, and the
+    task itself is only cancelled when its last caller is.
+    """
+    
+    class _Call:
+        __slots__ = ('task', 'waiters')
+        
+        def __init__(self, task: 'asyncio.Task'):
+            self.task = task
+            self.waiters = 0
+    
+    def __init__(self):
+        self._calls: Dict[Tuple[asyncio.AbstractEventLoop, Hashable], 'AsyncSingleFlight._Call'] = {}
+        # Each event loop only touches its own keys, but loops may run in different threads
+        self._lock = threading.Lock()
+        self.leaders = 0
+        self.coalesced = 0
+    
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[Any]]) -> Any:
+        """Return await fn(), sharing one execution among concurrent callers for key"""
+        flight_key = (asyncio.get_running_loop(), key)
+        with self._lock:
+            call = self._calls.get(flight_key)
+            if call is not None:
+                self.coalesced += 1
+            else:
+                call = self._calls[flight_key] = self._Call(asyncio.ensure_future(fn()))
+                call.task.add_done_callback(lambda _: self._forget(flight_key, call))
+                self.leaders += 1
+            call.waiters += 1
+        
+        try:
+            return await asyncio.shield(call.task)
+        except asyncio.CancelledError:
+            with self._lock:
+                call.waiters -= 1
+                abandoned = call.waiters == 0
+            if abandoned:
+                call.task.cancel()
+            raise
+    
+    def _forget(self, flight_key: Tuple[asyncio.AbstractEventLoop, Hashable], call: '_Call') -> None:
+        with self._lock:
+            if self._calls.get(flight_key) is call:
+                del self._calls[flight_key]
+    
+    def stats(self) -> Dict[str, int]:
+        """Return in-flight keys, their callers beyond the leader, and lifetime leader/coalesced counts"""
+        with self._lock:
+            return {
+                'in_flight': len(self._calls),
+                'waiting': sum(max(0, call.waiters - 1) for call in self._calls.values()),
+                'leaders': self.leaders,
+                'coalesced': self.coalesced,
+            }
+
+
+def _json_size(value: Any) -> int:
+    return len(json.dumps(value))
+
+
+def default_response_cache() -> ResponseCache:
+    """
+    Build the response cache from environment settings
+    
+    CLARITY_CACHE_DIR (default "cache") holds the SQLite store; setting it to
+    an empty string disables the disk tier. CLARITY_CACHE_MAX_BYTES,
+    CLARITY_MEMORY_CACHE_MAX_BYTES and CLARITY_CACHE_TTL_SECONDS size the tiers.
+    """
+    ttl_seconds = float(os.getenv('CLARITY_CACHE_TTL_SECONDS', 7 * 24 * 3600))
+    memory = LRUCache(
+        int(os.getenv('CLARITY_MEMORY_CACHE_MAX_BYTES', 32 * 1024 * 1024)),
+        sizeof=_json_size,
+        ttl_seconds=ttl_seconds
+    )
+    
+    cache_dir = os.getenv('CLARITY_CACHE_DIR', 'cache')
+    disk = None
+    if cache_dir:
+        disk = DiskCache(
+            Path(cache_dir) / 'responses.sqlite3',
+            max_bytes=int(os.getenv('CLARITY_CACHE_MAX_BYTES', 256 * 1024 * 1024)),
+            ttl_seconds=ttl_seconds
+        )
+    return ResponseCache(memory, disk)
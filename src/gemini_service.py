@@ -1,50 +1,532 @@
-import google.generativeai as genai
-from typing import Dict, Any
+import asyncio
+import json
+import os
+import re
+import weakref
+from typing import TYPE_CHECKING, BinaryIO, Callable, Dict, Any, Iterator, List, Mapping, Optional, Sequence, Tuple, Union
 import logging
-from functools import lru_cache
+import threading
+import time
 import hashlib
-from PIL import Image
-import io
-from tenacity import retry, stop_after_attempt, wait_exponential
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass
+
+try:
+    from .cache import AsyncSingleFlight, ResponseCache, SingleFlight, default_response_cache
+    from .metrics import metrics
+    from .rate_limiter import RateLimiter, default_rate_limiter
+    from .image_processor import (
+        ANALYSIS_TILE_SIZE, MAX_TILES, TILE_OVERLAP, ImageTooLargeError, TiledImage, image_fingerprint,
+        image_tokens
+    )
+    from .perceptual_hash import NearDuplicateIndex
+    from .uploads import UploadRegistry
+except ImportError:
+    from cache import AsyncSingleFlight, ResponseCache, SingleFlight, default_response_cache
+    from metrics import metrics
+    from rate_limiter import RateLimiter, default_rate_limiter
+    from image_processor import (
+        ANALYSIS_TILE_SIZE, MAX_TILES, TILE_OVERLAP, ImageTooLargeError, TiledImage, image_fingerprint,
+        image_tokens
+    )
+    from perceptual_hash import NearDuplicateIndex
+    from uploads import UploadRegistry
+
+if TYPE_CHECKING:
+    from preprocess_pool import PreprocessExecutor
 
 logger = logging.getLogger(__name__)
 
+MODEL_NAME = 'gemini-1.5-flash'
+
+# Upper bound on parallel requests issued for one multi-prompt selection
+MAX_CONCURRENT_PROMPTS = 4
+
+# Single-image question whose cached answers feed grouped gallery comparisons
+GALLERY_DESCRIPTION_QUESTION = "Describe this image in detail"
+
+# Default upper bound on async requests in flight per event loop
+MAX_CONCURRENT_ASYNC_REQUESTS = 64
+
+# Output token estimate used to reserve TPM quota before a request is sent
+ESTIMATED_OUTPUT_TOKENS = 512
+
+CONFIDENCE_LEVELS = ('High', 'Medium', 'Low')
+
+# Errors with which the backend rejects an uploaded file handle that was
+# deleted or expired before its local expiry (PermissionDenied, NotFound)
+STALE_UPLOAD_CODES = {403, 404}
+
+# Numbered "N. Label:" headings of the plain-text answer format the prompts request
+SECTION_HEADING = re.compile(r"^[ \t]*\d+\.[ \t]*\**[ \t]*([A-Za-z][\w ]{0,38}?)[ \t]*\**[ \t]*:[ \t]*\**", re.MULTILINE)
+
+# JSON shape requested from non-streamed calls; parsed once and cached as-is
+RESPONSE_SCHEMA = {
+    'type': 'object',
+    'properties': {
+        'answer': {'type': 'string'},
+        'details': {'type': 'string'},
+        'confidence': {'type': 'string', 'enum': list(CONFIDENCE_LEVELS)},
+    },
+    'required': ['answer', 'confidence'],
+}
+
+
+@dataclass(frozen=True)
+class GenerationProfile:
+    """Output budget and sampling settings for one kind of analysis"""
+    name: str
+    max_output_tokens: int
+    temperature: float
+    
+    def generation_config(self, structured: bool) -> Dict[str, Any]:
+        """Build the generate_content config, with a JSON response schema if structured"""
+        config = {'max_output_tokens': self.max_output_tokens, 'temperature': self.temperature}
+        if structured:
+            config.update(response_mime_type='application/json', response_schema=RESPONSE_SCHEMA)
+        return config
+
+
+GENERATION_PROFILES = {
+    'general': GenerationProfile('general', max_output_tokens=512, temperature=0.4),
+    'technical': GenerationProfile('technical', max_output_tokens=768, temperature=0.2),
+    'artistic': GenerationProfile('artistic', max_output_tokens=768, temperature=0.8),
+    'objects': GenerationProfile('objects', max_output_tokens=384, temperature=0.1),
+}
+
+DEFAULT_GENERATION_PROFILE = GENERATION_PROFILES['general']
+
+# Analysis modes offered by the UI and the generation profile each one uses
+MODE_GENERATION_PROFILES = {
+    'General Analysis': 'general',
+    'Technical Details': 'technical',
+    'Artistic Analysis': 'artistic',
+    'Object Detection': 'objects',
+}
+
+
+def select_generation_profile(analysis_mode: Optional[str] = None) -> GenerationProfile:
+    """Return the output budget for an analysis mode, defaulting to 'general'"""
+    return GENERATION_PROFILES[MODE_GENERATION_PROFILES.get(analysis_mode, DEFAULT_GENERATION_PROFILE.name)]
+
+_shared_service: Optional['GeminiService'] = None
+_shared_service_lock = threading.Lock()
+
+
 class GeminiService:
-    def __init__(self, api_key: str):
+    def __init__(self, api_key: str, cache: Optional[ResponseCache] = None,
+                 max_async_requests: int = MAX_CONCURRENT_ASYNC_REQUESTS,
+                 limiter: Optional[RateLimiter] = None,
+                 near_duplicate_distance: Optional[int] = None,
+                 model: Optional[Any] = None,
+                 uploads: Optional[UploadRegistry] = None):
         self.api_key = api_key
-        genai.configure(api_key=api_key)
-        
-        # Use gemini-1.5-flash model
-        self.model = genai.GenerativeModel('gemini-1.5-flash')
+        self.max_async_requests = max_async_requests
+        # Memory LRU in front of the on-disk store shared by all workers on the host
+        self.cache = cache if cache is not None else default_response_cache()
+        # Quota, adaptive concurrency, retries and circuit breaking for every API call
+        self.limiter = limiter if limiter is not None else default_rate_limiter()
+        # Optional reuse of answers for re-saved or recompressed copies of an image
+        if near_duplicate_distance is None:
+            near_duplicate_distance = int(os.getenv('CLARITY_NEAR_DUPLICATE_DISTANCE', 0))
+        self.near_duplicates = NearDuplicateIndex(near_duplicate_distance) if near_duplicate_distance > 0 else None
+        # Optional upload-once sessions: images go through the File API once and
+        # follow-up questions reference the handle instead of resending the bytes
+        if uploads is None and os.getenv('CLARITY_UPLOAD_SESSIONS', '0') == '1':
+            uploads = UploadRegistry(max_entries=int(os.getenv('CLARITY_UPLOAD_MAX_ENTRIES', 256)))
+        if uploads is not None and uploads.limiter is None:
+            # File API calls share the quota, retries and breaker of generate calls
+            uploads.limiter = self.limiter
+        self.uploads = uploads
+        # Concurrent misses for the same cache key share one API call, on threads and event loops alike
+        self.in_flight = SingleFlight()
+        self.in_flight_async = AsyncSingleFlight()
+        # An injected model (e.g. the benchmarks' local stub backend) is used as-is
+        self._model = model
+        self._model_lock = threading.Lock()
+        self._client_configured = False
+        self._client_lock = threading.Lock()
+        # asyncio primitives bind to one event loop, so keep a semaphore per loop
+        self._async_semaphores: 'weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, asyncio.Semaphore]' = \
+            weakref.WeakKeyDictionary()
+        self._async_semaphores_lock = threading.Lock()
         logger.info("GeminiService initialized with Gemini 1.5 Flash")
     
-    @staticmethod
-    def _generate_cache_key(image: bytes, question: str) -> str:
-        """Generate a cache key from image and question"""
-        image_hash = hashlib.md5(image).hexdigest()
-        return f"{image_hash}:{question}"
+    @property
+    def model(self):
+        """Lazily create the Gemini 1.5 Flash model on first use"""
+        if self._model is None:
+            with self._model_lock:
+                if self._model is None:
+                    # The SDK pulls in gRPC and protobuf, so it is only imported
+                    # once a request is actually made
+                    import google.generativeai as genai
+                    
+                    self._configure_client()
+                    self._model = genai.GenerativeModel(MODEL_NAME)
+        return self._model
     
-    def _prepare_image(self, image_bytes: bytes):
-        """Convert bytes to PIL Image for Gemini"""
-        return Image.open(io.BytesIO(image_bytes))
+    def _configure_client(self) -> None:
+        """Point the process-wide SDK client at this service's key, once"""
+        if self._client_configured:
+            return
+        with self._client_lock:
+            if not self._client_configured:
+                import google.generativeai as genai
+                
+                # Its transport is reused by every call, including File API uploads
+                genai.configure(api_key=self.api_key)
+                self._client_configured = True
     
-    @lru_cache(maxsize=100)
-    def _cached_analyze(self, cache_key: str, image: bytes, question: str) -> Dict[str, Any]:
-        """Cached version of the API call"""
-        logger.info(f"Making API call for question: {question}")
-        
-        # Convert bytes to PIL Image for Gemini
-        pil_image = self._prepare_image(image)
+    @staticmethod
+    def _image_digest(image: bytes) -> str:
+        """Return the content digest of an encoded image"""
+        return hashlib.sha256(image).hexdigest()
+    
+    @staticmethod
+    def _generate_cache_key(image_digests: Sequence[str], prompt: str,
+                            profile: GenerationProfile = DEFAULT_GENERATION_PROFILE) -> str:
+        """
+        Generate a fixed-length cache key for a request
         
-        # Generate the response with Flash model
-        response = self.model.generate_content([pil_image, question])
-        response.resolve()  # Ensure the response is complete
+        Only digests are hashed into the key, so cache entries never reference
+        the image payload, the prompt text or the service instance. The
+        generation profile is part of the key, since it bounds the answer.
+        """
+        key = hashlib.sha256(MODEL_NAME.encode('utf-8'))
+        key.update(b'\0' + repr(profile).encode('utf-8'))
+        for digest in image_digests:
+            key.update(b'\0' + digest.encode('ascii'))
+        key.update(b'\0' + prompt.encode('utf-8'))
+        return key.hexdigest()
+    
+    @staticmethod
+    def _usage(response) -> Dict[str, int]:
+        """Extract billed token counts from a response's usage_metadata"""
+        usage = getattr(response, 'usage_metadata', None)
+        counts = {
+            'input_tokens': getattr(usage, 'prompt_token_count', None),
+            'output_tokens': getattr(usage, 'candidates_token_count', None),
+            'total_tokens': getattr(usage, 'total_token_count', None),
+        }
+        return {name: count for name, count in counts.items() if isinstance(count, int)}
+    
+    @staticmethod
+    def _record_usage(usage: Dict[str, int]) -> None:
+        """Add a fresh response's billed tokens to the process-wide counters"""
+        for name in ('input_tokens', 'output_tokens'):
+            if name in usage:
+                metrics.increment(name, usage[name])
+    
+    @staticmethod
+    def _parse_confidence(text: str) -> Optional[str]:
+        """Find a "Confidence: High/Medium/Low" line in free-form text"""
+        match = re.search(r"confidence\W*(high|medium|low)", text, re.IGNORECASE)
+        return match.group(1).capitalize() if match else None
+    
+    @classmethod
+    def _parse_answer(cls, text: str) -> Dict[str, Any]:
+        """
+        Parse response text into answer, details and confidence
         
+        Structured responses are JSON matching RESPONSE_SCHEMA. Streamed
+        answers follow the prompt's numbered sections, which are split into
+        the same fields, so a streamed and a structured answer cached under
+        one key have the same shape. Text without an answer section, such as
+        JSON cut short by the output budget, is kept whole as the answer with
+        the confidence read from the text.
+        """
+        try:
+            parsed = json.loads(text)
+        except ValueError:
+            parsed = None
+        if isinstance(parsed, dict) and isinstance(parsed.get('answer'), str):
+            confidence = parsed.get('confidence')
+            return {
+                'answer': parsed['answer'],
+                'details': parsed.get('details') or None,
+                'confidence': confidence if confidence in CONFIDENCE_LEVELS else None,
+            }
+        sections = cls._parse_sections(text)
+        answers = [body for label, body in sections if 'answer' in label.lower()]
+        if answers and answers[0]:
+            # Text before the first heading is kept with the details rather than dropped
+            preamble = text[:SECTION_HEADING.search(text).start()].strip()
+            details = [preamble] if preamble else []
+            details += [
+                body if label.lower() == 'details' else f"{label}: {body}"
+                for label, body in sections
+                if 'answer' not in label.lower() and label.lower() != 'confidence' and body
+            ]
+            return {
+                'answer': answers[0],
+                'details': '\n\n'.join(details) or None,
+                'confidence': cls._parse_confidence(text),
+            }
+        return {'answer': text, 'details': None, 'confidence': cls._parse_confidence(text)}
+    
+    @staticmethod
+    def _parse_sections(text: str) -> List[Tuple[str, str]]:
+        """Split text at its numbered "N. Label:" headings into (label, body) pairs"""
+        headings = list(SECTION_HEADING.finditer(text))
+        return [
+            (heading.group(1).strip(), text[heading.end():end].strip().strip('*').strip())
+            for heading, end in zip(headings, [h.start() for h in headings[1:]] + [len(text)])
+        ]
+    
+    @staticmethod
+    def render_text(result: Dict[str, Any]) -> str:
+        """Join a parsed result's answer and details into display text"""
+        if result.get('details'):
+            return f"{result['answer']}\n\n{result['details']}"
+        return result['answer']
+    
+    @classmethod
+    def _to_result(cls, response) -> Dict[str, Any]:
+        """Convert an SDK response into the parsed, JSON-serializable result schema"""
+        usage = cls._usage(response)
+        cls._record_usage(usage)
         return {
-            'answer': response.text,
-            'raw_response': response
+            **cls._parse_answer(response.text),
+            'model': MODEL_NAME,
+            'usage': usage
         }
     
+    @staticmethod
+    def _estimate_tokens(images: Sequence[bytes], prompt: str, output_tokens: int = ESTIMATED_OUTPUT_TOKENS) -> int:
+        """Rough token cost of a request, reserved against the TPM quota; images are billed per 768px tile"""
+        return sum(image_tokens(image) for image in images) + len(prompt) // 4 + output_tokens
+    
+    @staticmethod
+    def _total_tokens(response) -> Optional[int]:
+        """Return the token count reported in usage_metadata, if any"""
+        usage = getattr(response, 'usage_metadata', None)
+        total = getattr(usage, 'total_token_count', None)
+        return total if isinstance(total, int) else None
+    
+    def _generate(self, images: Sequence[bytes], contents: List[Any],
+                  profile: GenerationProfile = DEFAULT_GENERATION_PROFILE):
+        """Make one rate-limited, retried, structured generate_content call for contents built from images"""
+        estimate = self._estimate_tokens(images, contents[-1], profile.max_output_tokens)
+        config = profile.generation_config(structured=True)
+        
+        def call():
+            with metrics.span('network'):
+                response = self.model.generate_content(contents, generation_config=config)
+                response.resolve()  # Ensure the response is complete
+            return response
+        
+        response = self.limiter.call(call, tokens=estimate)
+        self.limiter.record_usage(estimate, self._total_tokens(response))
+        return response
+    
+    @staticmethod
+    def _image_mime_type(image_bytes: bytes) -> str:
+        """Identify the encoding of an image buffer from its magic bytes"""
+        if image_bytes[:4] == b'\x89PNG':
+            return 'image/png'
+        if image_bytes[:4] == b'RIFF' and image_bytes[8:12] == b'WEBP':
+            return 'image/webp'
+        return 'image/jpeg'
+    
+    def _prepare_image(self, image_bytes: bytes) -> Dict[str, Any]:
+        """
+        Wrap already-encoded image bytes as an inline blob for Gemini
+        
+        The bytes are forwarded as-is, so the image is never decoded or
+        re-encoded on the request path and the blob is exactly the buffer the
+        cache digest was computed over. With upload sessions enabled, the
+        image is uploaded on first use and referenced by its file handle
+        afterwards; if the upload fails the inline blob is sent instead.
+        """
+        mime_type = self._image_mime_type(image_bytes)
+        if self.uploads is not None:
+            try:
+                # Uploads go through the SDK client, which must carry our key first
+                self._configure_client()
+                return self.uploads.get_or_upload(self._image_digest(image_bytes), image_bytes, mime_type)
+            except Exception as e:
+                logger.warning(f"Image upload failed, sending inline: {str(e)}")
+        return {'mime_type': mime_type, 'data': image_bytes}
+    
+    def _forget_stale_uploads(self, exc: BaseException, images: Sequence[bytes]) -> bool:
+        """
+        Drop the upload handles of images if exc shows the backend rejected one
+        
+        Returns:
+            True if handles were dropped and the request is worth retrying once
+        """
+        if self.uploads is None or getattr(exc, 'code', None) not in STALE_UPLOAD_CODES:
+            return False
+        logger.warning(f"Backend rejected an uploaded file, uploading again: {str(exc)}")
+        metrics.increment('upload_invalidations')
+        for image in images:
+            self.uploads.invalidate(self._image_digest(image))
+        return True
+    
+    def _generate_for_images(self, images: Sequence[bytes], prompt: str,
+                             profile: GenerationProfile = DEFAULT_GENERATION_PROFILE):
+        """Make one structured call about images, re-uploading them once if a file handle went stale"""
+        try:
+            return self._generate(images, [self._prepare_image(image) for image in images] + [prompt], profile)
+        except Exception as e:
+            if not self._forget_stale_uploads(e, images):
+                raise
+            return self._generate(images, [self._prepare_image(image) for image in images] + [prompt], profile)
+    
+    @staticmethod
+    def _prompt_key(prompt: str, profile: GenerationProfile) -> str:
+        return hashlib.sha256(f"{profile!r}\0{prompt}".encode('utf-8')).hexdigest()
+    
+    def _cache_get(self, cache_key: str, images: Sequence[bytes], prompt: str,
+                   profile: GenerationProfile = DEFAULT_GENERATION_PROFILE) -> Optional[Dict[str, Any]]:
+        """Look up a cached answer, counting the outcome in the cache_hits/cache_misses metrics"""
+        with metrics.span('cache_lookup'):
+            cached = self._lookup(cache_key, images, prompt, profile)
+        metrics.increment('cache_hits' if cached is not None else 'cache_misses')
+        return cached
+    
+    def _lookup(self, cache_key: str, images: Sequence[bytes], prompt: str,
+                profile: GenerationProfile) -> Optional[Dict[str, Any]]:
+        """Look up an exact cache hit, then a near-duplicate image with the same prompt"""
+        cached = self.cache.get(cache_key)
+        if cached is not None or self.near_duplicates is None or len(images) != 1:
+            return cached
+        
+        prompt_key = self._prompt_key(prompt, profile)
+        for candidate in self.near_duplicates.candidates(prompt_key, image_fingerprint(images[0])):
+            cached = self.cache.get(candidate)
+            if cached is not None:
+                metrics.increment('near_duplicate_hits')
+                return cached
+        return None
+    
+    def _cache_put(self, cache_key: str, images: Sequence[bytes], prompt: str, result: Dict[str, Any],
+                   profile: GenerationProfile = DEFAULT_GENERATION_PROFILE) -> None:
+        """Store a result and index single-image answers by perceptual hash"""
+        self.cache.put(cache_key, result)
+        if self.near_duplicates is not None and len(images) == 1:
+            self.near_duplicates.add(self._prompt_key(prompt, profile), image_fingerprint(images[0]), cache_key)
+    
+    def _cached_analyze(self, cache_key: str, images: Sequence[bytes], prompt: str,
+                        profile: GenerationProfile = DEFAULT_GENERATION_PROFILE,
+                        load_images: Optional[Callable[[], Sequence[bytes]]] = None) -> Dict[str, Any]:
+        """
+        Cached version of the API call
+        
+        Concurrent misses for the same key are coalesced: one caller makes
+        the request and the others wait for its result. If load_images is
+        given, it produces the images to send and is only called on a miss
+        (e.g. to crop a tile lazily); images then only feed the near-duplicate
+        index.
+        """
+        cached = self._cache_get(cache_key, images, prompt, profile)
+        if cached is not None:
+            logger.debug(f"Cache hit for question: {prompt}")
+            return cached
+        
+        def fetch():
+            # A call that finished between our miss and taking the lead already cached it
+            if cache_key in self.cache.memory:
+                cached = self.cache.get(cache_key)
+                if cached is not None:
+                    return cached
+            
+            logger.info(f"Making API call for question: {prompt}")
+            
+            # Generate the response with Flash model
+            payload = load_images() if load_images is not None else images
+            response = self._generate_for_images(payload, prompt, profile)
+            
+            result = self._to_result(response)
+            self._cache_put(cache_key, images, prompt, result, profile)
+            return result
+        
+        return self.in_flight.do(cache_key, fetch)
+    
+    def _async_semaphore(self) -> asyncio.Semaphore:
+        """Return the in-flight request semaphore of the running event loop"""
+        loop = asyncio.get_running_loop()
+        with self._async_semaphores_lock:
+            semaphore = self._async_semaphores.get(loop)
+            if semaphore is None:
+                semaphore = asyncio.Semaphore(self.max_async_requests)
+                self._async_semaphores[loop] = semaphore
+            return semaphore
+    
+    async def _cached_analyze_async(self, cache_key: str, images: Sequence[bytes], prompt: str,
+                                    profile: GenerationProfile = DEFAULT_GENERATION_PROFILE) -> Dict[str, Any]:
+        """
+        Async counterpart of _cached_analyze sharing the same response cache
+        
+        Concurrent misses for the same key on one event loop are coalesced
+        into a single request, as the sync path does across threads.
+        """
+        cached = await asyncio.to_thread(self._cache_get, cache_key, images, prompt, profile)
+        if cached is not None:
+            logger.debug(f"Cache hit for question: {prompt}")
+            return cached
+        return await self.in_flight_async.do(cache_key, lambda: self._fetch_async(cache_key, images, prompt, profile))
+    
+    async def _fetch_async(self, cache_key: str, images: Sequence[bytes], prompt: str,
+                           profile: GenerationProfile) -> Dict[str, Any]:
+        """Make the async API call for a cache miss and cache its result"""
+        # A call that finished between our miss and taking the lead already cached it
+        if cache_key in self.cache.memory:
+            cached = self.cache.get(cache_key)
+            if cached is not None:
+                return cached
+        
+        estimate = self._estimate_tokens(images, prompt, profile.max_output_tokens)
+        config = profile.generation_config(structured=True)
+        
+        async def generate():
+            if self.uploads is not None:
+                # A first-time upload blocks, so keep it off the event loop
+                parts = await asyncio.to_thread(lambda: [self._prepare_image(image) for image in images])
+            else:
+                parts = [self._prepare_image(image) for image in images]
+            contents = parts + [prompt]
+            
+            async def call():
+                with metrics.span('network'):
+                    return await self.model.generate_content_async(contents, generation_config=config)
+            
+            async with self._async_semaphore():
+                # Backoff waits never block the loop; cancellation propagates immediately
+                logger.info(f"Making async API call for question: {prompt}")
+                return await self.limiter.call_async(call, tokens=estimate)
+        
+        try:
+            response = await generate()
+        except Exception as e:
+            if not self._forget_stale_uploads(e, images):
+                raise
+            response = await generate()
+        self.limiter.record_usage(estimate, self._total_tokens(response))
+        
+        result = self._to_result(response)
+        await asyncio.to_thread(self._cache_put, cache_key, images, prompt, result, profile)
+        return result
+    
+    def cache_stats(self) -> Dict[str, Dict[str, int]]:
+        """Return hits, misses, evictions and resident bytes per cache tier"""
+        return self.cache.stats()
+    
+    def in_flight_stats(self) -> Dict[str, int]:
+        """Return in-flight requests, waiting callers and lifetime coalesced callers of both sync and async calls"""
+        sync, async_ = self.in_flight.stats(), self.in_flight_async.stats()
+        return {name: value + async_[name] for name, value in sync.items()}
+    
+    def upload_stats(self) -> Dict[str, int]:
+        """Return upload, reuse and eviction counts of the upload-session registry"""
+        return self.uploads.stats() if self.uploads is not None else {}
+    
+    @staticmethod
+    def _normalize_question(question: str) -> str:
+        """Collapse whitespace so equivalent questions share a cache entry"""
+        return ' '.join(question.split())
+    
     def _build_prompt(self, question: str) -> str:
         """Build a structured prompt for better responses"""
         return f"""
@@ -57,30 +539,130 @@ class GeminiService:
         3. Confidence: [High/Medium/Low based on clarity of visual elements]
         """
     
-    @retry(stop=stop_after_attempt(3), wait=wait_exponential(multiplier=1, min=4, max=10))
-    def analyze_image(self, image: bytes, question: str) -> Dict[str, Any]:
+    def _build_comparison_prompt(self, question: str) -> str:
+        """Build a structured prompt for comparing two images"""
+        return f"""
+        Please compare these two images and answer the following question:
+        {question}
+        
+        Provide your response in this format:
+        1. Image 1: [Description of first image]
+        2. Image 2: [Description of second image]
+        3. Comparison: [Key differences and similarities]
+        4. Answer: [Direct answer to the question]
+        5. Confidence: [High/Medium/Low based on clarity of visual elements]
+        """
+    
+    def _stream_and_cache(self, cache_key: str, images: Sequence[bytes], prompt: str,
+                          result: Optional[Dict[str, Any]] = None,
+                          profile: GenerationProfile = DEFAULT_GENERATION_PROFILE) -> Iterator[str]:
+        """
+        Stream a generation, yielding text chunks and caching the full result
+        
+        The stream is plain text, so it can be shown as it arrives, but it
+        keeps the profile's output budget. Time-to-first-token is recorded as
+        the ``ttft_seconds`` metric. Nothing is cached if the stream fails or
+        the consumer stops early. If result is given, it is filled with the
+        final result (plus ``cached`` and ``ttft_seconds``) once the stream is
+        exhausted.
+        """
+        result = result if result is not None else {}
+        cached = self._cache_get(cache_key, images, prompt, profile)
+        if cached is None:
+            try:
+                # A non-streaming call for the same key (e.g. a speculative one) is already paying for the answer
+                cached = self.in_flight.join(cache_key)
+            except Exception:
+                cached = None
+        if cached is not None:
+            result.update(cached, cached=True, ttft_seconds=0.0)
+            yield self.render_text(cached)
+            return
+        
+        start = time.perf_counter()
+        
+        config = profile.generation_config(structured=False)
+        
+        estimate = self._estimate_tokens(images, prompt, profile.max_output_tokens)
+        
+        def generate():
+            # Uploads take their own limiter slot, so they happen before this call is admitted
+            contents = [self._prepare_image(image) for image in images] + [prompt]
+            
+            def call():
+                with metrics.span('network'):
+                    return self.model.generate_content(contents, stream=True, generation_config=config)
+            
+            # The limiter admits and retries the request until its first chunk arrives
+            return self.limiter.call(call, tokens=estimate)
+        
+        try:
+            response = generate()
+        except Exception as e:
+            # A stale file handle is uploaded again once
+            if not self._forget_stale_uploads(e, images):
+                raise
+            response = generate()
+        
+        chunks = []
+        usage = {}
+        total_tokens = None
+        ttft = None
+        for chunk in response:
+            text = chunk.text
+            if not chunks:
+                ttft = time.perf_counter() - start
+                metrics.observe('ttft_seconds', ttft)
+            chunks.append(text)
+            # Token counts arrive with the final chunk
+            usage = self._usage(chunk) or usage
+            total_tokens = self._total_tokens(chunk) or total_tokens
+            yield text
+        
+        metrics.observe('generation_seconds', time.perf_counter() - start)
+        self.limiter.record_usage(estimate, total_tokens)
+        self._record_usage(usage)
+        final = {
+            **self._parse_answer(''.join(chunks)),
+            'model': MODEL_NAME,
+            'usage': usage
+        }
+        self._cache_put(cache_key, images, prompt, final, profile)
+        result.update(final, cached=False, ttft_seconds=ttft)
+    
+    def analyze_image(self, image: bytes, question: str,
+                      profile: GenerationProfile = DEFAULT_GENERATION_PROFILE) -> Dict[str, Any]:
         """
         Analyze an image using Gemini Flash API
         
         Args:
             image: Preprocessed image bytes
             question: User's question about the image
+            profile: Output budget and sampling settings for the answer
             
         Returns:
             Dict containing the analysis response
         """
         try:
-            formatted_question = self._build_prompt(question)
-            cache_key = self._generate_cache_key(image, formatted_question)
+            formatted_question = self._build_prompt(self._normalize_question(question))
+            cache_key = self._generate_cache_key([self._image_digest(image)], formatted_question, profile)
             logger.debug(f"Generated cache key: {cache_key}")
             
-            return self._cached_analyze(cache_key, image, formatted_question)
+            return self._cached_analyze(cache_key, [image], formatted_question, profile)
             
         except Exception as e:
             logger.error(f"Error analyzing image: {str(e)}")
             raise Exception(f"Gemini API error: {str(e)}")
     
-    def analyze_images_comparison(self, image1: bytes, image2: bytes, question: str) -> Dict[str, Any]:
+    def has_cached_answer(self, image: bytes, question: str,
+                          profile: GenerationProfile = DEFAULT_GENERATION_PROFILE) -> bool:
+        """Whether analyze_image would answer this from the cache, without counting a hit or miss"""
+        formatted_question = self._build_prompt(self._normalize_question(question))
+        cache_key = self._generate_cache_key([self._image_digest(image)], formatted_question, profile)
+        return self._lookup(cache_key, [image], formatted_question, profile) is not None
+    
+    def analyze_images_comparison(self, image1: bytes, image2: bytes, question: str,
+                                  profile: GenerationProfile = DEFAULT_GENERATION_PROFILE) -> Dict[str, Any]:
         """
         Compare two images using Gemini API
         
@@ -88,33 +670,479 @@ class GeminiService:
             image1: First image bytes
             image2: Second image bytes
             question: User's question about the images
+            profile: Output budget and sampling settings for the answer
         """
         try:
-            # Prepare both images
-            pil_image1 = self._prepare_image(image1)
-            pil_image2 = self._prepare_image(image2)
-            
-            # Build comparison prompt
-            comparison_prompt = f"""
-            Please compare these two images and answer the following question:
-            {question}
-            
-            Provide your response in this format:
-            1. Image 1: [Description of first image]
-            2. Image 2: [Description of second image]
-            3. Comparison: [Key differences and similarities]
-            4. Answer: [Direct answer to the question]
-            """
-            
-            # Generate response with both images
-            response = self.model.generate_content([pil_image1, pil_image2, comparison_prompt])
-            response.resolve()
+            comparison_prompt = self._build_comparison_prompt(self._normalize_question(question))
+            cache_key = self._generate_cache_key(
+                [self._image_digest(image1), self._image_digest(image2)],
+                comparison_prompt,
+                profile
+            )
+            return self._cached_analyze(cache_key, [image1, image2], comparison_prompt, profile)
             
-            return {
-                'answer': response.text,
-                'raw_response': response
-            }
+        except Exception as e:
+            logger.error(f"Error comparing images: {str(e)}")
+            raise Exception(f"Gemini API error: {str(e)}")
+
+    
+    def analyze_image_stream(self, image: bytes, question: str,
+                             result: Optional[Dict[str, Any]] = None,
+                             profile: GenerationProfile = DEFAULT_GENERATION_PROFILE) -> Iterator[str]:
+        """
+        Analyze an image, yielding the answer text as it is generated
+        
+        Args:
+            image: Preprocessed image bytes
+            question: User's question about the image
+            result: Optional dict filled with the final result, usage and TTFT
+            profile: Output budget and sampling settings for the answer
+            
+        Yields:
+            Answer text chunks; a cached answer is yielded as a single chunk
+        """
+        try:
+            formatted_question = self._build_prompt(self._normalize_question(question))
+            cache_key = self._generate_cache_key([self._image_digest(image)], formatted_question, profile)
+            
+            yield from self._stream_and_cache(cache_key, [image], formatted_question, result, profile)
+            
+        except Exception as e:
+            logger.error(f"Error streaming image analysis: {str(e)}")
+            raise Exception(f"Gemini API error: {str(e)}")
+    
+    def analyze_images_comparison_stream(self, image1: bytes, image2: bytes, question: str,
+                                         result: Optional[Dict[str, Any]] = None,
+                                         profile: GenerationProfile = DEFAULT_GENERATION_PROFILE) -> Iterator[str]:
+        """
+        Compare two images, yielding the answer text as it is generated
+        
+        Args:
+            image1: First image bytes
+            image2: Second image bytes
+            question: User's question about the images
+            result: Optional dict filled with the final result, usage and TTFT
+            profile: Output budget and sampling settings for the answer
+            
+        Yields:
+            Answer text chunks; a cached answer is yielded as a single chunk
+        """
+        try:
+            comparison_prompt = self._build_comparison_prompt(self._normalize_question(question))
+            cache_key = self._generate_cache_key(
+                [self._image_digest(image1), self._image_digest(image2)],
+                comparison_prompt,
+                profile
+            )
+            
+            yield from self._stream_and_cache(cache_key, [image1, image2], comparison_prompt, result, profile)
+            
+        except Exception as e:
+            logger.error(f"Error streaming image comparison: {str(e)}")
+            raise Exception(f"Gemini API error: {str(e)}")
+    
+    async def analyze_image_async(self, image: bytes, question: str,
+                                  profile: GenerationProfile = DEFAULT_GENERATION_PROFILE) -> Dict[str, Any]:
+        """
+        Analyze an image without blocking the event loop
+        
+        Args:
+            image: Preprocessed image bytes
+            question: User's question about the image
+            profile: Output budget and sampling settings for the answer
+            
+        Returns:
+            Dict containing the analysis response
+        """
+        try:
+            formatted_question = self._build_prompt(self._normalize_question(question))
+            cache_key = self._generate_cache_key([self._image_digest(image)], formatted_question, profile)
+            
+            return await self._cached_analyze_async(cache_key, [image], formatted_question, profile)
+            
+        except Exception as e:
+            logger.error(f"Error analyzing image: {str(e)}")
+            raise Exception(f"Gemini API error: {str(e)}")
+    
+    async def analyze_images_comparison_async(self, image1: bytes, image2: bytes, question: str,
+                                              profile: GenerationProfile = DEFAULT_GENERATION_PROFILE
+                                              ) -> Dict[str, Any]:
+        """
+        Compare two images without blocking the event loop
+        
+        Args:
+            image1: First image bytes
+            image2: Second image bytes
+            question: User's question about the images
+            profile: Output budget and sampling settings for the answer
+        """
+        try:
+            comparison_prompt = self._build_comparison_prompt(self._normalize_question(question))
+            cache_key = self._generate_cache_key(
+                [self._image_digest(image1), self._image_digest(image2)],
+                comparison_prompt,
+                profile
+            )
+            
+            return await self._cached_analyze_async(cache_key, [image1, image2], comparison_prompt, profile)
             
         except Exception as e:
             logger.error(f"Error comparing images: {str(e)}")
-            raise Exception(f"Gemini API error: {str(e)}")
\ No newline at end of file
+            raise Exception(f"Gemini API error: {str(e)}")
+    
+    def _build_frames_prompt(self, question: str, timestamps: Optional[Sequence[Optional[float]]],
+                             count: int) -> str:
+        """Build a prompt for keyframes of one clip or burst, in order"""
+        if timestamps and all(timestamp is not None for timestamp in timestamps):
+            order = ", ".join(f"frame {n} at {t:.1f}s" for n, t in enumerate(timestamps, start=1))
+            source = f"keyframes of one video clip, in order ({order})"
+        else:
+            source = "shots from one camera burst, in the order they were taken"
+        return f"""
+        These {count} images are {source}.
+        Please analyze them as one sequence and answer the following question:
+        {question}
+        
+        Provide your response in this format:
+        1. Direct Answer: [Concise answer to the question]
+        2. Details: [What happens across the frames, referring to frames by number]
+        3. Confidence: [High/Medium/Low based on clarity of visual elements]
+        """
+    
+    def analyze_frames(self, frames: Sequence[bytes], question: str,
+                       timestamps: Optional[Sequence[Optional[float]]] = None,
+                       profile: GenerationProfile = DEFAULT_GENERATION_PROFILE) -> Dict[str, Any]:
+        """
+        Analyze the keyframes of a clip or burst in one multi-image request
+        
+        Args:
+            frames: Preprocessed keyframe images, in order
+            question: User's question about the sequence
+            timestamps: Seconds into the clip of each frame; None for bursts
+            profile: Output budget and sampling settings for the answer
+            
+        Returns:
+            Dict containing the analysis response
+        """
+        if not frames:
+            raise ValueError("A sequence analysis needs at least one frame")
+        try:
+            prompt = self._build_frames_prompt(self._normalize_question(question), timestamps, len(frames))
+            cache_key = self._generate_cache_key([self._image_digest(frame) for frame in frames], prompt, profile)
+            return self._cached_analyze(cache_key, list(frames), prompt, profile)
+            
+        except Exception as e:
+            logger.error(f"Error analyzing frames: {str(e)}")
+            raise Exception(f"Gemini API error: {str(e)}")
+    
+    def _fan_out(self, analyze: Callable[[str], Dict[str, Any]], questions: Sequence[str],
+                 max_workers: int) -> Iterator[Tuple[str, Dict[str, Any]]]:
+        """Run analyze once per distinct question in parallel, yielding results as they complete"""
+        unique_questions = list(dict.fromkeys(self._normalize_question(q) for q in questions if q.strip()))
+        if not unique_questions:
+            return
+        
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(unique_questions))) as executor:
+            futures = {executor.submit(analyze, question): question for question in unique_questions}
+            for future in as_completed(futures):
+                yield futures[future], future.result()
+    
+    def analyze_prompts(self, image: Union[bytes, Mapping[str, bytes]], questions: Sequence[str],
+                        max_workers: int = MAX_CONCURRENT_PROMPTS,
+                        profile: GenerationProfile = DEFAULT_GENERATION_PROFILE
+                        ) -> Iterator[Tuple[str, Dict[str, Any]]]:
+        """
+        Ask each question about an image as its own request, in parallel
+        
+        Every question is cached separately, so changing the selection only
+        pays for the questions that were not asked before. Passing one image
+        per question, each preprocessed with the payload profile the question
+        would get on its own, lets these requests share cache entries with
+        single-question requests.
+        
+        Args:
+            image: Preprocessed image bytes, or a mapping from each question
+                to the image preprocessed for it
+            questions: Questions to ask; duplicates are asked once
+            max_workers: Maximum number of requests in flight
+            profile: Output budget and sampling settings for the answer
+            
+        Yields:
+            (question, response) pairs in completion order
+        """
+        if isinstance(image, Mapping):
+            images = {self._normalize_question(question): data for question, data in image.items()}
+            return self._fan_out(
+                lambda question: self.analyze_image(images[question], question, profile), questions, max_workers
+            )
+        return self._fan_out(lambda question: self.analyze_image(image, question, profile), questions, max_workers)
+    
+    def compare_prompts(self, image1: bytes, image2: bytes, questions: Sequence[str],
+                        max_workers: int = MAX_CONCURRENT_PROMPTS,
+                        profile: GenerationProfile = DEFAULT_GENERATION_PROFILE
+                        ) -> Iterator[Tuple[str, Dict[str, Any]]]:
+        """
+        Ask each comparison question as its own request, in parallel
+        
+        Args:
+            image1: First image bytes
+            image2: Second image bytes
+            questions: Questions to ask; duplicates are asked once
+            max_workers: Maximum number of requests in flight
+            profile: Output budget and sampling settings for the answer
+            
+        Yields:
+            (question, response) pairs in completion order
+        """
+        return self._fan_out(
+            lambda question: self.analyze_images_comparison(image1, image2, question, profile),
+            questions,
+            max_workers
+        )
+    
+    def _build_gallery_prompt(self, question: str, descriptions: Sequence[str]) -> str:
+        """Build a text-only prompt comparing images through their descriptions"""
+        described = "\n".join(
+            f"Image {number}: {description}" for number, description in enumerate(descriptions, start=1)
+        )
+        return f"""
+        Below are descriptions of {len(descriptions)} images:
+        {described}
+        
+        Using these descriptions, compare the images and answer the following question:
+        {question}
+        
+        Provide your response in this format:
+        1. Comparison: [Key differences and similarities across the images]
+        2. Answer: [Direct answer to the question, referring to images by number]
+        3. Confidence: [High/Medium/Low based on how well the descriptions support the answer]
+        """
+    
+    def analyze_gallery(self, images: Sequence[bytes], question: str, mode: str = 'grouped',
+                        max_workers: int = MAX_CONCURRENT_PROMPTS,
+                        profile: GenerationProfile = DEFAULT_GENERATION_PROFILE) -> Dict[str, Any]:
+        """
+        Compare N images
+        
+        Repeated images are collapsed by digest first. In ``grouped`` mode each
+        distinct image is described once (a cached single-image analysis that
+        any later gallery reuses) and one text-only request compares the
+        descriptions. In ``pairwise`` mode every distinct pair is compared
+        with both images, concurrently; pair results are cached in order, so
+        (A, B) and (B, A) are separate entries.
+        
+        Args:
+            images: Preprocessed image bytes, in display order
+            question: User's question about the images
+            mode: 'grouped' or 'pairwise'
+            max_workers: Maximum number of requests in flight
+            profile: Output budget for the comparisons; descriptions always
+                use the default profile so every gallery can reuse them
+            
+        Returns:
+            Dict with the answer plus per-image descriptions or per-pair results,
+            using 1-based positions of the first occurrence of each image
+        """
+        if mode not in ('grouped', 'pairwise'):
+            raise ValueError(f"Unknown gallery mode: {mode}")
+        
+        # Map each distinct digest to the first position it appears at
+        positions: Dict[str, int] = {}
+        for position, image in enumerate(images, start=1):
+            positions.setdefault(self._image_digest(image), position)
+        unique = [(position, images[position - 1]) for position in positions.values()]
+        if len(unique) < 2:
+            raise ValueError("A gallery comparison needs at least two distinct images")
+        
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            if mode == 'pairwise':
+                pairs = [(a, b) for i, a in enumerate(unique) for b in unique[i + 1:]]
+                futures = [
+                    executor.submit(self.analyze_images_comparison, a[1], b[1], question, profile)
+                    for a, b in pairs
+                ]
+                results = [
+                    {'images': [a[0], b[0]], 'answer': future.result()['answer']}
+                    for (a, b), future in zip(pairs, futures)
+                ]
+                return {
+                    'answer': "\n\n".join(
+                        f"Images {r['images'][0]} & {r['images'][1]}: {r['answer']}" for r in results
+                    ),
+                    'model': MODEL_NAME,
+                    'pairs': results
+                }
+            
+            futures = [
+                executor.submit(self.analyze_image, image, GALLERY_DESCRIPTION_QUESTION)
+                for _, image in unique
+            ]
+            descriptions = [self.render_text(future.result()) for future in futures]
+        
+        try:
+            prompt = self._build_gallery_prompt(self._normalize_question(question), descriptions)
+            cache_key = self._generate_cache_key([self._image_digest(image) for _, image in unique], prompt, profile)
+            result = self._cached_analyze(cache_key, [], prompt, profile)
+        except Exception as e:
+            logger.error(f"Error comparing gallery: {str(e)}")
+            raise Exception(f"Gemini API error: {str(e)}")
+        
+        return dict(result, descriptions=[
+            {'image': position, 'description': description}
+            for (position, _), description in zip(unique, descriptions)
+        ])
+
+    
+    def _build_tile_prompt(self, question: str, box: Tuple[int, int, int, int], size: Tuple[int, int]) -> str:
+        """Build a prompt for one tile that says where the tile sits in the full image"""
+        left, upper, right, lower = box
+        return f"""
+        This image is one tile of a larger {size[0]}x{size[1]} image, covering pixels
+        {left}-{right} horizontally and {upper}-{lower} vertically. Neighbouring tiles overlap slightly.
+        Please analyze this tile and answer the following question:
+        {question}
+        
+        If nothing in this tile is relevant to the question, say so briefly.
+        
+        Provide your response in this format:
+        1. Direct Answer: [Concise answer to the question for this tile]
+        2. Details: [Additional relevant details]
+        3. Confidence: [High/Medium/Low based on clarity of visual elements]
+        """
+    
+    def _build_tile_merge_prompt(self, question: str, size: Tuple[int, int],
+                                 boxes: Sequence[Tuple[int, int, int, int]], answers: Sequence[str]) -> str:
+        """Build a text-only prompt combining the answers for every tile of one image"""
+        described = "\n".join(
+            f"Tile {number} (pixels {left}-{right} x {upper}-{lower}): {answer}"
+            for number, ((left, upper, right, lower), answer) in enumerate(zip(boxes, answers), start=1)
+        )
+        return f"""
+        A {size[0]}x{size[1]} image was analyzed as {len(boxes)} overlapping tiles, in reading order:
+        {described}
+        
+        Combine these tile answers into one answer to the following question about the whole image:
+        {question}
+        
+        Tiles overlap, so the same object or text may be reported by neighbouring tiles; count it once.
+        
+        Provide your response in this format:
+        1. Direct Answer: [Concise answer to the question]
+        2. Details: [Additional relevant details, with where in the image they appear]
+        3. Confidence: [High/Medium/Low based on how well the tile answers support the answer]
+        """
+    
+    def analyze_image_tiled(self, image: Union[bytes, BinaryIO], question: str,
+                            profile: GenerationProfile = DEFAULT_GENERATION_PROFILE,
+                            max_workers: int = MAX_CONCURRENT_PROMPTS, tile_size: int = ANALYSIS_TILE_SIZE,
+                            overlap: int = TILE_OVERLAP, max_tiles: int = MAX_TILES,
+                            executor: Optional['PreprocessExecutor'] = None) -> Dict[str, Any]:
+        """
+        Analyze a large image as overlapping native-resolution tiles
+        
+        Each tile is asked the question in its own request, concurrently,
+        and one text-only request merges the tile answers. Tile answers are
+        cached by source digest and tile coordinates, so a tile is only
+        cropped and encoded on a miss and asking again reuses every tile.
+        With an executor the tiles are cut in a worker process, under its
+        memory limit, rather than on the calling thread.
+        
+        Args:
+            image: Original (not preprocessed) upload as bytes, a path or a file-like object
+            question: User's question about the image
+            profile: Output budget and sampling settings for the answers
+            max_workers: Maximum number of tile requests in flight
+            tile_size: Largest tile side sent to the model
+            overlap: Minimum overlap between neighbouring tiles in pixels
+            max_tiles: Upper bound on the number of tiles
+            executor: Worker pool that decodes the image and cuts the tiles
+            
+        Returns:
+            Dict containing the merged analysis plus the per-tile answers and boxes
+            
+        Raises:
+            ImageTooLargeError: If the image exceeds the pixel or worker memory limits
+        """
+        # Oversized images are rejected from the header, before anything is decoded
+        tiled = TiledImage(image, tile_size, overlap, max_tiles, executor=executor)
+        try:
+            question = self._normalize_question(question)
+            
+            def analyze_tile(box):
+                prompt = self._build_tile_prompt(question, box, tiled.size)
+                cache_key = self._generate_cache_key([tiled.tile_id(box)], prompt, profile)
+                return self._cached_analyze(cache_key, [], prompt, profile, load_images=lambda: [tiled.tile(box)])
+            
+            try:
+                with ThreadPoolExecutor(max_workers=min(max_workers, len(tiled.boxes))) as tile_pool:
+                    results = list(tile_pool.map(analyze_tile, tiled.boxes))
+            finally:
+                tiled.release()
+            tiles = [
+                {'tile': number, 'box': list(box), 'answer': self.render_text(result),
+                 'confidence': result.get('confidence')}
+                for number, (box, result) in enumerate(zip(tiled.boxes, results), start=1)
+            ]
+            if len(results) == 1:
+                return dict(results[0], tiles=tiles)
+            
+            prompt = self._build_tile_merge_prompt(
+                question, tiled.size, tiled.boxes, [tile['answer'] for tile in tiles]
+            )
+            cache_key = self._generate_cache_key([tiled.digest], prompt, profile)
+            result = self._cached_analyze(cache_key, [], prompt, profile)
+            
+        except ImageTooLargeError:
+            raise
+        except Exception as e:
+            logger.error(f"Error analyzing image tiles: {str(e)}")
+            raise Exception(f"Gemini API error: {str(e)}")
+        
+        return dict(result, tiles=tiles)
+
+
+def get_gemini_service(api_key: str) -> GeminiService:
+    """
+    Return the process-wide GeminiService, creating it on first use
+    
+    Streamlit re-executes the script on every interaction, but imported modules
+    persist, so the service (and its response cache) is shared by all reruns
+    and sessions in this process.
+    
+    Args:
+        api_key: Google API key; a different key replaces the shared service
+        
+    Returns:
+        The shared GeminiService instance
+    """
+    global _shared_service
+    service = _shared_service
+    if service is not None and service.api_key == api_key:
+        return service
+    
+    with _shared_service_lock:
+        if _shared_service is None or _shared_service.api_key != api_key:
+            _shared_service = GeminiService(api_key)
+            metrics.register_collector('response_cache', _shared_cache_gauges)
+            metrics.register_collector('uploads', _shared_upload_gauges)
+        return _shared_service
+
+
+def _shared_cache_gauges() -> Dict[str, int]:
+    """Flatten the shared service's per-tier cache stats into metric gauges"""
+    service = _shared_service
+    if service is None:
+        return {}
+    gauges = {
+        f"{tier}_{name}": value
+        for tier, stats in service.cache_stats().items()
+        for name, value in stats.items()
+    }
+    gauges.update({f"in_flight_{name}": value for name, value in service.in_flight_stats().items()})
+    return gauges
+
+
+def _shared_upload_gauges() -> Dict[str, int]:
+    """Upload-session counters of the shared service; empty while sessions are off"""
+    service = _shared_service
+    return service.upload_stats() if service is not None else {}
@@ -1,33 +1,496 @@
-import cv2
-import numpy as np
-from PIL import Image
+from PIL import Image, ImageOps
 import io
+import hashlib
+import math
+import re
+import threading
+from dataclasses import dataclass
+from pathlib import Path
+from typing import TYPE_CHECKING, BinaryIO, Dict, List, Optional, Tuple, Union
 
-def preprocess_image(uploaded_file: bytes) -> bytes:
+try:
+    from .cache import LRUCache
+    from .metrics import metrics
+    from .perceptual_hash import phash
+except ImportError:
+    from cache import LRUCache
+    from metrics import metrics
+    from perceptual_hash import phash
+
+if TYPE_CHECKING:
+    from .preprocess_pool import PreprocessExecutor
+
+MAX_SIZE = 1600
+JPEG_QUALITY = 85
+
+# JPEGs within MAX_SIZE and this many bytes are sent without re-encoding
+MAX_PASSTHROUGH_BYTES = 1024 * 1024
+EXIF_ORIENTATION_TAG = 0x0112
+
+# JPEG segments dropped from passed-through files: APP1 (EXIF, XMP), APP13
+# (IPTC) and comments, which can carry GPS positions and camera serials
+JPEG_METADATA_MARKERS = {0xE1, 0xED, 0xFE}
+
+# Larger images are rejected before decoding (decompression bombs, huge PNGs)
+MAX_IMAGE_PIXELS = 64_000_000
+
+class ImageTooLargeError(ValueError):
+    """Raised when an image exceeds the pixel or memory limits for preprocessing"""
+
+# Gemini bills an image by 768x768 tiles (258 tokens each); images no larger
+# than 384x384 cost a single tile's worth
+TILE_SIZE = 768
+SMALL_IMAGE_SIZE = 384
+TOKENS_PER_TILE = 258
+MIN_QUALITY = 40
+
+# Tiling mode cuts native-resolution crops of 2x2 billing tiles; neighbours
+# overlap so anything cut by one seam appears whole in the next tile
+ANALYSIS_TILE_SIZE = 2 * TILE_SIZE
+TILE_OVERLAP = 128
+MAX_TILES = 16
+TILE_QUALITY = 90
+
+@dataclass(frozen=True)
+class PayloadProfile:
+    """How large, in which format and at what quality an image is uploaded"""
+    name: str
+    max_size: int
+    quality: int
+    format: str = 'JPEG'
+    max_bytes: int = MAX_PASSTHROUGH_BYTES
+
+DEFAULT_PROFILE = PayloadProfile('default', MAX_SIZE, JPEG_QUALITY)
+
+# Target sizes are snapped to tile boundaries so no tile is paid for half-empty
+PAYLOAD_PROFILES = {
+    'compact': PayloadProfile('compact', TILE_SIZE, 80, 'WEBP', 256 * 1024),
+    'standard': PayloadProfile('standard', 2 * TILE_SIZE, JPEG_QUALITY, 'JPEG', 768 * 1024),
+    'detail': PayloadProfile('detail', 3 * TILE_SIZE, 90, 'JPEG', 2 * 1024 * 1024),
+}
+
+MODE_PROFILES = {
+    'General Analysis': 'standard',
+    'Technical Details': 'detail',
+    'Artistic Analysis': 'standard',
+    'Object Detection': 'detail',
+}
+
+# Questions that need fine detail, or that only need the gist of the scene
+DETAIL_KEYWORDS = ('text', 'read', 'ocr', 'number', 'label', 'sign', 'count', 'small')
+# Inflections under which a detail keyword still counts ("reading", "labels")
+DETAIL_SUFFIXES = ('', 's', 'es', 'ed', 'ing')
+GIST_KEYWORDS = ('describe the scene', 'analyze colors', 'detect emotions', 'mood', 'overall')
+
+def _is_detail_word(word: str) -> bool:
+    return any(word.startswith(keyword) and word[len(keyword):] in DETAIL_SUFFIXES for keyword in DETAIL_KEYWORDS)
+
+def select_profile(analysis_mode: Optional[str] = None, question: str = '') -> PayloadProfile:
+    """
+    Choose the payload profile for an analysis mode and question
+    
+    Args:
+        analysis_mode: Sidebar analysis mode, if any
+        question: User question (or joined quick prompts)
+        
+    Returns:
+        The matching PayloadProfile
+    """
+    question = question.lower()
+    # Whole words only, so "bread", "country" or "design" stay at the standard size
+    if any(_is_detail_word(word) for word in re.findall(r"[a-z]+", question)):
+        return PAYLOAD_PROFILES['detail']
+    
+    name = MODE_PROFILES.get(analysis_mode, 'standard')
+    if name == 'standard' and question and all(
+            any(keyword in part for keyword in GIST_KEYWORDS) for part in question.split(' & ')):
+        name = 'compact'
+    return PAYLOAD_PROFILES[name]
+
+def estimate_image_tokens(width: int, height: int) -> int:
+    """Estimate the input tokens Gemini bills for an image of this size"""
+    if width <= SMALL_IMAGE_SIZE and height <= SMALL_IMAGE_SIZE:
+        return TOKENS_PER_TILE
+    return math.ceil(width / TILE_SIZE) * math.ceil(height / TILE_SIZE) * TOKENS_PER_TILE
+
+def image_tokens(image_bytes: bytes) -> int:
+    """Estimate the input tokens of an encoded image from its header alone"""
+    try:
+        width, height = Image.open(io.BytesIO(image_bytes)).size
+    except (OSError, ValueError, Image.DecompressionBombError):
+        return TOKENS_PER_TILE
+    return estimate_image_tokens(width, height)
+
+# Preprocessed JPEGs are ~0.3-1 MB, so this keeps the last few hundred uploads
+PREPROCESS_CACHE_BYTES = 128 * 1024 * 1024
+
+_preprocess_cache = LRUCache(PREPROCESS_CACHE_BYTES)
+
+# Encoded tiles are ~0.3-0.8 MB, so this keeps the tiles of the last few large uploads
+TILE_CACHE_BYTES = 64 * 1024 * 1024
+
+_tile_cache = LRUCache(TILE_CACHE_BYTES)
+
+# Perceptual hashes of preprocessed payloads, keyed by payload digest
+FINGERPRINT_CACHE_ENTRIES = 100000
+_fingerprints = LRUCache(FINGERPRINT_CACHE_ENTRIES, sizeof=lambda value: 1)
+
+def open_image(raw: bytes, max_pixels: int = MAX_IMAGE_PIXELS) -> Image.Image:
+    """
+    Open an encoded image, reading only its header
+    
+    Raises:
+        ImageTooLargeError: If the image has more than max_pixels pixels
+    """
+    try:
+        image = Image.open(io.BytesIO(raw))
+    except Image.DecompressionBombError as e:
+        raise ImageTooLargeError(str(e)) from e
+    width, height = image.size
+    if width * height > max_pixels:
+        raise ImageTooLargeError(
+            f"Image is {width}x{height} ({width * height / 1e6:.0f} MP); "
+            f"the limit is {max_pixels / 1e6:.0f} MP"
+        )
+    return image
+
+def preprocess_image(uploaded_file: Union[bytes, str, Path, BinaryIO],
+                     profile: PayloadProfile = DEFAULT_PROFILE, max_pixels: int = MAX_IMAGE_PIXELS) -> bytes:
     """
     Preprocess the uploaded image for Gemini API
     
+    JPEGs are decoded at a reduced DCT scale close to the target size and
+    large images are shrunk with an integer reduce() before the final LANCZOS
+    pass, so most of the full-resolution decode work is skipped. A JPEG that
+    already meets the size limits is sent without re-encoding, with only its
+    metadata segments removed.
+    
     Args:
-        uploaded_file: Raw uploaded file bytes
+        uploaded_file: Raw upload as bytes, a path or a file-like object
+        profile: Target size, format, quality and byte budget
+        max_pixels: Images with more pixels are rejected before decoding
         
     Returns:
         Preprocessed image bytes
+    
+    Raises:
+        ImageTooLargeError: If the image has more than max_pixels pixels
     """
-    # Convert uploaded file to PIL Image
-    image = Image.open(uploaded_file)
+    raw = _read_upload(uploaded_file)
+    image = open_image(raw, max_pixels)
+    max_size = profile.max_size
+    orientation = image.getexif().get(EXIF_ORIENTATION_TAG, 1)
+    
+    if (image.format == profile.format and image.mode == 'RGB' and orientation == 1
+            and max(image.size) <= max_size and len(raw) <= profile.max_bytes):
+        if image.format == 'JPEG':
+            stripped = _strip_jpeg_metadata(raw)
+            if stripped is not None:
+                return stripped
+        elif not ('exif' in image.info or 'xmp' in image.info):
+            return raw
     
-    # Convert to RGB if needed
-    if image.mode != 'RGB':
-        image = image.convert('RGB')
+    with metrics.span('preprocess_decode'):
+        # Let the JPEG decoder scale by 1/2, 1/4 or 1/8 while staying above the target
+        if max(image.size) > max_size:
+            ratio = max_size / max(image.size)
+            image.draft('RGB', tuple(int(dim * ratio) for dim in image.size))
+        
+        # Apply EXIF orientation while loading so the model sees the image upright
+        image = ImageOps.exif_transpose(image)
+        
+        # Convert to RGB if needed
+        if image.mode != 'RGB':
+            image = image.convert('RGB')
+        image.load()
     
-    # Use fixed values for size and quality
-    max_size = 1600
     if max(image.size) > max_size:
-        ratio = max_size / max(image.size)
-        new_size = tuple([int(dim * ratio) for dim in image.size])
-        image = image.resize(new_size, Image.Resampling.LANCZOS)
-    
-    # Convert back to bytes with fixed quality
-    img_byte_arr = io.BytesIO()
-    image.save(img_byte_arr, format='JPEG', quality=85)
-    return img_byte_arr.getvalue() 
\ No newline at end of file
+        with metrics.span('preprocess_resize'):
+            # Cheap box reduction down to no less than twice the target...
+            factor = max(image.size) // (max_size * 2)
+            if factor > 1:
+                image = image.reduce(factor)
+            # ...then the high-quality resample
+            ratio = max_size / max(image.size)
+            new_size = tuple([int(dim * ratio) for dim in image.size])
+            image = image.resize(new_size, Image.Resampling.LANCZOS)
+    
+    with metrics.span('preprocess_encode'):
+        processed = _encode_within_budget(image, profile)
+    return processed
+
+def _strip_jpeg_metadata(raw: bytes) -> Optional[bytes]:
+    """
+    Drop the JPEG_METADATA_MARKERS segments from a JPEG without re-encoding it
+    
+    Returns:
+        The JPEG without those segments, or None if its header cannot be parsed
+    """
+    if raw[:2] != b'\xff\xd8':
+        return None
+    kept = [raw[:2]]
+    pos = 2
+    while pos + 4 <= len(raw):
+        if raw[pos] != 0xFF:
+            return None
+        marker = raw[pos + 1]
+        if marker == 0xFF:
+            # Fill byte before a marker
+            pos += 1
+            continue
+        if marker in (0xDA, 0xD9):
+            # Start of scan: the rest is entropy-coded image data
+            kept.append(raw[pos:])
+            return b''.join(kept)
+        length = int.from_bytes(raw[pos + 2:pos + 4], 'big')
+        if length < 2:
+            return None
+        if marker not in JPEG_METADATA_MARKERS:
+            kept.append(raw[pos:pos + 2 + length])
+        pos += 2 + length
+    return None
+
+def _encode_within_budget(image: Image.Image, profile: PayloadProfile) -> bytes:
+    """Encode at the profile quality, stepping quality then size down to fit max_bytes"""
+    quality = profile.quality
+    while True:
+        img_byte_arr = io.BytesIO()
+        image.save(img_byte_arr, format=profile.format, quality=quality)
+        if img_byte_arr.tell() <= profile.max_bytes:
+            return img_byte_arr.getvalue()
+        
+        if quality > MIN_QUALITY:
+            quality = max(MIN_QUALITY, quality - 10)
+        elif max(image.size) > SMALL_IMAGE_SIZE:
+            new_size = tuple([max(1, int(dim * 0.75)) for dim in image.size])
+            image = image.resize(new_size, Image.Resampling.LANCZOS)
+        else:
+            return img_byte_arr.getvalue()
+
+def _read_upload(uploaded_file: Union[bytes, str, Path, BinaryIO]) -> bytes:
+    """Return the raw bytes of an upload without disturbing its read position"""
+    if isinstance(uploaded_file, (bytes, bytearray, memoryview)):
+        return bytes(uploaded_file)
+    if isinstance(uploaded_file, (str, Path)):
+        return Path(uploaded_file).read_bytes()
+    if hasattr(uploaded_file, 'getvalue'):
+        return uploaded_file.getvalue()
+    
+    position = uploaded_file.tell()
+    uploaded_file.seek(0)
+    data = uploaded_file.read()
+    uploaded_file.seek(position)
+    return data
+
+def preprocess_image_cached(uploaded_file: Union[bytes, BinaryIO],
+                            profile: PayloadProfile = DEFAULT_PROFILE,
+                            executor: Optional['PreprocessExecutor'] = None) -> bytes:
+    """
+    Preprocess an upload, reusing the result for identical content
+    
+    Results are keyed by the SHA-256 of the raw upload plus the preprocessing
+    parameters, so the same image is decoded and encoded once per process no
+    matter how many reruns or sessions ask for it.
+    
+    Args:
+        uploaded_file: Raw upload as bytes or a file-like object
+        profile: Target size, format, quality and byte budget
+        executor: Process pool to run a cache miss in; in this thread if None
+    
+    Returns:
+        Preprocessed image bytes
+    
+    Raises:
+        ImageTooLargeError: If the image exceeds the pixel or worker memory limits
+    """
+    raw = _read_upload(uploaded_file)
+    key = (hashlib.sha256(raw).hexdigest(), profile)
+    
+    processed = _preprocess_cache.get(key)
+    if processed is None:
+        processed = executor.preprocess(raw, profile) if executor is not None else preprocess_image(raw, profile)
+        _preprocess_cache.put(key, processed)
+    return processed
+
+def preprocess_cache_stats() -> Dict[str, int]:
+    """Return hit/miss counters and residency of the preprocessing cache"""
+    return _preprocess_cache.stats()
+
+metrics.register_collector('preprocess_cache', preprocess_cache_stats)
+
+def tile_cache_stats() -> Dict[str, int]:
+    """Return hit/miss counters and residency of the encoded tile cache"""
+    return _tile_cache.stats()
+
+metrics.register_collector('tile_cache', tile_cache_stats)
+
+def image_fingerprint(image_bytes: bytes) -> int:
+    """
+    Return the perceptual hash of an encoded image
+    
+    Only near-duplicate matching needs fingerprints, so they are computed
+    on first use, from a reduced-scale decode, and memoized by content.
+    
+    Args:
+        image_bytes: Encoded image bytes
+        
+    Returns:
+        64-bit pHash as an integer
+    """
+    digest = hashlib.sha256(image_bytes).hexdigest()
+    fingerprint = _fingerprints.get(digest)
+    if fingerprint is None:
+        image = Image.open(io.BytesIO(image_bytes))
+        image.draft('L', (64, 64))
+        fingerprint = phash(image)
+        _fingerprints.put(digest, fingerprint)
+    return fingerprint
+
+def _tile_count(length: int, tile_size: int, overlap: int) -> int:
+    if length <= tile_size:
+        return 1
+    return math.ceil((length - overlap) / (tile_size - overlap))
+
+def _tile_starts(length: int, tile_size: int, count: int) -> List[int]:
+    # Evenly spaced, so the last tile ends exactly at the edge
+    if count == 1:
+        return [0]
+    step = (length - tile_size) / (count - 1)
+    return [round(i * step) for i in range(count)]
+
+def tile_boxes(width: int, height: int, tile_size: int = ANALYSIS_TILE_SIZE,
+               overlap: int = TILE_OVERLAP, max_tiles: int = MAX_TILES) -> List[Tuple[int, int, int, int]]:
+    """
+    Plan overlapping tiles covering a width x height image
+    
+    Neighbouring tiles overlap by at least ``overlap`` pixels. When the grid
+    would need more than max_tiles tiles, the tiles grow until it fits (and
+    are downscaled to tile_size when encoded).
+    
+    Args:
+        width: Image width in pixels
+        height: Image height in pixels
+        tile_size: Largest tile side sent to the model
+        overlap: Minimum overlap between neighbouring tiles
+        max_tiles: Upper bound on the number of tiles
+        
+    Returns:
+        (left, upper, right, lower) boxes in reading order
+    """
+    size = tile_size
+    while _tile_count(width, size, overlap) * _tile_count(height, size, overlap) > max_tiles:
+        size += tile_size // 4
+    
+    columns = _tile_starts(width, min(size, width), _tile_count(width, size, overlap))
+    rows = _tile_starts(height, min(size, height), _tile_count(height, size, overlap))
+    return [
+        (left, upper, min(left + size, width), min(upper + size, height))
+        for upper in rows for left in columns
+    ]
+
+def decode_upright(raw: bytes, max_pixels: int = MAX_IMAGE_PIXELS) -> Image.Image:
+    """Decode an image at full resolution, upright and in RGB, after the pixel-limit check"""
+    with metrics.span('preprocess_decode'):
+        image = ImageOps.exif_transpose(open_image(raw, max_pixels))
+        if image.mode != 'RGB':
+            image = image.convert('RGB')
+        image.load()
+    return image
+
+def encode_tile(image: Image.Image, box: Tuple[int, int, int, int], tile_size: int = ANALYSIS_TILE_SIZE,
+                quality: int = TILE_QUALITY) -> bytes:
+    """Crop one tile from a decoded image and encode it as JPEG no larger than tile_size"""
+    with metrics.span('tile_encode'):
+        tile = image.crop(box)
+        if max(tile.size) > tile_size:
+            tile.thumbnail((tile_size, tile_size), Image.Resampling.LANCZOS)
+        img_byte_arr = io.BytesIO()
+        tile.save(img_byte_arr, format='JPEG', quality=quality)
+    return img_byte_arr.getvalue()
+
+class TiledImage:
+    """
+    A source image cut into overlapping tiles at native resolution
+    
+    Only the header is read up front to plan the tiles, and images over
+    max_pixels are rejected there. With an executor, all tiles are cut in
+    a worker process on the first tile() call, under the worker's memory
+    limit; otherwise the pixels are decoded once in this process and every
+    tile is a crop of that single bitmap. Encoded tiles are memoized by
+    tile_id, so a rerun asking a new question of the same upload does not
+    decode it again, and tiles whose answers are cached are never decoded at
+    all.
+    """
+    
+    def __init__(self, uploaded_file: Union[bytes, str, Path, BinaryIO], tile_size: int = ANALYSIS_TILE_SIZE,
+                 overlap: int = TILE_OVERLAP, max_tiles: int = MAX_TILES, quality: int = TILE_QUALITY,
+                 max_pixels: int = MAX_IMAGE_PIXELS, executor: Optional['PreprocessExecutor'] = None):
+        """
+        Raises:
+            ImageTooLargeError: If the image has more than max_pixels pixels
+        """
+        self._raw = _read_upload(uploaded_file)
+        self.digest = hashlib.sha256(self._raw).hexdigest()
+        self.tile_size = tile_size
+        self.quality = quality
+        self.max_pixels = max_pixels
+        self.executor = executor
+        
+        image = open_image(self._raw, max_pixels)
+        width, height = image.size
+        # Orientations 5-8 rotate by 90 degrees, so the upright image is transposed
+        if image.getexif().get(EXIF_ORIENTATION_TAG, 1) in (5, 6, 7, 8):
+            width, height = height, width
+        self.size = (width, height)
+        self.boxes = tile_boxes(width, height, tile_size, overlap, max_tiles)
+        self._image: Optional[Image.Image] = None
+        self._tiles: Optional[Dict[Tuple[int, int, int, int], bytes]] = None
+        self._lock = threading.Lock()
+    
+    def _decoded(self) -> Image.Image:
+        with self._lock:
+            if self._image is None:
+                self._image = decode_upright(self._raw, self.max_pixels)
+            return self._image
+    
+    def _worker_tiles(self) -> Dict[Tuple[int, int, int, int], bytes]:
+        with self._lock:
+            if self._tiles is None:
+                encoded = self.executor.tiles(self._raw, self.boxes, self.tile_size, self.quality)
+                self._tiles = dict(zip(self.boxes, encoded))
+                for box, tile in self._tiles.items():
+                    _tile_cache.put((self.tile_id(box), self.quality), tile)
+            return self._tiles
+    
+    def tile_id(self, box: Tuple[int, int, int, int]) -> str:
+        """Identify a tile by source digest, box and encoded size, e.g. for cache keys"""
+        return f"{self.digest}:{','.join(map(str, box))}:{self.tile_size}"
+    
+    def tile(self, box: Tuple[int, int, int, int]) -> bytes:
+        """
+        Crop and encode one tile
+        
+        Args:
+            box: (left, upper, right, lower) box from self.boxes
+            
+        Returns:
+            JPEG bytes of the tile, no larger than tile_size on either side
+        
+        Raises:
+            ImageTooLargeError: If decoding would exceed the worker memory limit
+        """
+        key = (self.tile_id(box), self.quality)
+        tile = _tile_cache.get(key)
+        if tile is not None:
+            return tile
+        if self.executor is not None:
+            return self._worker_tiles()[box]
+        tile = encode_tile(self._decoded(), box, self.tile_size, self.quality)
+        _tile_cache.put(key, tile)
+        return tile
+    
+    def release(self) -> None:
+        """Drop the decoded bitmap and encoded tiles; a later tile() call decodes again"""
+        with self._lock:
+            self._image = None
+            self._tiles = None
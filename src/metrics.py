@@ -0,0 +1,203 @@
+import json
+import logging
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import TYPE_CHECKING, Any, Callable, Deque, Dict, Iterator, List, Optional
+
+if TYPE_CHECKING:
+    from http.server import ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+# Histogram bucket upper bounds in seconds, for the Prometheus exposition
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# Recent observations kept per metric for percentile estimates
+RESERVOIR_SIZE = 1024
+
+Sink = Callable[[Dict[str, Any]], None]
+
+
+def _percentile(values: List[float], fraction: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+class Metrics:
+    """Thread-safe process-wide counters, timing observations and spans
+    
+    Every observation is also passed to the registered sinks as an event
+    dict, and registered collectors contribute gauges (e.g. cache residency)
+    whenever a snapshot or Prometheus exposition is produced.
+    """
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters: Dict[str, float] = {}
+        self._observations: Dict[str, Dict[str, Any]] = {}
+        self._recent: Dict[str, Deque[float]] = {}
+        self._sinks: List[Sink] = []
+        self._collectors: Dict[str, Callable[[], Dict[str, float]]] = {}
+    
+    def add_sink(self, sink: Sink) -> None:
+        """Send every counter increment and observation to sink"""
+        with self._lock:
+            self._sinks.append(sink)
+    
+    def remove_sink(self, sink: Sink) -> None:
+        with self._lock:
+            self._sinks.remove(sink)
+    
+    def register_collector(self, name: str, collector: Callable[[], Dict[str, float]]) -> None:
+        """Register a callable returning gauge values, read at snapshot time"""
+        with self._lock:
+            self._collectors[name] = collector
+    
+    def _emit(self, event: Dict[str, Any]) -> None:
+        for sink in list(self._sinks):
+            try:
+                sink(event)
+            except Exception as e:
+                logger.warning(f"Metrics sink failed: {str(e)}")
+    
+    def increment(self, name: str, amount: float = 1) -> None:
+        """Add amount to the named counter"""
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + amount
+        self._emit({'type': 'counter', 'name': name, 'value': amount})
+    
+    def observe(self, name: str, value: float) -> None:
+        """Record one observation (e.g. a latency in seconds) for name"""
+        with self._lock:
+            summary = self._observations.get(name)
+            if summary is None:
+                summary = self._observations[name] = {
+                    'count': 0, 'sum': 0.0, 'min': value, 'max': value, 'last': value,
+                    'buckets': [0] * len(LATENCY_BUCKETS)
+                }
+                self._recent[name] = deque(maxlen=RESERVOIR_SIZE)
+            summary['count'] += 1
+            summary['sum'] += value
+            summary['min'] = min(summary['min'], value)
+            summary['max'] = max(summary['max'], value)
+            summary['last'] = value
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if value <= bound:
+                    summary['buckets'][i] += 1
+            self._recent[name].append(value)
+        self._emit({'type': 'observation', 'name': name, 'value': value})
+    
+    @contextmanager
+    def span(self, name: str) -> Iterator[None]:
+        """Time the enclosed block and record it as ``<name>_seconds``"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(f"{name}_seconds", time.perf_counter() - start)
+    
+    def snapshot(self) -> Dict[str, Dict]:
+        """Return counters, observation summaries with p50/p95/p99, and gauges"""
+        with self._lock:
+            observations = {}
+            for name, summary in self._observations.items():
+                recent = list(self._recent[name])
+                observations[name] = dict(
+                    summary,
+                    buckets=list(summary['buckets']),
+                    p50=_percentile(recent, 0.50),
+                    p95=_percentile(recent, 0.95),
+                    p99=_percentile(recent, 0.99)
+                )
+            counters = dict(self._counters)
+            collectors = dict(self._collectors)
+        
+        gauges = {}
+        for prefix, collector in collectors.items():
+            try:
+                for name, value in collector().items():
+                    gauges[f"{prefix}_{name}"] = value
+            except Exception as e:
+                logger.warning(f"Metrics collector {prefix} failed: {str(e)}")
+        return {'counters': counters, 'observations': observations, 'gauges': gauges}
+    
+    def prometheus_text(self, prefix: str = 'clarity') -> str:
+        """Render the current snapshot in the Prometheus text exposition format"""
+        snapshot = self.snapshot()
+        lines = []
+        for name, value in sorted(snapshot['counters'].items()):
+            lines += [f"# TYPE {prefix}_{name}_total counter", f"{prefix}_{name}_total {value}"]
+        for name, value in sorted(snapshot['gauges'].items()):
+            lines += [f"# TYPE {prefix}_{name} gauge", f"{prefix}_{name} {value}"]
+        for name, summary in sorted(snapshot['observations'].items()):
+            metric = f"{prefix}_{name}"
+            lines.append(f"# TYPE {metric} histogram")
+            for bound, count in zip(LATENCY_BUCKETS, summary['buckets']):
+                lines.append(f'{metric}_bucket{{le="{bound}"}} {count}')
+            lines += [
+                f'{metric}_bucket{{le="+Inf"}} {summary["count"]}',
+                f"{metric}_sum {summary['sum']}",
+                f"{metric}_count {summary['count']}",
+            ]
+        return "\n".join(lines) + "\n"
+    
+    def reset(self) -> None:
+        """Clear all recorded values"""
+        with self._lock:
+            self._counters.clear()
+            self._observations.clear()
+            self._recent.clear()
+
+
+class JsonLogSink:
+    """Metrics sink writing one structured JSON log line per event"""
+    
+    def __init__(self, log: Optional[logging.Logger] = None, level: int = logging.INFO):
+        self.log = log if log is not None else logging.getLogger('clarity.metrics')
+        self.level = level
+    
+    def __call__(self, event: Dict[str, Any]) -> None:
+        self.log.log(self.level, json.dumps(dict(event, ts=time.time())))
+
+
+def start_metrics_server(port: int, registry: Optional['Metrics'] = None,
+                         host: str = '0.0.0.0') -> 'ThreadingHTTPServer':
+    """
+    Serve ``/metrics`` in the Prometheus text format from a daemon thread
+    
+    Args:
+        port: Port to listen on (0 picks a free port)
+        registry: Metrics to expose; defaults to the process-wide registry
+        host: Interface to bind
+    
+    Returns:
+        The running server; call shutdown() to stop it
+    """
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    
+    registry = registry if registry is not None else metrics
+    
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+            body = registry.prometheus_text().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        
+        def log_message(self, format, *args):
+            pass
+    
+    server = ThreadingHTTPServer((host, port), Handler)
+    threading.Thread(target=server.serve_forever, name='metrics-server', daemon=True).start()
+    logger.info(f"Serving Prometheus metrics on port {server.server_address[1]}")
+    return server
+
+
+metrics = Metrics()
@@ -0,0 +1,147 @@
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+from typing import TYPE_CHECKING, Dict, Hashable, List, Optional, Tuple
+
+from PIL import Image
+
+if TYPE_CHECKING:
+    import numpy as np
+
+HASH_SIZE = 8
+PHASH_HIGHFREQ_FACTOR = 4
+
+
+def hamming_distance(a: int, b: int) -> int:
+    """Number of differing bits between two hashes"""
+    return bin(a ^ b).count('1')
+
+
+def _bits_to_int(bits: 'np.ndarray') -> int:
+    import numpy as np
+    return int.from_bytes(np.packbits(bits.astype(np.uint8).ravel()).tobytes(), 'big')
+
+
+@lru_cache(maxsize=4)
+def _dct_matrix(size: int) -> 'np.ndarray':
+    """Orthonormal DCT-II basis, so a 2-D DCT is two matrix products"""
+    import numpy as np
+    n = np.arange(size)
+    matrix = np.cos(np.pi * (2 * n[None, :] + 1) * n[:, None] / (2 * size)) * np.sqrt(2 / size)
+    matrix[0] /= np.sqrt(2)
+    return matrix
+
+
+def _grayscale(image: Image.Image, size: Tuple[int, int]) -> 'np.ndarray':
+    # NumPy is only needed once images are hashed, so it stays off the import path
+    import numpy as np
+    return np.asarray(image.convert('L').resize(size, Image.Resampling.BILINEAR), dtype=np.float32)
+
+
+def dhash(image: Image.Image, hash_size: int = HASH_SIZE) -> int:
+    """Difference hash: sign of horizontal gradients on a (hash_size+1) x hash_size thumbnail"""
+    pixels = _grayscale(image, (hash_size + 1, hash_size))
+    return _bits_to_int(pixels[:, 1:] > pixels[:, :-1])
+
+
+def phash(image: Image.Image, hash_size: int = HASH_SIZE) -> int:
+    """Perceptual hash: low-frequency DCT coefficients compared with their median"""
+    import numpy as np
+    size = hash_size * PHASH_HIGHFREQ_FACTOR
+    dct = _dct_matrix(size)
+    coefficients = dct @ _grayscale(image, (size, size)) @ dct.T
+    low = coefficients[:hash_size, :hash_size]
+    # The DC term only encodes overall brightness, so it is left out of the median
+    return _bits_to_int(low > np.median(low.ravel()[1:]))
+
+
+class BKTree:
+    """Burkhard-Keller tree over integer hashes under the Hamming metric"""
+
+    def __init__(self):
+        self._root: Optional[list] = None
+        self._size = 0
+
+    def add(self, hash_value: int, item: Hashable) -> None:
+        """Insert item under hash_value"""
+        self._size += 1
+        if self._root is None:
+            self._root = [hash_value, item, {}]
+            return
+
+        node = self._root
+        while True:
+            distance = hamming_distance(hash_value, node[0])
+            child = node[2].get(distance)
+            if child is None:
+                node[2][distance] = [hash_value, item, {}]
+                return
+            node = child
+
+    def search(self, hash_value: int, max_distance: int) -> List[Tuple[int, Hashable]]:
+        """Return (distance, item) pairs within max_distance, nearest first"""
+        matches = []
+        stack = [self._root] if self._root is not None else []
+        while stack:
+            node = stack.pop()
+            distance = hamming_distance(hash_value, node[0])
+            if distance <= max_distance:
+                matches.append((distance, node[1]))
+            # Triangle inequality: only subtrees in this band can hold matches
+            for edge, child in node[2].items():
+                if distance - max_distance <= edge <= distance + max_distance:
+                    stack.append(child)
+        return sorted(matches, key=lambda match: match[0])
+
+    def __len__(self) -> int:
+        return self._size
+
+
+class NearDuplicateIndex:
+    """
+    Bounded index of cache keys by image hash, grouped by prompt
+
+    A BK-tree per prompt answers "which cached answers for this question were
+    given for an image within max_distance bits of this one". Trees cannot
+    delete cheaply, so once max_entries is exceeded the oldest half is dropped
+    and the trees are rebuilt.
+    """
+
+    def __init__(self, max_distance: int, max_entries: int = 50000):
+        self.max_distance = max_distance
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[Tuple[str, str], int]" = OrderedDict()
+        self._trees: Dict[str, BKTree] = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def add(self, prompt_key: str, hash_value: int, cache_key: str) -> None:
+        """Record that cache_key holds the answer to prompt_key for an image with hash_value"""
+        with self._lock:
+            if (prompt_key, cache_key) in self._entries:
+                return
+            self._entries[(prompt_key, cache_key)] = hash_value
+            self._trees.setdefault(prompt_key, BKTree()).add(hash_value, cache_key)
+
+            if len(self._entries) > self.max_entries:
+                for _ in range(len(self._entries) - self.max_entries // 2):
+                    self._entries.popitem(last=False)
+                self._trees = {}
+                for (prompt, key), value in self._entries.items():
+                    self._trees.setdefault(prompt, BKTree()).add(value, key)
+
+    def candidates(self, prompt_key: str, hash_value: int) -> List[str]:
+        """Return cache keys of near-identical images for prompt_key, nearest first"""
+        with self._lock:
+            tree = self._trees.get(prompt_key)
+            matches = tree.search(hash_value, self.max_distance) if tree is not None else []
+            if matches:
+                self.hits += 1
+            else:
+                self.misses += 1
+            return [key for _, key in matches]
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'entries': len(self._entries)}
@@ -0,0 +1,354 @@
+import errno
+import logging
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing.shared_memory import SharedMemory
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+try:
+    from .image_processor import (
+        DEFAULT_PROFILE, MAX_IMAGE_PIXELS, TILE_QUALITY, ImageTooLargeError, PayloadProfile,
+        decode_upright, encode_tile, open_image, preprocess_image
+    )
+    from .metrics import metrics
+except ImportError:
+    from image_processor import (
+        DEFAULT_PROFILE, MAX_IMAGE_PIXELS, TILE_QUALITY, ImageTooLargeError, PayloadProfile,
+        decode_upright, encode_tile, open_image, preprocess_image
+    )
+    from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# Resident memory a worker may reach while decoding one image
+WORKER_MAX_RSS_BYTES = 1024 * 1024 * 1024
+
+# PIL keeps RGB pixels in 4 bytes, and an EXIF rotation or mode conversion
+# briefly holds a second full-size copy
+DECODE_BYTES_PER_PIXEL = 8
+
+JobResult = Tuple[str, List[int], List[Tuple[str, float]], float, float]
+
+Box = Tuple[int, int, int, int]
+
+
+def _memory_pages(field: int) -> Optional[int]:
+    """Read one field of /proc/self/statm in bytes; None where it is unavailable"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[field]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError, AttributeError):
+        return None
+
+
+def _init_worker(max_rss_bytes: int) -> None:
+    """
+    Cap the worker's address space as a backstop to the per-job admission check
+    
+    The limit sits max_rss_bytes above what the worker has mapped once its
+    imports are done, so an allocation the estimate missed fails with a
+    MemoryError, reported as a rejection, instead of the kernel OOM-killing
+    the process.
+    """
+    # NumPy (loaded later by the pHash) maps its thread stacks on import, so load it before the baseline
+    import numpy
+    
+    try:
+        import resource
+    except ImportError:
+        return
+    baseline = _memory_pages(0)
+    if baseline is None:
+        return
+    try:
+        _, hard = resource.getrlimit(resource.RLIMIT_AS)
+        limit = baseline + max_rss_bytes
+        if hard != resource.RLIM_INFINITY:
+            limit = min(limit, hard)
+        resource.setrlimit(resource.RLIMIT_AS, (limit, hard))
+    except (ValueError, OSError) as e:
+        logger.warning(f"Could not limit preprocessing worker memory: {str(e)}")
+
+
+def _check_memory(raw: bytes, max_pixels: int, max_rss_bytes: int, max_size: Optional[int] = None) -> None:
+    """
+    Reject an image whose decode would take the worker past max_rss_bytes
+    
+    With max_size the estimate is made at the scale the JPEG decoder
+    downscales to for that target, as preprocess_image lets it; without it
+    the image is decoded at full resolution.
+    """
+    image = open_image(raw, max_pixels)
+    if max_size is not None and max(image.size) > max_size:
+        ratio = max_size / max(image.size)
+        image.draft('RGB', tuple(int(dim * ratio) for dim in image.size))
+    width, height = image.size
+    needed = width * height * DECODE_BYTES_PER_PIXEL
+    resident = _memory_pages(1) or 0
+    if resident + needed > max_rss_bytes:
+        raise ImageTooLargeError(
+            f"Image needs about {needed / 2**20:.0f} MB to decode; the worker memory limit is "
+            f"{max_rss_bytes / 2**20:.0f} MB ({resident / 2**20:.0f} MB in use)"
+        )
+
+
+def _preprocess_job(raw: bytes, max_pixels: int, max_rss_bytes: int, profile: PayloadProfile) -> List[bytes]:
+    _check_memory(raw, max_pixels, max_rss_bytes, profile.max_size)
+    return [preprocess_image(raw, profile, max_pixels)]
+
+
+def _tiles_job(raw: bytes, max_pixels: int, max_rss_bytes: int, boxes: Sequence[Box],
+               tile_size: int, quality: int) -> List[bytes]:
+    _check_memory(raw, max_pixels, max_rss_bytes)
+    image = decode_upright(raw, max_pixels)
+    return [encode_tile(image, box, tile_size, quality) for box in boxes]
+
+
+def _run_job(name: str, size: int, job: Callable[..., List[bytes]], max_pixels: int, max_rss_bytes: int,
+             *args: Any) -> JobResult:
+    """
+    Run job on the image in shared memory block name, in a worker process
+    
+    The outputs are written back to back into one result block.
+    
+    Returns:
+        (result block name, output sizes, the worker's span observations,
+        wall-clock start time, run seconds)
+    """
+    started_at = time.time()
+    start = time.perf_counter()
+    events: List[Dict[str, Any]] = []
+    sink = events.append
+    metrics.add_sink(sink)
+    try:
+        source = SharedMemory(name=name)
+        try:
+            raw = bytes(source.buf[:size])
+        finally:
+            source.close()
+        
+        outputs = job(raw, max_pixels, max_rss_bytes, *args)
+        processed = b''.join(outputs)
+        
+        result = SharedMemory(create=True, size=max(1, len(processed)))
+        try:
+            result.buf[:len(processed)] = processed
+        except BaseException:
+            # The parent never learns the block's name, so it must not outlive this job
+            result.close()
+            result.unlink()
+            raise
+        result.close()
+    except (MemoryError, OSError) as e:
+        # Allocations and mappings past the address-space cap fail here rather than in the OOM killer
+        if isinstance(e, OSError) and e.errno != errno.ENOMEM:
+            raise
+        raise ImageTooLargeError(
+            f"Image needs more than the worker memory limit of {max_rss_bytes / 2**20:.0f} MB"
+        ) from None
+    finally:
+        metrics.remove_sink(sink)
+    
+    observations = [(event['name'], event['value']) for event in events if event['type'] == 'observation']
+    return result.name, [len(output) for output in outputs], observations, started_at, time.perf_counter() - start
+
+
+class PreprocessExecutor:
+    """
+    Runs preprocess_image, and tile cutting, in a pool of worker processes
+    
+    Decoding and resizing hold the GIL, so in the app's process one large
+    upload stalls every other session; in a worker it only occupies that
+    worker. Source and result bytes travel through shared memory blocks, not
+    through the pickled task arguments. Images over max_pixels, or whose
+    decode would take a worker past max_rss_bytes, are rejected with
+    ImageTooLargeError before any pixels are decoded.
+    """
+    
+    def __init__(self, max_workers: Optional[int] = None, max_pixels: int = MAX_IMAGE_PIXELS,
+                 max_rss_bytes: int = WORKER_MAX_RSS_BYTES,
+                 mp_context: Optional[multiprocessing.context.BaseContext] = None):
+        """
+        Args:
+            max_workers: Worker processes; defaults to min(4, CPU count)
+            max_pixels: Largest accepted image in pixels
+            max_rss_bytes: Resident memory ceiling per worker
+            mp_context: Multiprocessing context; defaults to 'spawn', since
+                forking a process that runs threads is unsafe
+        """
+        self.max_workers = max_workers or min(4, os.cpu_count() or 1)
+        self.max_pixels = max_pixels
+        self.max_rss_bytes = max_rss_bytes
+        self._mp_context = mp_context if mp_context is not None else multiprocessing.get_context('spawn')
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._lock = threading.Lock()
+        self.pending = 0
+        self.jobs = 0
+        self.rejected = 0
+        self.failed = 0
+    
+    def _pool(self) -> ProcessPoolExecutor:
+        """Return the worker pool, starting it on first use or after a worker died"""
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.max_workers, mp_context=self._mp_context,
+                    initializer=_init_worker, initargs=(self.max_rss_bytes,)
+                )
+            return self._executor
+    
+    def _discard_pool(self, executor: ProcessPoolExecutor) -> None:
+        with self._lock:
+            if self._executor is executor:
+                self._executor = None
+        executor.shutdown(wait=False, cancel_futures=True)
+    
+    def preprocess(self, raw: bytes, profile: PayloadProfile = DEFAULT_PROFILE) -> bytes:
+        """
+        Preprocess raw image bytes in a worker process
+        
+        Args:
+            raw: Encoded source image
+            profile: Target size, format, quality and byte budget
+        
+        Returns:
+            Preprocessed image bytes, as preprocess_image would return them
+        
+        Raises:
+            ImageTooLargeError: If the image exceeds the pixel or memory limits
+        """
+        return self._submit(raw, _preprocess_job, profile)[0]
+    
+    def tiles(self, raw: bytes, boxes: Sequence[Box], tile_size: int, quality: int = TILE_QUALITY) -> List[bytes]:
+        """
+        Cut tiles from raw image bytes in a worker process
+        
+        The image is decoded once, at full resolution, and every tile is
+        encoded as TiledImage.tile would encode it.
+        
+        Args:
+            raw: Encoded source image
+            boxes: (left, upper, right, lower) tile boxes in upright pixels
+            tile_size: Largest tile side
+            quality: JPEG quality of the tiles
+        
+        Returns:
+            JPEG bytes of each tile, in the order of boxes
+        
+        Raises:
+            ImageTooLargeError: If the image exceeds the pixel or memory limits
+        """
+        return self._submit(raw, _tiles_job, list(boxes), tile_size, quality)
+    
+    def _submit(self, raw: bytes, job: Callable[..., List[bytes]], *args: Any) -> List[bytes]:
+        """Run job on raw in a worker, counting the outcome and replaying the worker's metrics"""
+        try:
+            # The header alone settles the pixel limit, so skip the round trip
+            open_image(raw, self.max_pixels)
+        except ImageTooLargeError:
+            with self._lock:
+                self.rejected += 1
+            raise
+        
+        source = SharedMemory(create=True, size=max(1, len(raw)))
+        with self._lock:
+            self.pending += 1
+            self.jobs += 1
+        submitted_at = time.time()
+        try:
+            source.buf[:len(raw)] = raw
+            executor = self._pool()
+            future = executor.submit(_run_job, source.name, len(raw), job, self.max_pixels, self.max_rss_bytes, *args)
+            try:
+                name, sizes, observations, started_at, run_seconds = future.result()
+            except BrokenProcessPool:
+                self._discard_pool(executor)
+                raise
+        except ImageTooLargeError:
+            with self._lock:
+                self.rejected += 1
+            raise
+        except Exception:
+            with self._lock:
+                self.failed += 1
+            raise
+        finally:
+            with self._lock:
+                self.pending -= 1
+            source.close()
+            try:
+                source.unlink()
+            except FileNotFoundError:
+                # A worker that failed to map the block has already unlinked it
+                pass
+        
+        result = SharedMemory(name=name)
+        try:
+            outputs = []
+            offset = 0
+            for size in sizes:
+                outputs.append(bytes(result.buf[offset:offset + size]))
+                offset += size
+        finally:
+            result.close()
+            result.unlink()
+        
+        metrics.observe('preprocess_queue_wait_seconds', max(0.0, started_at - submitted_at))
+        metrics.observe('preprocess_job_seconds', run_seconds)
+        for observation, value in observations:
+            metrics.observe(observation, value)
+        return outputs
+    
+    def stats(self) -> Dict[str, int]:
+        """Return queue depth (jobs waiting for a free worker), jobs in flight and outcome counts"""
+        with self._lock:
+            return {
+                'workers': self.max_workers,
+                'pending': self.pending,
+                'queued': max(0, self.pending - self.max_workers),
+                'jobs': self.jobs,
+                'rejected': self.rejected,
+                'failed': self.failed,
+            }
+    
+    def shutdown(self, wait: bool = True) -> None:
+        """Stop the worker processes; a later preprocess() starts new ones"""
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=wait)
+
+
+_shared_executor: Optional[PreprocessExecutor] = None
+_shared_executor_lock = threading.Lock()
+
+
+def get_preprocess_executor() -> Optional[PreprocessExecutor]:
+    """
+    Return the process-wide preprocessing pool, creating it on first use
+    
+    CLARITY_PREPROCESS_WORKERS sets the number of workers (0 preprocesses in
+    the calling thread and returns None) and CLARITY_WORKER_MAX_RSS_MB the
+    per-worker memory ceiling.
+    
+    Returns:
+        The shared PreprocessExecutor, or None if the pool is disabled
+    """
+    global _shared_executor
+    workers = os.getenv('CLARITY_PREPROCESS_WORKERS')
+    if workers is not None and int(workers) == 0:
+        return None
+    
+    with _shared_executor_lock:
+        if _shared_executor is None:
+            max_rss_mb = os.getenv('CLARITY_WORKER_MAX_RSS_MB')
+            _shared_executor = PreprocessExecutor(
+                max_workers=int(workers) if workers else None,
+                max_rss_bytes=int(max_rss_mb) * 1024 * 1024 if max_rss_mb else WORKER_MAX_RSS_BYTES
+            )
+            metrics.register_collector('preprocess_pool', _shared_executor.stats)
+        return _shared_executor
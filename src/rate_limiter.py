@@ -0,0 +1,343 @@
+import asyncio
+import logging
+import os
+import random
+import threading
+import time
+from typing import Any, Awaitable, Callable, Optional, Tuple
+
+try:
+    from .metrics import metrics
+except ImportError:
+    from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# HTTP status codes (exposed as ``exc.code`` by google.api_core exceptions)
+OVERLOAD_CODES = {429, 503}
+RETRYABLE_CODES = {429, 500, 502, 503, 504}
+
+
+class CircuitOpenError(Exception):
+    """Raised without calling the backend while the circuit breaker is open"""
+
+
+def _status_code(exc: BaseException) -> Optional[int]:
+    code = getattr(exc, 'code', None)
+    if isinstance(code, int):
+        return code
+    # Errors from HTTP clients carry the status on the attached response instead
+    http_code = getattr(getattr(exc, 'response', None), 'status_code', None)
+    return http_code if isinstance(http_code, int) else None
+
+
+def is_overload(exc: BaseException) -> bool:
+    """True for 429/503 responses that signal the backend wants less traffic"""
+    return _status_code(exc) in OVERLOAD_CODES
+
+
+def is_retryable(exc: BaseException) -> bool:
+    """True for throttling, server-side and transport errors worth retrying"""
+    return _status_code(exc) in RETRYABLE_CODES or isinstance(exc, (ConnectionError, TimeoutError))
+
+
+def retry_after(exc: BaseException) -> Optional[float]:
+    """Return the server's retry-after hint in seconds, if the error carries one"""
+    for detail in getattr(exc, 'details', None) or []:
+        delay = getattr(detail, 'retry_delay', None)
+        if delay is not None:
+            return delay.seconds + delay.nanos / 1e9
+    
+    headers = getattr(getattr(exc, 'response', None), 'headers', None) or {}
+    value = headers.get('Retry-After') if hasattr(headers, 'get') else None
+    try:
+        return float(value) if value is not None else None
+    except ValueError:
+        return None
+
+
+class TokenBucket:
+    """Reservation-based token bucket; callers sleep for the returned delay"""
+    
+    def __init__(self, per_minute: float, capacity: Optional[float] = None):
+        """
+        Args:
+            per_minute: Refill rate in tokens per minute
+            capacity: Burst size; defaults to one minute of tokens
+        """
+        self.rate = per_minute / 60.0
+        self.capacity = capacity if capacity is not None else per_minute
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+    
+    def reserve(self, amount: float) -> float:
+        """Take amount tokens, returning how long to wait before using them"""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            # Requests larger than the bucket still go through, after a full refill
+            self._tokens -= min(amount, self.capacity)
+            return max(0.0, -self._tokens / self.rate)
+    
+    def adjust(self, delta: float) -> None:
+        """Correct the balance once the real cost is known (positive delta refunds)"""
+        with self._lock:
+            self._tokens = min(self.capacity, self._tokens + delta)
+
+
+class AdaptiveConcurrencyLimiter:
+    """AIMD concurrency limit: +1 per window of successes, halved on overload"""
+    
+    def __init__(self, initial: int, minimum: int = 1, maximum: int = 64):
+        self.minimum = minimum
+        self.maximum = maximum
+        self._limit = float(initial)
+        self._in_flight = 0
+        self._condition = threading.Condition()
+    
+    @property
+    def limit(self) -> int:
+        return int(self._limit)
+    
+    def try_acquire(self) -> bool:
+        """Take a slot if one is free"""
+        with self._condition:
+            if self._in_flight < int(self._limit):
+                self._in_flight += 1
+                return True
+            return False
+    
+    def acquire(self, timeout: Optional[float] = None) -> bool:
+        """Block until a slot is free"""
+        with self._condition:
+            if not self._condition.wait_for(lambda: self._in_flight < int(self._limit), timeout):
+                return False
+            self._in_flight += 1
+            return True
+    
+    async def acquire_async(self) -> None:
+        """Wait for a slot without blocking the event loop"""
+        delay = 0.005
+        while not self.try_acquire():
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 0.1)
+    
+    def release(self, overloaded: bool = False) -> None:
+        """Return a slot and adapt the limit to the outcome of the call"""
+        with self._condition:
+            self._in_flight -= 1
+            if overloaded:
+                self._limit = max(self.minimum, self._limit / 2)
+            else:
+                self._limit = min(self.maximum, self._limit + 1 / self._limit)
+            self._condition.notify_all()
+
+
+class CircuitBreaker:
+    """Fails fast after repeated backend failures, probing again after a cool-down"""
+    
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._failures = 0
+        self._opened_at: Optional[float] = None
+        self._probing = False
+        self._lock = threading.Lock()
+    
+    @property
+    def state(self) -> str:
+        with self._lock:
+            if self._opened_at is None:
+                return 'closed'
+            if time.monotonic() - self._opened_at >= self.reset_timeout:
+                return 'half_open'
+            return 'open'
+    
+    def check(self) -> bool:
+        """
+        Raise CircuitOpenError unless a call may go through
+        
+        Returns:
+            True if the call is the half-open probe; it must end in
+            record_success, record_failure or abort_probe
+        """
+        with self._lock:
+            if self._opened_at is None:
+                return False
+            if time.monotonic() - self._opened_at >= self.reset_timeout and not self._probing:
+                # Half-open: let exactly one probe through
+                self._probing = True
+                return True
+        raise CircuitOpenError("Gemini backend unavailable; circuit breaker is open")
+    
+    def abort_probe(self) -> None:
+        """Give up a probe that ended without an outcome (e.g. was cancelled); the circuit stays open"""
+        with self._lock:
+            self._probing = False
+    
+    def record_success(self) -> None:
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._probing = False
+    
+    def record_failure(self) -> None:
+        with self._lock:
+            self._failures += 1
+            if self._probing or self._failures >= self.failure_threshold:
+                if self._opened_at is None or self._probing:
+                    logger.warning("Opening circuit breaker after repeated Gemini failures")
+                    metrics.increment('circuit_breaker_opened')
+                self._opened_at = time.monotonic()
+            self._probing = False
+
+
+class RateLimiter:
+    """
+    Client-side admission control shared by every Gemini call in a process
+    
+    Each attempt passes the circuit breaker, reserves request and token quota,
+    waits out any server retry-after hint, and takes an adaptive concurrency
+    slot. Throttling and server errors are retried with jittered exponential
+    backoff; other errors are raised immediately.
+    """
+    
+    def __init__(self, requests_per_minute: float, tokens_per_minute: float,
+                 initial_concurrency: int = 8, max_concurrency: int = 64,
+                 breaker: Optional[CircuitBreaker] = None,
+                 max_attempts: int = 3, base_delay: float = 1.0, max_delay: float = 10.0):
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+        self.concurrency = AdaptiveConcurrencyLimiter(initial_concurrency, maximum=max_concurrency)
+        self.breaker = breaker if breaker is not None else CircuitBreaker()
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._blocked_until = 0.0
+        self._lock = threading.Lock()
+    
+    def _admission_delay(self, tokens: float) -> Tuple[float, bool]:
+        """Reserve quota for one attempt; return how long to wait first and whether it is the breaker's probe"""
+        probe = self.breaker.check()
+        delay = max(self.requests.reserve(1), self.tokens.reserve(tokens))
+        with self._lock:
+            return max(delay, self._blocked_until - time.monotonic()), probe
+    
+    def _abandon_attempt(self, tokens: float, probe: bool, sent: bool) -> None:
+        """Undo an attempt cancelled or interrupted before it had an outcome"""
+        if probe:
+            self.breaker.abort_probe()
+        if not sent:
+            # Nothing reached the backend, so return the quota it reserved
+            self.requests.adjust(1)
+            self.tokens.adjust(tokens)
+    
+    def _on_failure(self, exc: Exception, attempt: int) -> float:
+        """Record a failed attempt; return the backoff delay or re-raise"""
+        if not is_retryable(exc):
+            # The backend answered; the request itself was bad
+            self.breaker.record_success()
+            raise exc
+        
+        self.breaker.record_failure()
+        metrics.increment('rate_limiter_retries')
+        hint = retry_after(exc)
+        if hint is not None:
+            with self._lock:
+                self._blocked_until = max(self._blocked_until, time.monotonic() + hint)
+        
+        if attempt + 1 >= self.max_attempts:
+            raise exc
+        backoff = min(self.max_delay, self.base_delay * 2 ** attempt) * random.uniform(0.5, 1.0)
+        return max(backoff, hint or 0.0)
+    
+    def _on_success(self) -> None:
+        self.breaker.record_success()
+    
+    def record_usage(self, estimated_tokens: float, actual_tokens: Optional[int]) -> None:
+        """Refund or charge the difference between estimated and reported token usage"""
+        if isinstance(actual_tokens, int):
+            self.tokens.adjust(estimated_tokens - actual_tokens)
+    
+    def call(self, fn: Callable[[], Any], tokens: float = 0) -> Any:
+        """Run fn under the limiter, retrying throttled and failed attempts"""
+        for attempt in range(self.max_attempts):
+            delay, probe = self._admission_delay(tokens)
+            sent = settled = False
+            try:
+                if delay > 0:
+                    metrics.observe('rate_limiter_wait_seconds', delay)
+                    time.sleep(delay)
+                
+                self.concurrency.acquire()
+                try:
+                    sent = True
+                    result = fn()
+                except Exception as e:
+                    self.concurrency.release(overloaded=is_overload(e))
+                    settled = True
+                    backoff = self._on_failure(e, attempt)
+                except BaseException:
+                    self.concurrency.release()
+                    raise
+                else:
+                    self.concurrency.release()
+                    settled = True
+                    self._on_success()
+                    return result
+            except BaseException:
+                if not settled:
+                    self._abandon_attempt(tokens, probe, sent)
+                raise
+            time.sleep(backoff)
+    
+    async def call_async(self, fn: Callable[[], Awaitable[Any]], tokens: float = 0) -> Any:
+        """Async counterpart of call; waits never block the event loop"""
+        for attempt in range(self.max_attempts):
+            delay, probe = self._admission_delay(tokens)
+            sent = settled = False
+            try:
+                if delay > 0:
+                    metrics.observe('rate_limiter_wait_seconds', delay)
+                    await asyncio.sleep(delay)
+                
+                await self.concurrency.acquire_async()
+                try:
+                    sent = True
+                    result = await fn()
+                except Exception as e:
+                    self.concurrency.release(overloaded=is_overload(e))
+                    settled = True
+                    backoff = self._on_failure(e, attempt)
+                except BaseException:
+                    # Cancelled, e.g. by a client disconnecting
+                    self.concurrency.release()
+                    raise
+                else:
+                    self.concurrency.release()
+                    settled = True
+                    self._on_success()
+                    return result
+            except BaseException:
+                if not settled:
+                    self._abandon_attempt(tokens, probe, sent)
+                raise
+            await asyncio.sleep(backoff)
+
+
+def default_rate_limiter() -> RateLimiter:
+    """
+    Build the limiter from environment settings
+    
+    CLARITY_RPM and CLARITY_TPM should match the project's Gemini quota;
+    CLARITY_MAX_CONCURRENCY caps the adaptive concurrency limit.
+    """
+    max_concurrency = int(os.getenv('CLARITY_MAX_CONCURRENCY', 32))
+    return RateLimiter(
+        requests_per_minute=float(os.getenv('CLARITY_RPM', 1000)),
+        tokens_per_minute=float(os.getenv('CLARITY_TPM', 4_000_000)),
+        initial_concurrency=min(8, max_concurrency),
+        max_concurrency=max_concurrency
+    )
@@ -0,0 +1,360 @@
+"""
+HTTP API for GeminiService, for programmatic use alongside the Streamlit UI
+
+Usage:
+    python src/server.py [--host 0.0.0.0] [--port 8000] [--workers 16] [--queue 64]
+
+Endpoints (multipart/form-data):
+    POST /v1/analyze  image, question, [mode], [stream]
+    POST /v1/compare  image1, image2, question, [mode], [stream]
+    POST /v1/batch    image (repeatable), question (repeatable), [mode]
+    GET  /health
+    GET  /metrics     Prometheus text format
+
+Answers are JSON, or plain text chunks with ``stream=true``. At most
+``workers`` analyses run at once and ``queue`` more wait; beyond that the
+server answers 429 with a Retry-After header. The server uses the
+process-wide GeminiService and preprocessing pool, so it shares their
+in-memory caches within this process and the on-disk response cache with
+the Streamlit app.
+"""
+import argparse
+import asyncio
+import logging
+import weakref
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
+
+from starlette.applications import Starlette
+from starlette.concurrency import iterate_in_threadpool
+from starlette.datastructures import UploadFile
+from starlette.requests import Request
+from starlette.responses import JSONResponse, PlainTextResponse, Response, StreamingResponse
+from starlette.routing import Route
+
+try:
+    from .gemini_service import GeminiService, get_gemini_service, select_generation_profile
+    from .image_processor import ImageTooLargeError, preprocess_image_cached, select_profile
+    from .metrics import metrics
+    from .preprocess_pool import get_preprocess_executor
+    from .utils import configure_logging, load_env_variables
+except ImportError:
+    from gemini_service import GeminiService, get_gemini_service, select_generation_profile
+    from image_processor import ImageTooLargeError, preprocess_image_cached, select_profile
+    from metrics import metrics
+    from preprocess_pool import get_preprocess_executor
+    from utils import configure_logging, load_env_variables
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_WORKERS = 16
+DEFAULT_QUEUE = 64
+
+# Uploads larger than this are refused before preprocessing
+MAX_UPLOAD_BYTES = 25 * 1024 * 1024
+
+# Most (image, question) pairs in one batch request
+MAX_BATCH_ITEMS = 64
+
+# Seconds a client is asked to wait after a 429
+RETRY_AFTER_SECONDS = 1
+
+
+class QueueFull(Exception):
+    """Raised when admitting a request would exceed the queue capacity"""
+
+
+class RequestError(Exception):
+    """A client error, answered with status and message"""
+    
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+
+class AdmissionQueue:
+    """
+    Bounded admission in front of the analysis workers
+    
+    A request reserves one unit per analysis it will run before its uploads
+    are read; if that would take the number of pending analyses past
+    workers + queue, it is refused at once instead of waiting. Admitted
+    analyses then run at most ``workers`` at a time. All methods are called
+    on the event loop, so the counters need no lock.
+    """
+    
+    def __init__(self, workers: int = DEFAULT_WORKERS, queue: int = DEFAULT_QUEUE):
+        self.workers = workers
+        self.capacity = workers + queue
+        self.pending = 0
+        self.admitted = 0
+        self.rejected = 0
+        self._semaphores: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, asyncio.Semaphore]" = (
+            weakref.WeakKeyDictionary()
+        )
+    
+    def admit(self, cost: int = 1) -> None:
+        """Reserve cost analyses, or raise QueueFull"""
+        if self.pending + cost > self.capacity:
+            self.rejected += 1
+            metrics.increment('api_rejected')
+            raise QueueFull()
+        self.pending += cost
+        self.admitted += 1
+    
+    def release(self, cost: int = 1) -> None:
+        self.pending -= cost
+    
+    @asynccontextmanager
+    async def worker(self) -> AsyncIterator[None]:
+        """Hold one of the worker slots of the running event loop"""
+        loop = asyncio.get_running_loop()
+        semaphore = self._semaphores.get(loop)
+        if semaphore is None:
+            semaphore = self._semaphores[loop] = asyncio.Semaphore(self.workers)
+        async with semaphore:
+            yield
+    
+    def stats(self) -> Dict[str, int]:
+        return {
+            'workers': self.workers,
+            'capacity': self.capacity,
+            'pending': self.pending,
+            'admitted': self.admitted,
+            'rejected': self.rejected,
+        }
+
+
+def _busy() -> Response:
+    return JSONResponse({'error': "Server busy, retry later"}, status_code=429,
+                        headers={'Retry-After': str(RETRY_AFTER_SECONDS)})
+
+
+async def _read_image(form, field: str) -> Tuple[str, bytes]:
+    """Return the filename and bytes of one uploaded file field"""
+    upload = form.get(field)
+    if not isinstance(upload, UploadFile):
+        raise RequestError(400, f"Missing file field '{field}'")
+    return upload.filename or field, await _read_upload_file(upload)
+
+
+async def _read_upload_file(upload: UploadFile) -> bytes:
+    data = await upload.read(MAX_UPLOAD_BYTES + 1)
+    if len(data) > MAX_UPLOAD_BYTES:
+        raise RequestError(413, f"Upload exceeds {MAX_UPLOAD_BYTES // (1024 * 1024)} MB")
+    if not data:
+        raise RequestError(400, f"Empty upload '{upload.filename}'")
+    return data
+
+
+def _question(form) -> str:
+    question = form.get('question')
+    if not isinstance(question, str) or not question.strip():
+        raise RequestError(400, "Missing 'question'")
+    return question
+
+
+def _wants_stream(request: Request, form) -> bool:
+    value = form.get('stream') or request.query_params.get('stream') or ''
+    return str(value).lower() in ('1', 'true', 'yes')
+
+
+async def _preprocess(raw: bytes, mode: Optional[str], question: str) -> bytes:
+    """Preprocess off the event loop, through the shared preprocessing cache and pool"""
+    try:
+        return await asyncio.to_thread(
+            preprocess_image_cached, raw, select_profile(mode, question), get_preprocess_executor()
+        )
+    except ImageTooLargeError as e:
+        raise RequestError(413, str(e))
+    except (OSError, ValueError) as e:
+        raise RequestError(400, f"Unreadable image: {str(e)}")
+
+
+def _service(request: Request) -> GeminiService:
+    app_state = request.app.state
+    if app_state.service is None:
+        app_state.service = get_gemini_service(load_env_variables()['GOOGLE_API_KEY'])
+    return app_state.service
+
+
+async def _handle(request: Request, cost: int, run) -> Response:
+    """Admit a request, run it and map failures to status codes"""
+    admission: AdmissionQueue = request.app.state.admission
+    try:
+        admission.admit(cost)
+    except QueueFull:
+        return _busy()
+    
+    release = True
+    try:
+        with metrics.span('api_request'):
+            response = await run()
+        # A streaming response holds its reservation until the stream ends
+        release = not isinstance(response, ReservedStreamingResponse)
+        return response
+    except RequestError as e:
+        return JSONResponse({'error': str(e)}, status_code=e.status)
+    except Exception as e:
+        logger.error(f"API request failed: {str(e)}")
+        return JSONResponse({'error': str(e)}, status_code=502)
+    finally:
+        if release:
+            admission.release(cost)
+
+
+class ReservedStreamingResponse(StreamingResponse):
+    """Streams text chunks from a sync generator while holding a worker slot and an admission reservation"""
+    
+    def __init__(self, admission: AdmissionQueue, cost: int, chunks):
+        async def body():
+            async with admission.worker():
+                async for chunk in iterate_in_threadpool(chunks):
+                    yield chunk
+        
+        super().__init__(body(), media_type='text/plain; charset=utf-8')
+        self.admission = admission
+        self.cost = cost
+    
+    async def __call__(self, scope, receive, send) -> None:
+        # Released however the stream ends, even if the client left before it started
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            await self.body_iterator.aclose()
+            self.admission.release(self.cost)
+
+
+def _stream(request: Request, cost: int, chunks) -> ReservedStreamingResponse:
+    return ReservedStreamingResponse(request.app.state.admission, cost, chunks)
+
+
+async def analyze(request: Request) -> Response:
+    async def run():
+        form = await request.form()
+        _, raw = await _read_image(form, 'image')
+        question = _question(form)
+        mode = form.get('mode')
+        service = _service(request)
+        profile = select_generation_profile(mode)
+        
+        image = await _preprocess(raw, mode, question)
+        if _wants_stream(request, form):
+            return _stream(request, 1, service.analyze_image_stream(image, question, profile=profile))
+        async with request.app.state.admission.worker():
+            return JSONResponse(await service.analyze_image_async(image, question, profile))
+    
+    return await _handle(request, 1, run)
+
+
+async def compare(request: Request) -> Response:
+    async def run():
+        form = await request.form()
+        _, raw1 = await _read_image(form, 'image1')
+        _, raw2 = await _read_image(form, 'image2')
+        question = _question(form)
+        mode = form.get('mode')
+        service = _service(request)
+        profile = select_generation_profile(mode)
+        
+        image1, image2 = await asyncio.gather(_preprocess(raw1, mode, question), _preprocess(raw2, mode, question))
+        if _wants_stream(request, form):
+            return _stream(request, 1, service.analyze_images_comparison_stream(
+                image1, image2, question, profile=profile
+            ))
+        async with request.app.state.admission.worker():
+            return JSONResponse(await service.analyze_images_comparison_async(image1, image2, question, profile))
+    
+    return await _handle(request, 1, run)
+
+
+async def batch(request: Request) -> Response:
+    # The cost is only known from the form, so it is parsed first; large file
+    # parts are spooled to disk and only read into memory once admitted
+    form = await request.form(max_files=MAX_BATCH_ITEMS)
+    uploads = [upload for upload in form.getlist('image') if isinstance(upload, UploadFile)]
+    questions = [q for q in form.getlist('question') if isinstance(q, str) and q.strip()]
+    cost = len(uploads) * len(questions)
+    if not cost:
+        return JSONResponse({'error': "A batch needs at least one 'image' and one 'question'"}, status_code=400)
+    if cost > MAX_BATCH_ITEMS:
+        return JSONResponse({'error': f"A batch may hold at most {MAX_BATCH_ITEMS} image/question pairs"},
+                            status_code=400)
+    
+    async def run():
+        mode = form.get('mode')
+        service = _service(request)
+        profile = select_generation_profile(mode)
+        admission: AdmissionQueue = request.app.state.admission
+        raws = [(upload.filename, await _read_upload_file(upload)) for upload in uploads]
+        
+        async def one(name: str, raw: bytes, question: str) -> Dict[str, Any]:
+            try:
+                image = await _preprocess(raw, mode, question)
+                async with admission.worker():
+                    result = await service.analyze_image_async(image, question, profile)
+                return dict(result, image=name, question=question)
+            except RequestError as e:
+                return {'image': name, 'question': question, 'error': str(e), 'status': e.status}
+            except Exception as e:
+                return {'image': name, 'question': question, 'error': str(e), 'status': 502}
+        
+        results: List[Dict[str, Any]] = await asyncio.gather(*[
+            one(name, raw, question) for name, raw in raws for question in questions
+        ])
+        return JSONResponse({'results': results})
+    
+    return await _handle(request, cost, run)
+
+
+async def health(request: Request) -> Response:
+    return JSONResponse({'status': 'ok', 'queue': request.app.state.admission.stats()})
+
+
+async def prometheus(request: Request) -> Response:
+    return PlainTextResponse(metrics.prometheus_text(), media_type='text/plain; version=0.0.4')
+
+
+def create_app(service: Optional[GeminiService] = None, workers: int = DEFAULT_WORKERS,
+               queue: int = DEFAULT_QUEUE) -> Starlette:
+    """
+    Build the API application
+    
+    Args:
+        service: Service to answer with; defaults to the process-wide one,
+            created from GOOGLE_API_KEY on the first request
+        workers: Analyses run concurrently
+        queue: Further analyses admitted to wait before requests get 429
+    
+    Returns:
+        The ASGI application
+    """
+    app = Starlette(routes=[
+        Route('/v1/analyze', analyze, methods=['POST']),
+        Route('/v1/compare', compare, methods=['POST']),
+        Route('/v1/batch', batch, methods=['POST']),
+        Route('/health', health, methods=['GET']),
+        Route('/metrics', prometheus, methods=['GET']),
+    ])
+    app.state.service = service
+    app.state.admission = AdmissionQueue(workers, queue)
+    metrics.register_collector('api_queue', app.state.admission.stats)
+    return app
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    import uvicorn
+    
+    parser = argparse.ArgumentParser(description="Serve the Clarity analysis API over HTTP")
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS, help="Analyses run concurrently")
+    parser.add_argument('--queue', type=int, default=DEFAULT_QUEUE, help="Analyses waiting before 429")
+    args = parser.parse_args(argv)
+    
+    configure_logging()
+    uvicorn.run(create_app(workers=args.workers, queue=args.queue), host=args.host, port=args.port)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,197 @@
+import hashlib
+import logging
+import os
+import threading
+from concurrent.futures import Executor, Future, ThreadPoolExecutor
+from typing import TYPE_CHECKING, Callable, Dict, List, Optional, Sequence, Tuple
+
+try:
+    from .gemini_service import select_generation_profile
+    from .image_processor import PayloadProfile, preprocess_image_cached, select_profile
+    from .metrics import metrics
+except ImportError:
+    from gemini_service import select_generation_profile
+    from image_processor import PayloadProfile, preprocess_image_cached, select_profile
+    from metrics import metrics
+
+if TYPE_CHECKING:
+    from gemini_service import GeminiService
+
+logger = logging.getLogger(__name__)
+
+# Quick prompts most often asked first in each analysis mode, most likely first
+SPECULATIVE_PROMPTS = {
+    'General Analysis': ("Describe the scene", "List main objects"),
+    'Technical Details': ("Identify text", "List main objects"),
+    'Artistic Analysis': ("Describe the scene", "Analyze colors"),
+    'Object Detection': ("List main objects", "Identify text"),
+}
+DEFAULT_SPECULATIVE_PROMPTS = SPECULATIVE_PROMPTS['General Analysis']
+
+# Speculative API calls one session may make before speculation stops
+SPECULATION_BUDGET = 6
+
+# Threads running speculative work for all sessions in the process
+SPECULATION_WORKERS = 2
+
+
+def speculation_enabled() -> bool:
+    """Whether uploads are pre-analyzed by default (CLARITY_SPECULATION=1)"""
+    return os.getenv('CLARITY_SPECULATION', '0') == '1'
+
+
+class SpeculativeAnalyzer:
+    """
+    Answers the likely first questions about an upload before they are asked
+    
+    One analyzer belongs to one session. On upload it preprocesses the image
+    and asks the analysis mode's likely quick prompts in the background,
+    exactly as the app would ask them, so the answers land in the service's
+    response cache and the user's first click is a cache hit (or joins the
+    call still in flight). A new upload or mode cancels the work not yet
+    started for the previous one, and at most budget speculative API calls
+    are made per session; prompts that are already cached cost nothing.
+    """
+    
+    def __init__(self, service: 'GeminiService', budget: int = SPECULATION_BUDGET,
+                 preprocess: Callable[[bytes, PayloadProfile], bytes] = preprocess_image_cached,
+                 executor: Optional[Executor] = None,
+                 prompts: Optional[Dict[str, Sequence[str]]] = None):
+        """
+        Args:
+            service: Service whose response cache receives the answers
+            budget: Most speculative API calls this session may make
+            preprocess: Function preprocessing raw bytes for a payload profile,
+                e.g. preprocess_image_cached bound to the worker pool
+            executor: Runs the speculative work; the shared speculation pool if None
+            prompts: Likely prompts per analysis mode; SPECULATIVE_PROMPTS if None
+        """
+        self.service = service
+        self.budget = budget
+        self.preprocess = preprocess
+        self._executor = executor
+        self.prompts = prompts if prompts is not None else SPECULATIVE_PROMPTS
+        self._lock = threading.Lock()
+        self._target: Optional[Tuple[str, str]] = None
+        self._cancelled = threading.Event()
+        self._futures: List[Future] = []
+        self.spent = 0
+        self.answered = 0
+        self.cancelled = 0
+    
+    def speculate(self, raw: bytes, analysis_mode: str) -> bool:
+        """
+        Start pre-analyzing an upload, unless it is already under way
+        
+        Calling this on every rerun is cheap: the same upload and mode are
+        only started once.
+        
+        Args:
+            raw: Encoded upload bytes
+            analysis_mode: Sidebar analysis mode, which selects the prompts and profiles
+        
+        Returns:
+            True if new speculative work was started
+        """
+        target = (hashlib.sha256(raw).hexdigest(), analysis_mode)
+        with self._lock:
+            if target == self._target:
+                return False
+            self._cancel_locked()
+            if self.spent >= self.budget:
+                return False
+            
+            self._target = target
+            cancelled = self._cancelled = threading.Event()
+            executor = self._executor or get_speculation_executor()
+            self._futures = [
+                executor.submit(self._run, raw, analysis_mode, prompt, cancelled)
+                for prompt in self.prompts.get(analysis_mode, DEFAULT_SPECULATIVE_PROMPTS)
+            ]
+            return True
+    
+    def cancel(self) -> None:
+        """Drop speculative work not yet started, e.g. when the upload is removed"""
+        with self._lock:
+            self._cancel_locked()
+    
+    def _cancel_locked(self) -> None:
+        self._target = None
+        self._cancelled.set()
+        for future in self._futures:
+            if future.cancel():
+                self._count_cancelled()
+        self._futures = []
+    
+    def _count_cancelled(self) -> None:
+        self.cancelled += 1
+        metrics.increment('speculative_cancelled')
+    
+    def _claim_budget(self, cancelled: threading.Event) -> bool:
+        """Reserve one speculative call, unless the work was cancelled or the budget is spent"""
+        with self._lock:
+            if cancelled.is_set():
+                self._count_cancelled()
+                return False
+            if self.spent >= self.budget:
+                metrics.increment('speculative_budget_exhausted')
+                return False
+            self.spent += 1
+            return True
+    
+    def _run(self, raw: bytes, analysis_mode: str, prompt: str, cancelled: threading.Event) -> None:
+        """Preprocess and ask one prompt the way the app's Analyze button would"""
+        if cancelled.is_set():
+            with self._lock:
+                self._count_cancelled()
+            return
+        try:
+            image = self.preprocess(raw, select_profile(analysis_mode, prompt))
+            generation = select_generation_profile(analysis_mode)
+            if self.service.has_cached_answer(image, prompt, generation):
+                return
+            if not self._claim_budget(cancelled):
+                return
+            
+            with metrics.span('speculative_analysis'):
+                self.service.analyze_image(image, prompt, generation)
+            metrics.increment('speculative_requests')
+            with self._lock:
+                self.answered += 1
+        except Exception as e:
+            # Speculation is best effort; the real request reports any error
+            metrics.increment('speculative_errors')
+            logger.warning(f"Speculative analysis of '{prompt}' failed: {str(e)}")
+    
+    def stats(self) -> Dict[str, int]:
+        """Return the session's budget, calls spent and answered, and cancelled prompts"""
+        with self._lock:
+            return {
+                'budget': self.budget,
+                'spent': self.spent,
+                'answered': self.answered,
+                'cancelled': self.cancelled,
+                'pending': sum(not future.done() for future in self._futures),
+            }
+
+
+_shared_executor: Optional[ThreadPoolExecutor] = None
+_shared_executor_lock = threading.Lock()
+
+
+def get_speculation_executor() -> ThreadPoolExecutor:
+    """
+    Return the process-wide speculation pool, creating it on first use
+    
+    The pool is small and shared by every session, so speculative calls
+    hold only a few of the rate limiter's slots however many sessions
+    upload at once; CLARITY_SPECULATION_WORKERS sets its size.
+    """
+    global _shared_executor
+    with _shared_executor_lock:
+        if _shared_executor is None:
+            _shared_executor = ThreadPoolExecutor(
+                max_workers=int(os.getenv('CLARITY_SPECULATION_WORKERS', SPECULATION_WORKERS)),
+                thread_name_prefix='speculation'
+            )
+        return _shared_executor
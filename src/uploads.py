@@ -0,0 +1,152 @@
+import io
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import TYPE_CHECKING, Any, Callable, Dict, Optional, Tuple
+
+try:
+    from .metrics import metrics
+except ImportError:
+    from metrics import metrics
+
+if TYPE_CHECKING:
+    from rate_limiter import RateLimiter
+
+logger = logging.getLogger(__name__)
+
+# Gemini keeps uploaded files for 48 hours
+FILE_TTL_SECONDS = 48 * 3600
+
+# Handles are dropped this long before the server deletes the file
+EXPIRY_MARGIN_SECONDS = 3600
+
+Uploader = Callable[[bytes, str], Tuple[Dict[str, Any], Optional[float]]]
+
+
+def upload_to_gemini(data: bytes, mime_type: str) -> Tuple[Dict[str, Any], Optional[float]]:
+    """Upload an image through the Gemini File API; return its content part and expiry time"""
+    import google.generativeai as genai
+    
+    uploaded = genai.upload_file(io.BytesIO(data), mime_type=mime_type)
+    expiration = getattr(uploaded, 'expiration_time', None)
+    expires_at = expiration.timestamp() if hasattr(expiration, 'timestamp') else None
+    return {'file_data': {'mime_type': mime_type, 'file_uri': uploaded.uri}}, expires_at
+
+
+def delete_from_gemini(part: Dict[str, Any]) -> None:
+    """Delete an uploaded file early, once its handle has been evicted"""
+    import google.generativeai as genai
+    
+    # File URIs end in the resource id that names the file ("files/<id>")
+    genai.delete_file('files/' + part['file_data']['file_uri'].rsplit('/', 1)[-1])
+
+
+class UploadRegistry:
+    """
+    Bounded map from image digest to an uploaded-file handle
+    
+    The first request for an image uploads it once; later requests reference
+    the handle, so follow-up questions only send text. Handles expire before
+    the server-side file does, the least recently used handle is evicted
+    (and its file deleted) beyond max_entries, and concurrent requests for
+    the same image share a single upload. With a limiter, uploads and
+    deletes are admitted, retried and circuit-broken like every other
+    Gemini call.
+    """
+    
+    def __init__(self, max_entries: int = 256, uploader: Uploader = upload_to_gemini,
+                 deleter: Optional[Callable[[Dict[str, Any]], None]] = delete_from_gemini,
+                 ttl_seconds: float = FILE_TTL_SECONDS, limiter: Optional['RateLimiter'] = None):
+        self.max_entries = max_entries
+        self.uploader = uploader
+        self.deleter = deleter
+        self.ttl_seconds = ttl_seconds
+        self.limiter = limiter
+        self._entries: "OrderedDict[str, Tuple[Dict[str, Any], float]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._uploading: Dict[str, threading.Lock] = {}
+        self.uploads = 0
+        self.reuses = 0
+        self.evictions = 0
+    
+    def _call(self, fn: Callable[..., Any], *args: Any) -> Any:
+        """Run one File API call, through the limiter if there is one"""
+        if self.limiter is None:
+            return fn(*args)
+        return self.limiter.call(lambda: fn(*args))
+    
+    def _get(self, digest: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            entry = self._entries.get(digest)
+            if entry is None:
+                return None
+            part, expires_at = entry
+            if expires_at <= time.time():
+                del self._entries[digest]
+                return None
+            self._entries.move_to_end(digest)
+            self.reuses += 1
+            return part
+    
+    def get_or_upload(self, digest: str, data: bytes, mime_type: str) -> Dict[str, Any]:
+        """Return the content part for an image, uploading it if no live handle exists"""
+        part = self._get(digest)
+        if part is not None:
+            metrics.increment('upload_reuses')
+            return part
+        
+        with self._lock:
+            upload_lock = self._uploading.setdefault(digest, threading.Lock())
+        try:
+            with upload_lock:
+                # Another request may have finished the upload while we waited
+                part = self._get(digest)
+                if part is not None:
+                    metrics.increment('upload_reuses')
+                    return part
+                
+                with metrics.span('upload'):
+                    part, expires_at = self._call(self.uploader, data, mime_type)
+                metrics.increment('uploads')
+                expires_at = expires_at if expires_at is not None else time.time() + self.ttl_seconds
+                self._put(digest, part, expires_at - EXPIRY_MARGIN_SECONDS)
+                return part
+        finally:
+            with self._lock:
+                self._uploading.pop(digest, None)
+    
+    def _put(self, digest: str, part: Dict[str, Any], expires_at: float) -> None:
+        evicted = []
+        with self._lock:
+            self._entries[digest] = (part, expires_at)
+            self._entries.move_to_end(digest)
+            self.uploads += 1
+            while len(self._entries) > self.max_entries:
+                evicted.append(self._entries.popitem(last=False)[1][0])
+                self.evictions += 1
+        
+        if evicted and self.deleter is not None:
+            # Deleting is only housekeeping, so it never delays the request
+            threading.Thread(target=self._delete, args=(evicted,), daemon=True).start()
+    
+    def _delete(self, parts) -> None:
+        for part in parts:
+            try:
+                self._call(self.deleter, part)
+            except Exception as e:
+                logger.warning(f"Failed to delete uploaded file: {str(e)}")
+    
+    def invalidate(self, digest: str) -> None:
+        """Forget the handle for digest, e.g. after the backend rejected it"""
+        with self._lock:
+            self._entries.pop(digest, None)
+    
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                'uploads': self.uploads,
+                'reuses': self.reuses,
+                'evictions': self.evictions,
+                'entries': len(self._entries),
+            }
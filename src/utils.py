@@ -1,24 +1,37 @@
 import os
 import logging
-from dotenv import load_dotenv
 from functools import lru_cache
-from datetime import datetime
-import json
-import hashlib
-from pathlib import Path
+from typing import Optional
 
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler('clarity.log'),
-        logging.StreamHandler()
-    ]
-)
+LOG_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
 
 logger = logging.getLogger(__name__)
 
+_logging_configured = False
+
+def configure_logging(level: int = logging.INFO, log_file: Optional[str] = None) -> None:
+    """
+    Configure root logging for an entry point (the Streamlit app, the batch CLI)
+    
+    Importing project modules never touches logging configuration; entry points
+    call this once. Repeated calls are no-ops, so Streamlit reruns are safe.
+    
+    Args:
+        level: Root log level
+        log_file: File to log to in addition to stderr; defaults to
+            CLARITY_LOG_FILE, or 'clarity.log' if unset. Empty disables it.
+    """
+    global _logging_configured
+    if _logging_configured:
+        return
+    
+    log_file = log_file if log_file is not None else os.getenv('CLARITY_LOG_FILE', 'clarity.log')
+    handlers = [logging.StreamHandler()]
+    if log_file:
+        handlers.insert(0, logging.FileHandler(log_file))
+    logging.basicConfig(level=level, format=LOG_FORMAT, handlers=handlers)
+    _logging_configured = True
+
 @lru_cache(maxsize=1)
 def load_env_variables() -> dict:
     """
@@ -27,6 +40,8 @@ def load_env_variables() -> dict:
     Returns:
         Dict containing environment variables
     """
+    from dotenv import load_dotenv
+    
     logger.info("Loading environment variables")
     load_dotenv()
     
@@ -40,21 +55,4 @@ def load_env_variables() -> dict:
             raise ValueError(f"Missing required environment variable: {var}")
         env_vars[var] = value
     
-    return env_vars 
-
-def cache_response(cache_key: str, response: dict):
-    """Cache response to disk"""
-    cache_dir = Path("cache")
-    cache_dir.mkdir(exist_ok=True)
-    
-    cache_file = cache_dir / f"{cache_key}.json"
-    with open(cache_file, "w") as f:
-        json.dump(response, f)
-
-def get_cached_response(cache_key: str) -> dict:
-    """Get cached response from disk"""
-    cache_file = Path("cache") / f"{cache_key}.json"
-    if cache_file.exists():
-        with open(cache_file) as f:
-            return json.load(f)
-    return None 
\ No newline at end of file
+    return env_vars
@@ -0,0 +1,282 @@
+import logging
+import os
+import tempfile
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Iterator, List, Optional, Sequence, Tuple
+
+from PIL import Image
+
+try:
+    from .image_processor import (
+        DEFAULT_PROFILE, MAX_IMAGE_PIXELS, PayloadProfile, open_image, preprocess_image, preprocess_image_cached
+    )
+    from .metrics import metrics
+    from .perceptual_hash import hamming_distance, phash
+except ImportError:
+    from image_processor import (
+        DEFAULT_PROFILE, MAX_IMAGE_PIXELS, PayloadProfile, open_image, preprocess_image, preprocess_image_cached
+    )
+    from metrics import metrics
+    from perceptual_hash import hamming_distance, phash
+
+if TYPE_CHECKING:
+    import numpy as np
+    from preprocess_pool import PreprocessExecutor
+
+logger = logging.getLogger(__name__)
+
+VIDEO_TYPES = ["mp4", "mov", "avi", "mkv", "webm"]
+
+# Frames scored per second of video, and at most this many per clip
+SAMPLE_FPS = 2.0
+MAX_SAMPLED_FRAMES = 300
+
+# Keyframes sent to the model for one clip or burst
+MAX_KEYFRAMES = 5
+
+# Frames are compared as SIGNATURE_SIZE thumbnails through colour histograms
+# with HISTOGRAM_LEVELS levels per channel
+SIGNATURE_SIZE = 64
+HISTOGRAM_LEVELS = 8
+
+# Half the L1 distance between normalized histograms, in [0, 1], from the
+# last keyframe at which a frame counts as a new scene
+SCENE_CHANGE_THRESHOLD = 0.3
+
+# Keyframes within this many pHash bits of an earlier one are dropped (e.g. A-B-A cuts)
+DUPLICATE_DISTANCE = 6
+
+
+@dataclass(frozen=True)
+class Keyframe:
+    """One frame chosen to represent a clip or burst"""
+    index: int                  # Frame number in the clip, or position in the burst
+    timestamp: Optional[float]  # Seconds from the start of the clip; None for bursts
+    image: bytes                # Preprocessed image bytes
+
+
+def color_histograms(signatures: 'np.ndarray') -> 'np.ndarray':
+    """
+    Normalized joint colour histograms of a stack of thumbnails
+    
+    Args:
+        signatures: uint8 array of shape (frames, height, width, 3)
+    
+    Returns:
+        float array of shape (frames, HISTOGRAM_LEVELS ** 3) whose rows sum to 1
+    """
+    import numpy as np
+    
+    frames = signatures.shape[0]
+    levels = (signatures.reshape(frames, -1, 3) // (256 // HISTOGRAM_LEVELS)).astype(np.int64)
+    codes = (levels[..., 0] * HISTOGRAM_LEVELS + levels[..., 1]) * HISTOGRAM_LEVELS + levels[..., 2]
+    # Offset each frame's codes into its own block so one bincount covers the whole stack
+    bins = HISTOGRAM_LEVELS ** 3
+    codes += np.arange(frames)[:, None] * bins
+    counts = np.bincount(codes.ravel(), minlength=frames * bins).reshape(frames, bins)
+    return counts / codes.shape[1]
+
+
+def select_keyframes(signatures: 'np.ndarray', max_keyframes: int = MAX_KEYFRAMES,
+                     threshold: float = SCENE_CHANGE_THRESHOLD,
+                     duplicate_distance: int = DUPLICATE_DISTANCE) -> List[int]:
+    """
+    Pick the frames that start a new scene
+    
+    The first frame is always kept. Each later keyframe is the first frame
+    whose histogram is at least threshold away from the previous keyframe,
+    which catches hard cuts as well as slow pans and zooms; distances to all
+    remaining frames are computed at once per keyframe. Keyframes that look
+    like an earlier one (by histogram or pHash, e.g. a cut back to the first
+    shot) are dropped, and if more than max_keyframes remain, the ones
+    furthest from their predecessor are kept.
+    
+    Args:
+        signatures: uint8 thumbnails of shape (frames, height, width, 3), in order
+        max_keyframes: Most keyframes to return
+        threshold: Histogram distance in [0, 1] that counts as a scene change
+        duplicate_distance: pHash distance at or below which frames are duplicates
+    
+    Returns:
+        Sorted indices into signatures
+    """
+    import numpy as np
+    
+    if len(signatures) == 0:
+        return []
+    
+    histograms = color_histograms(signatures)
+    keyframes = [0]
+    novelty = [float('inf')]  # The opening shot survives any cap
+    while True:
+        last = keyframes[-1]
+        distances = np.abs(histograms[last + 1:] - histograms[last]).sum(axis=1) / 2
+        changed = np.flatnonzero(distances >= threshold)
+        if not changed.size:
+            break
+        keyframes.append(last + 1 + int(changed[0]))
+        novelty.append(float(distances[changed[0]]))
+    
+    hashes = []
+    distinct = []
+    for index, score in zip(keyframes, novelty):
+        kept = [kept_index for kept_index, _ in distinct]
+        if kept and (np.abs(histograms[kept] - histograms[index]).sum(axis=1) / 2 < threshold).any():
+            continue
+        fingerprint = phash(Image.fromarray(signatures[index]))
+        if all(hamming_distance(fingerprint, seen) > duplicate_distance for seen in hashes):
+            hashes.append(fingerprint)
+            distinct.append((index, score))
+    
+    distinct.sort(key=lambda item: item[1], reverse=True)
+    return sorted(index for index, _ in distinct[:max_keyframes])
+
+
+def _signature(frame: 'np.ndarray') -> 'np.ndarray':
+    """Shrink a BGR video frame to an RGB signature thumbnail"""
+    import cv2
+    
+    thumbnail = cv2.resize(frame, (SIGNATURE_SIZE, SIGNATURE_SIZE), interpolation=cv2.INTER_AREA)
+    return cv2.cvtColor(thumbnail, cv2.COLOR_BGR2RGB)
+
+
+def _sampled_frames(path: str, frame_indices: Optional[Sequence[int]] = None,
+                    sample_fps: float = SAMPLE_FPS) -> Iterator[Tuple[int, float, 'np.ndarray']]:
+    """
+    Yield (frame number, timestamp, BGR frame) for sampled or chosen frames
+    
+    Skipped frames are only grabbed, never retrieved (colour-converted and
+    copied out), so they cost little beyond demuxing and decoding.
+    """
+    import cv2
+    
+    capture = cv2.VideoCapture(path)
+    if not capture.isOpened():
+        raise ValueError("Could not open the video")
+    try:
+        fps = capture.get(cv2.CAP_PROP_FPS) or 30.0
+        if frame_indices is None:
+            total = int(capture.get(cv2.CAP_PROP_FRAME_COUNT))
+            stride = max(1, round(fps / sample_fps), -(-total // MAX_SAMPLED_FRAMES))
+            wanted = None
+        else:
+            wanted = set(frame_indices)
+            last_wanted = max(wanted, default=-1)
+        
+        index = 0
+        while capture.grab():
+            if wanted is None:
+                take = index % stride == 0 and index // stride < MAX_SAMPLED_FRAMES
+            else:
+                take = index in wanted
+            if take:
+                ok, frame = capture.retrieve()
+                if ok:
+                    yield index, index / fps, frame
+            index += 1
+            if wanted is not None and index > last_wanted:
+                break
+            # The frame count is unknown for some containers, so the stride alone does not bound sampling
+            if wanted is None and index // stride >= MAX_SAMPLED_FRAMES:
+                break
+    finally:
+        capture.release()
+
+
+def _encode_frame(frame: 'np.ndarray') -> bytes:
+    """Encode a BGR frame as a high-quality JPEG for preprocess_image"""
+    import cv2
+    
+    ok, encoded = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, 95])
+    if not ok:
+        raise ValueError("Could not encode a video frame")
+    return encoded.tobytes()
+
+
+def extract_video_keyframes(video: bytes, profile: PayloadProfile = DEFAULT_PROFILE,
+                            max_keyframes: int = MAX_KEYFRAMES, sample_fps: float = SAMPLE_FPS,
+                            suffix: str = '.mp4') -> List[Keyframe]:
+    """
+    Decode a clip with OpenCV and return its preprocessed keyframes
+    
+    The clip is read twice: first sampled frames are reduced to signature
+    thumbnails and scored, then only the chosen keyframes are decoded again
+    at full size, encoded and preprocessed, so memory stays bounded by the
+    thumbnails whatever the clip length.
+    
+    Args:
+        video: Encoded video bytes
+        profile: Target size, format and quality of the keyframe images
+        max_keyframes: Most keyframes to return
+        sample_fps: Frames scored per second of video
+        suffix: File extension hinting the container format to the decoder
+    
+    Returns:
+        Keyframes in clip order
+    """
+    import numpy as np
+    
+    # OpenCV only decodes from a path or device
+    handle, path = tempfile.mkstemp(suffix=suffix)
+    try:
+        with os.fdopen(handle, 'wb') as f:
+            f.write(video)
+        
+        with metrics.span('video_sample'):
+            sampled = [(index, timestamp, _signature(frame))
+                       for index, timestamp, frame in _sampled_frames(path, sample_fps=sample_fps)]
+        if not sampled:
+            raise ValueError("The video contains no decodable frames")
+        
+        with metrics.span('keyframe_select'):
+            chosen = select_keyframes(np.stack([signature for _, _, signature in sampled]), max_keyframes)
+        frame_indices = [sampled[i][0] for i in chosen]
+        logger.info(f"Selected {len(chosen)} keyframes from {len(sampled)} sampled frames")
+        
+        return [
+            Keyframe(index, round(timestamp, 2), preprocess_image(_encode_frame(frame), profile))
+            for index, timestamp, frame in _sampled_frames(path, frame_indices)
+        ]
+    finally:
+        os.unlink(path)
+
+
+def extract_burst_keyframes(images: Sequence[bytes], profile: PayloadProfile = DEFAULT_PROFILE,
+                            max_keyframes: int = MAX_KEYFRAMES,
+                            executor: Optional['PreprocessExecutor'] = None) -> List[Keyframe]:
+    """
+    Choose the distinct shots of a camera burst and preprocess only those
+    
+    Every shot is checked against the pixel limit from its header before
+    its signature thumbnail is decoded, and the keyframes are preprocessed
+    through the shared preprocessing cache, in the executor's workers if
+    one is given.
+    
+    Args:
+        images: Encoded images in shooting order
+        profile: Target size, format and quality of the keyframe images
+        max_keyframes: Most keyframes to return
+        executor: Process pool that preprocesses the keyframes; in this thread if None
+    
+    Returns:
+        Keyframes in burst order
+    
+    Raises:
+        ImageTooLargeError: If a shot exceeds the pixel or worker memory limits
+    """
+    import numpy as np
+    
+    max_pixels = executor.max_pixels if executor is not None else MAX_IMAGE_PIXELS
+    signatures = []
+    with metrics.span('video_sample'):
+        for data in images:
+            image = open_image(data, max_pixels)
+            # Signatures are tiny, so let the JPEG decoder do most of the shrinking
+            image.draft('RGB', (SIGNATURE_SIZE * 2, SIGNATURE_SIZE * 2))
+            image = image.convert('RGB').resize((SIGNATURE_SIZE, SIGNATURE_SIZE), Image.Resampling.BILINEAR)
+            signatures.append(np.asarray(image))
+    
+    with metrics.span('keyframe_select'):
+        chosen = select_keyframes(np.stack(signatures), max_keyframes) if signatures else []
+    return [Keyframe(index, None, preprocess_image_cached(images[index], profile, executor=executor))
+            for index in chosen]
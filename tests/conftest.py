@@ -15,4 +15,14 @@ def mock_image():
 
 @pytest.fixture
 def mock_api_key():
-    return "mock_api_key_12345" 
\ No newline at end of file
+    return "mock_api_key_12345"
+
+@pytest.fixture(autouse=True)
+def isolated_response_cache(tmp_path, monkeypatch):
+    """Keep the on-disk response cache of each test in its own directory"""
+    monkeypatch.setenv("CLARITY_CACHE_DIR", str(tmp_path / "cache"))
+
+@pytest.fixture(autouse=True)
+def isolated_log_file(tmp_path, monkeypatch):
+    """Keep entry points that configure logging from writing clarity.log into the checkout"""
+    monkeypatch.setenv("CLARITY_LOG_FILE", str(tmp_path / "clarity.log"))
@@ -0,0 +1,65 @@
+import pytest
+import json
+from pathlib import Path
+from unittest.mock import Mock
+from PIL import Image
+from src.batch import BatchJob, discover_inputs, load_completed, run_batch
+
+@pytest.fixture
+def image_dir(tmp_path):
+    images = tmp_path / "images"
+    images.mkdir()
+    for i, color in enumerate(['red', 'green', 'blue']):
+        Image.new('RGB', (64, 64), color=color).save(images / f"img{i}.png")
+    (images / "notes.txt").write_text("not an image")
+    return images
+
+def test_discover_inputs_from_directory(image_dir):
+    jobs = list(discover_inputs(image_dir, ["Describe the scene"]))
+    
+    assert [Path(job.path).name for job in jobs] == ["img0.png", "img1.png", "img2.png"]
+    assert all(job.questions == ["Describe the scene"] for job in jobs)
+
+def test_discover_inputs_from_jsonl_manifest(image_dir):
+    manifest = image_dir / "manifest.jsonl"
+    manifest.write_text(json.dumps({"path": "img1.png", "questions": ["Identify text"]}) + "\n")
+    
+    jobs = list(discover_inputs(manifest, ["Describe the scene"]))
+    
+    assert jobs == [BatchJob(str(image_dir / "img1.png"), ["Identify text"])]
+
+def test_run_batch_writes_results_and_resumes(image_dir, tmp_path):
+    service = Mock()
+    service.analyze_image.return_value = {'answer': "An answer", 'model': "gemini-1.5-flash"}
+    output = tmp_path / "results.jsonl"
+    questions = ["Describe the scene", "List main objects"]
+    
+    stats = run_batch(service, discover_inputs(image_dir, questions), output,
+                      preprocess_workers=1, concurrency=2)
+    
+    assert stats.images == 3
+    assert stats.requests == 6
+    assert stats.failures == 0
+    assert len(load_completed(output)) == 6
+    
+    resumed = run_batch(service, discover_inputs(image_dir, questions), output,
+                        preprocess_workers=1, concurrency=2)
+    
+    assert resumed.skipped == 6
+    assert service.analyze_image.call_count == 6
+
+def test_run_batch_records_failures(image_dir, tmp_path):
+    service = Mock()
+    service.analyze_image.side_effect = Exception("Gemini API error: quota")
+    output = tmp_path / "results.jsonl"
+    
+    stats = run_batch(service, [BatchJob(str(image_dir / "img0.png"), ["Describe the scene"]),
+                                BatchJob(str(image_dir / "missing.png"), ["Describe the scene"])],
+                      output, preprocess_workers=1, concurrency=1)
+    
+    assert stats.failures == 2
+    assert load_completed(output) == set()
+    records = {Path(record['path']).name: record for record in map(json.loads, output.read_text().splitlines())}
+    assert set(records) == {"img0.png", "missing.png"}
+    assert records["missing.png"]['error'].startswith("Preprocessing failed")
+    assert records["missing.png"]['answer'] is None
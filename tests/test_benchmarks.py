@@ -0,0 +1,33 @@
+import pytest
+from benchmarks import bench_service
+from benchmarks.stub_backend import StubGenerativeModel
+
+def test_stub_backend_throttling_is_retried(tmp_path, mock_image):
+    backend = StubGenerativeModel(latency_seconds=0.001, throttle_rate=0.3, seed=1)
+    service = bench_service.make_service(backend, str(tmp_path))
+    
+    answers = [service.analyze_image(image, "What's in this image?")['answer']
+               for image in bench_service.distinct_images(10)]
+    
+    assert all(answer.startswith("Stub answer for 1 image(s)") for answer in answers)
+    assert backend.stats()['throttled'] > 0
+
+def test_stub_backend_streams_with_usage(tmp_path, mock_image):
+    service = bench_service.make_service(StubGenerativeModel(latency_seconds=0.001, chunks=4), str(tmp_path))
+    result = {}
+    
+    chunks = list(service.analyze_image_stream(mock_image, "What's in this image?", result=result))
+    
+    assert len(chunks) == 4
+    assert result['usage']['input_tokens'] > 258
+
+def test_benchmark_run_reports_every_scenario():
+    results = bench_service.run(requests=20, concurrency=4, latency=0.001, catalog=10,
+                                zipf_exponents=(1.1,), preprocess_repeat=1, preprocess_sizes=['12MP'])['results']
+    
+    assert results['analyze_image']['requests'] == 20
+    assert results['analyze_image']['p50_ms'] <= results['analyze_image']['p99_ms']
+    assert 'ttft_p95_ms' in results['stream']
+    assert 0 < results['zipf_cache']['s=1.1']['hit_ratio'] < 1
+    assert results['preprocess']['12MP']['megapixels_per_second'] > 0
+    assert bench_service.compare({'results': results}, {'results': results})['analyze_image.requests'] == 0
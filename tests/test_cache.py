@@ -0,0 +1,141 @@
+import pytest
+import asyncio
+import threading
+import time
+from src.cache import AsyncSingleFlight, DiskCache, LRUCache, ResponseCache, SingleFlight
+
+def test_lru_cache_hit_and_miss():
+    cache = LRUCache(max_bytes=100)
+    assert cache.get("a") is None
+    
+    cache.put("a", b"12345")
+    assert cache.get("a") == b"12345"
+    
+    stats = cache.stats()
+    assert stats['hits'] == 1
+    assert stats['misses'] == 1
+    assert stats['bytes'] == 5
+
+def test_lru_cache_evicts_least_recently_used_by_bytes():
+    cache = LRUCache(max_bytes=10)
+    cache.put("a", b"xxxx")
+    cache.put("b", b"yyyy")
+    cache.get("a")
+    cache.put("c", b"zzzz")
+    
+    assert "a" in cache
+    assert "b" not in cache
+    assert "c" in cache
+    assert cache.stats()['evictions'] == 1
+    assert cache.stats()['bytes'] == 8
+
+def test_lru_cache_skips_oversized_values():
+    cache = LRUCache(max_bytes=4)
+    cache.put("big", b"too large")
+    
+    assert len(cache) == 0
+
+def test_disk_cache_persists_across_instances(tmp_path):
+    DiskCache(tmp_path / "db.sqlite3", max_bytes=1024, ttl_seconds=60).put("k", {"answer": "a"})
+    
+    reopened = DiskCache(tmp_path / "db.sqlite3", max_bytes=1024, ttl_seconds=60)
+    assert reopened.get("k") == {"answer": "a"}
+
+def test_disk_cache_expires_entries(tmp_path):
+    cache = DiskCache(tmp_path / "db.sqlite3", max_bytes=1024, ttl_seconds=-1)
+    cache.put("k", {"answer": "a"})
+    
+    assert cache.get("k") is None
+
+def test_disk_cache_enforces_size_cap(tmp_path):
+    cache = DiskCache(tmp_path / "db.sqlite3", max_bytes=100, ttl_seconds=60)
+    for i in range(10):
+        cache.put(f"k{i}", {"answer": "x" * 20})
+    
+    assert cache.stats()['bytes'] <= 100
+    assert cache.get("k9") is not None
+    assert cache.get("k0") is None
+
+def test_response_cache_promotes_disk_hits(tmp_path):
+    disk = DiskCache(tmp_path / "db.sqlite3", max_bytes=1024, ttl_seconds=60)
+    disk.put("k", {"answer": "a"})
+    cache = ResponseCache(LRUCache(1024, sizeof=lambda value: 1), disk)
+    
+    assert cache.get("k") == {"answer": "a"}
+    assert "k" in cache.memory
+
+def test_lru_cache_expires_entries():
+    cache = LRUCache(max_bytes=100, ttl_seconds=0.05)
+    cache.put("a", b"xx")
+    
+    assert "a" in cache
+    time.sleep(0.1)
+    assert cache.get("a") is None
+    assert cache.stats()['expirations'] == 1
+    assert cache.stats()['bytes'] == 0
+
+def test_response_cache_memory_tier_expires_with_disk(tmp_path):
+    disk = DiskCache(tmp_path / "db.sqlite3", max_bytes=1024, ttl_seconds=0.05)
+    cache = ResponseCache(LRUCache(1024, sizeof=lambda value: 1), disk)
+    cache.put("written", {"answer": "a"})
+    disk.put("promoted", {"answer": "b"})
+    assert cache.get("promoted") == {"answer": "b"}
+    
+    time.sleep(0.1)
+    assert cache.get("written") is None
+    assert cache.get("promoted") is None
+
+def test_single_flight_coalesces_concurrent_calls():
+    flight = SingleFlight()
+    calls = []
+    release = threading.Event()
+    
+    def fn():
+        calls.append(1)
+        release.wait(1)
+        return "result"
+    
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(flight.do("k", fn))) for _ in range(5)]
+    for thread in threads:
+        thread.start()
+    while flight.waiters("k") < 4:
+        time.sleep(0.001)
+    release.set()
+    for thread in threads:
+        thread.join()
+    
+    assert calls == [1]
+    assert results == ["result"] * 5
+    assert flight.stats() == {'in_flight': 0, 'waiting': 0, 'leaders': 1, 'coalesced': 4}
+
+def test_single_flight_shares_errors_and_forgets_finished_calls():
+    flight = SingleFlight()
+    
+    with pytest.raises(ValueError):
+        flight.do("k", lambda: (_ for _ in ()).throw(ValueError("boom")))
+    
+    assert flight.do("k", lambda: "retried") == "retried"
+
+def test_async_single_flight_survives_one_cancelled_caller():
+    flight = AsyncSingleFlight()
+    calls = []
+    
+    async def fetch():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        return "result"
+    
+    async def run():
+        first = asyncio.create_task(flight.do("k", fetch))
+        second = asyncio.create_task(flight.do("k", fetch))
+        await asyncio.sleep(0.01)
+        first.cancel()
+        return await second, first
+    
+    result, first = asyncio.run(run())
+    
+    assert result == "result"
+    assert first.cancelled()
+    assert calls == [1]
+    assert flight.stats() == {'in_flight': 0, 'waiting': 0, 'leaders': 1, 'coalesced': 1}
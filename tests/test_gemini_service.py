@@ -1,6 +1,17 @@
 import pytest
-from unittest.mock import Mock, patch
-from src.gemini_service import GeminiService
+import asyncio
+from unittest.mock import AsyncMock, Mock, patch
+import gc
+import io
+import json
+import threading
+import time
+import weakref
+import numpy as np
+from PIL import Image
+from src import gemini_service
+from src.gemini_service import GeminiService, get_gemini_service, select_generation_profile
+from src.metrics import metrics
 
 @pytest.fixture
 def mock_gemini_service():
@@ -20,7 +31,7 @@ def test_analyze_image_success(mock_model, mock_gemini_service, mock_image):
     response = mock_gemini_service.analyze_image(mock_image, "What's in this image?")
     
     assert response['answer'] == "This is a test response"
-    assert 'raw_response' in response
+    assert json.loads(json.dumps(response)) == response
 
 @patch('google.generativeai.GenerativeModel')
 def test_analyze_image_error(mock_model, mock_gemini_service, mock_image):
@@ -30,4 +41,522 @@ def test_analyze_image_error(mock_model, mock_gemini_service, mock_image):
     with pytest.raises(Exception) as exc_info:
         mock_gemini_service.analyze_image(mock_image, "What's in this image?")
     
-    assert "Gemini API error" in str(exc_info.value) 
\ No newline at end of file
+    assert "Gemini API error" in str(exc_info.value)
+
+def test_get_gemini_service_is_shared():
+    first = get_gemini_service("shared_key")
+    assert get_gemini_service("shared_key") is first
+    assert get_gemini_service("other_key") is not first
+
+def test_get_gemini_service_thread_safe(monkeypatch):
+    monkeypatch.setattr(gemini_service, "_shared_service", None)
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(get_gemini_service("race_key")))
+               for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    
+    assert len({id(service) for service in results}) == 1
+
+@patch('google.generativeai.GenerativeModel')
+def test_model_created_lazily(mock_model):
+    service = GeminiService("lazy_key")
+    assert not mock_model.called
+    
+    assert service.model is service.model
+    mock_model.assert_called_once_with('gemini-1.5-flash')
+
+
+@patch('google.generativeai.GenerativeModel')
+def test_analyze_image_served_from_cache(mock_model, mock_gemini_service, mock_image):
+    mock_model.return_value.generate_content.return_value.text = "Cached answer"
+    
+    first = mock_gemini_service.analyze_image(mock_image, "What's in this image?")
+    second = mock_gemini_service.analyze_image(mock_image, "What's in this image?")
+    
+    assert first == second
+    assert mock_model.return_value.generate_content.call_count == 1
+
+@patch('google.generativeai.GenerativeModel')
+def test_comparison_cache_survives_restart(mock_model, mock_image):
+    mock_model.return_value.generate_content.return_value.text = "Comparison answer"
+    
+    GeminiService("mock_api_key").analyze_images_comparison(mock_image, mock_image, "Differences?")
+    restarted = GeminiService("mock_api_key")
+    response = restarted.analyze_images_comparison(mock_image, mock_image, "Differences?")
+    
+    assert response['answer'] == "Comparison answer"
+    assert mock_model.return_value.generate_content.call_count == 1
+
+def test_cache_key_is_fixed_length_digest():
+    digest = GeminiService._image_digest(b"image bytes")
+    short_key = GeminiService._generate_cache_key([digest], "Short?")
+    long_key = GeminiService._generate_cache_key([digest], "Long question " * 500)
+    
+    assert len(short_key) == len(long_key) == 64
+    assert GeminiService._generate_cache_key([digest, digest], "Short?") != short_key
+
+@patch('google.generativeai.GenerativeModel')
+def test_cache_does_not_keep_service_alive(mock_model, mock_image):
+    mock_model.return_value.generate_content.return_value.text = "Answer"
+    service = GeminiService("mock_api_key")
+    cache = service.cache
+    service.analyze_image(mock_image, "What's in this image?")
+    service_ref = weakref.ref(service)
+    
+    del service
+    gc.collect()
+    
+    assert service_ref() is None
+    assert cache.stats()['memory']['entries'] == 1
+
+@patch('google.generativeai.GenerativeModel')
+def test_cache_stats_count_hits_and_misses(mock_model, mock_gemini_service, mock_image):
+    mock_model.return_value.generate_content.return_value.text = "Answer"
+    
+    mock_gemini_service.analyze_image(mock_image, "What's in this image?")
+    mock_gemini_service.analyze_image(mock_image, "What's in this image?")
+    
+    memory = mock_gemini_service.cache_stats()['memory']
+    assert memory['hits'] == 1
+    assert memory['misses'] == 1
+    assert 0 < memory['bytes'] < len(mock_image)
+
+def _stream_chunks(*texts):
+    return [Mock(text=text) for text in texts]
+
+@patch('google.generativeai.GenerativeModel')
+def test_analyze_image_stream_yields_chunks_and_caches(mock_model, mock_gemini_service, mock_image):
+    mock_model.return_value.generate_content.return_value = _stream_chunks("Hello ", "world")
+    
+    chunks = list(mock_gemini_service.analyze_image_stream(mock_image, "What's in this image?"))
+    
+    assert chunks == ["Hello ", "world"]
+    assert mock_model.return_value.generate_content.call_args.kwargs['stream'] is True
+    cached = mock_gemini_service.analyze_image(mock_image, "What's in this image?")
+    assert cached['answer'] == "Hello world"
+    assert mock_model.return_value.generate_content.call_count == 1
+    assert metrics.snapshot()['observations']['ttft_seconds']['count'] >= 1
+
+@patch('google.generativeai.GenerativeModel')
+def test_comparison_stream_does_not_cache_partial_answers(mock_model, mock_gemini_service, mock_image):
+    mock_model.return_value.generate_content.return_value = _stream_chunks("Part one", "Part two")
+    
+    stream = mock_gemini_service.analyze_images_comparison_stream(mock_image, mock_image, "Differences?")
+    next(stream)
+    stream.close()
+    
+    assert mock_gemini_service.cache_stats()['memory']['entries'] == 0
+
+@patch('google.generativeai.GenerativeModel')
+def test_analyze_prompts_caches_each_prompt(mock_model, mock_gemini_service, mock_image):
+    mock_model.return_value.generate_content.side_effect = lambda contents, **kwargs: Mock(text=contents[-1])
+    
+    first = dict(mock_gemini_service.analyze_prompts(mock_image, ["Describe the scene", "List main objects"]))
+    second = dict(mock_gemini_service.analyze_prompts(
+        mock_image, ["List main objects", "Describe  the scene", "Analyze colors"]
+    ))
+    
+    assert set(first) == {"Describe the scene", "List main objects"}
+    assert set(second) == {"Describe the scene", "List main objects", "Analyze colors"}
+    assert "Analyze colors" in GeminiService.render_text(second["Analyze colors"])
+    assert mock_model.return_value.generate_content.call_count == 3
+
+@patch('google.generativeai.GenerativeModel')
+def test_analyze_prompts_shares_cache_with_single_questions(mock_model, mock_gemini_service, mock_image):
+    mock_model.return_value.generate_content.side_effect = lambda contents, **kwargs: Mock(text=contents[-1])
+    other = mock_image + b'\0'
+    
+    mock_gemini_service.analyze_image(mock_image, "Describe the scene")
+    mock_gemini_service.analyze_image(other, "List main objects")
+    results = dict(mock_gemini_service.analyze_prompts(
+        {"Describe the scene": mock_image, "List main objects": other}, ["Describe the scene", "List main objects"]
+    ))
+    
+    assert set(results) == {"Describe the scene", "List main objects"}
+    assert mock_model.return_value.generate_content.call_count == 2
+
+@patch('google.generativeai.GenerativeModel')
+def test_compare_prompts_bounds_concurrency(mock_model, mock_gemini_service, mock_image):
+    lock = threading.Lock()
+    in_flight = [0, 0]
+    
+    def slow_generate(contents, **kwargs):
+        with lock:
+            in_flight[0] += 1
+            in_flight[1] = max(in_flight[1], in_flight[0])
+        time.sleep(0.05)
+        with lock:
+            in_flight[0] -= 1
+        return Mock(text="answer")
+    
+    mock_model.return_value.generate_content.side_effect = slow_generate
+    questions = [f"Question {i}" for i in range(6)]
+    
+    results = list(mock_gemini_service.compare_prompts(mock_image, mock_image, questions, max_workers=2))
+    
+    assert len(results) == 6
+    assert in_flight[1] == 2
+
+@patch('google.generativeai.GenerativeModel')
+def test_analyze_image_async_shares_cache_with_sync(mock_model, mock_gemini_service, mock_image):
+    mock_model.return_value.generate_content_async = AsyncMock(return_value=Mock(text="Async answer"))
+    
+    response = asyncio.run(mock_gemini_service.analyze_image_async(mock_image, "What's in this image?"))
+    cached = mock_gemini_service.analyze_image(mock_image, "What's in this image?")
+    
+    assert response['answer'] == cached['answer'] == "Async answer"
+    assert not mock_model.return_value.generate_content.called
+
+@patch('google.generativeai.GenerativeModel')
+def test_concurrent_async_misses_share_one_call(mock_model, mock_gemini_service, mock_image):
+    async def slow_generate(contents, **kwargs):
+        await asyncio.sleep(0.05)
+        return Mock(text="Shared answer")
+    
+    mock_model.return_value.generate_content_async = AsyncMock(side_effect=slow_generate)
+    
+    async def run():
+        return await asyncio.gather(*[
+            mock_gemini_service.analyze_image_async(mock_image, "What's in this image?") for _ in range(2)
+        ])
+    
+    first, second = asyncio.run(run())
+    
+    assert first['answer'] == second['answer'] == "Shared answer"
+    assert mock_model.return_value.generate_content_async.call_count == 1
+    assert mock_gemini_service.in_flight_stats()['coalesced'] == 1
+
+@patch('google.generativeai.GenerativeModel')
+def test_async_requests_are_bounded(mock_model, mock_image):
+    service = GeminiService("mock_api_key", max_async_requests=2)
+    in_flight = [0, 0]
+    
+    async def slow_generate(contents, **kwargs):
+        in_flight[0] += 1
+        in_flight[1] = max(in_flight[1], in_flight[0])
+        await asyncio.sleep(0.01)
+        in_flight[0] -= 1
+        return Mock(text=contents[-1])
+    
+    mock_model.return_value.generate_content_async = slow_generate
+    
+    async def run():
+        return await asyncio.gather(*[
+            service.analyze_images_comparison_async(mock_image, mock_image, f"Question {i}")
+            for i in range(6)
+        ])
+    
+    assert len(asyncio.run(run())) == 6
+    assert in_flight[1] == 2
+
+@patch('google.generativeai.GenerativeModel')
+def test_async_request_cancellation(mock_model, mock_gemini_service, mock_image):
+    started = []
+    
+    async def hanging_generate(contents, **kwargs):
+        started.append(True)
+        await asyncio.sleep(60)
+    
+    mock_model.return_value.generate_content_async = hanging_generate
+    
+    async def run():
+        task = asyncio.create_task(mock_gemini_service.analyze_image_async(mock_image, "Slow?"))
+        while not started:
+            await asyncio.sleep(0)
+        task.cancel()
+        await task
+    
+    with pytest.raises(asyncio.CancelledError):
+        asyncio.run(run())
+    assert mock_gemini_service.cache_stats()['memory']['entries'] == 0
+
+@patch('google.generativeai.GenerativeModel')
+def test_images_forwarded_as_inline_blobs(mock_model, mock_gemini_service, mock_image):
+    mock_model.return_value.generate_content.return_value.text = "Answer"
+    
+    mock_gemini_service.analyze_images_comparison(mock_image, mock_image, "Differences?")
+    
+    contents = mock_model.return_value.generate_content.call_args.args[0]
+    assert contents[0] == {'mime_type': 'image/jpeg', 'data': mock_image}
+    assert contents[1]['data'] is mock_image
+
+def test_image_mime_type_detection():
+    assert GeminiService._image_mime_type(b'\x89PNG\r\n\x1a\n') == 'image/png'
+    assert GeminiService._image_mime_type(b'RIFF\x00\x00\x00\x00WEBPVP8 ') == 'image/webp'
+    assert GeminiService._image_mime_type(b'\xff\xd8\xff\xe0') == 'image/jpeg'
+
+
+@patch('google.generativeai.GenerativeModel')
+def test_response_reports_token_usage(mock_model, mock_gemini_service, mock_image):
+    mock_response = mock_model.return_value.generate_content.return_value
+    mock_response.text = "Answer"
+    mock_response.usage_metadata = Mock(prompt_token_count=270, candidates_token_count=40, total_token_count=310)
+    
+    response = mock_gemini_service.analyze_image(mock_image, "What's in this image?")
+    
+    assert response['usage'] == {'input_tokens': 270, 'output_tokens': 40, 'total_tokens': 310}
+
+@patch('google.generativeai.GenerativeModel')
+def test_requests_record_spans_and_cache_counters(mock_model, mock_gemini_service, mock_image):
+    mock_response = mock_model.return_value.generate_content.return_value
+    mock_response.text = "Answer"
+    mock_response.usage_metadata = Mock(prompt_token_count=270, candidates_token_count=40, total_token_count=310)
+    before = metrics.snapshot()
+    
+    mock_gemini_service.analyze_image(mock_image, "What's in this image?")
+    mock_gemini_service.analyze_image(mock_image, "What's in this image?")
+    
+    after = metrics.snapshot()
+    counter = lambda snapshot, name: snapshot['counters'].get(name, 0)
+    observed = lambda snapshot, name: snapshot['observations'].get(name, {}).get('count', 0)
+    assert counter(after, 'cache_misses') - counter(before, 'cache_misses') == 1
+    assert counter(after, 'cache_hits') - counter(before, 'cache_hits') == 1
+    assert counter(after, 'input_tokens') - counter(before, 'input_tokens') == 270
+    assert observed(after, 'network_seconds') - observed(before, 'network_seconds') == 1
+    assert observed(after, 'cache_lookup_seconds') - observed(before, 'cache_lookup_seconds') == 2
+
+@patch('google.generativeai.GenerativeModel')
+def test_stream_fills_result_with_usage_and_ttft(mock_model, mock_gemini_service, mock_image):
+    chunks = _stream_chunks("Hello ", "world")
+    chunks[-1].usage_metadata = Mock(prompt_token_count=270, candidates_token_count=2, total_token_count=272)
+    mock_model.return_value.generate_content.return_value = chunks
+    
+    result = {}
+    with patch.object(mock_gemini_service.limiter, 'record_usage') as record_usage:
+        list(mock_gemini_service.analyze_image_stream(mock_image, "What's in this image?", result=result))
+    
+    assert result['answer'] == "Hello world"
+    assert result['usage']['input_tokens'] == 270
+    # The worst-case reservation is settled against the reported usage
+    assert record_usage.call_args.args[1] == 272
+    assert result['cached'] is False
+    assert result['ttft_seconds'] >= 0
+
+@patch('google.generativeai.GenerativeModel')
+def test_quota_reservation_counts_image_tiles(mock_model, mock_gemini_service):
+    mock_model.return_value.generate_content.return_value.text = "Answer"
+    large = io.BytesIO()
+    Image.new('RGB', (1536, 1152), color='red').save(large, format='JPEG')
+    profile = select_generation_profile("Object Detection")
+    
+    with patch.object(mock_gemini_service.limiter, 'record_usage') as record_usage:
+        mock_gemini_service.analyze_image(large.getvalue(), "What's in this image?", profile)
+    
+    estimate = record_usage.call_args.args[0]
+    assert estimate - profile.max_output_tokens >= 4 * 258
+
+STREAMED_SECTIONS = "1. **Direct Answer:** A red square\n2. **Details:** Solid fill\n3. **Confidence:** High"
+
+@patch('google.generativeai.GenerativeModel')
+def test_streamed_answer_is_served_in_structured_shape(mock_model, mock_gemini_service, mock_image):
+    mock_model.return_value.generate_content.return_value = _stream_chunks(*STREAMED_SECTIONS.partition("2."))
+    
+    list(mock_gemini_service.analyze_image_stream(mock_image, "What's in this image?"))
+    response = mock_gemini_service.analyze_image(mock_image, "What's in this image?")
+    
+    assert response['answer'] == "A red square"
+    assert response['details'] == "Solid fill"
+    assert response['confidence'] == "High"
+    assert mock_model.return_value.generate_content.call_count == 1
+
+@patch('google.generativeai.GenerativeModel')
+def test_structured_answer_is_served_to_the_stream(mock_model, mock_gemini_service, mock_image):
+    mock_model.return_value.generate_content.return_value.text = json.dumps(
+        {'answer': "A red square", 'details': "Solid fill", 'confidence': "High"}
+    )
+    
+    structured = mock_gemini_service.analyze_image(mock_image, "What's in this image?")
+    result = {}
+    chunks = list(mock_gemini_service.analyze_image_stream(mock_image, "What's in this image?", result=result))
+    
+    assert chunks == ["A red square\n\nSolid fill"]
+    assert {key: result[key] for key in structured} == structured
+    assert result['cached'] is True
+
+@patch('google.generativeai.GenerativeModel')
+def test_near_duplicate_image_reuses_answer(mock_model):
+    mock_model.return_value.generate_content.return_value.text = "Shared answer"
+    service = GeminiService("mock_api_key", near_duplicate_distance=6)
+    x = np.linspace(0, 255, 256)
+    texture = Image.fromarray((np.outer(np.sin(x / 20), np.cos(x / 30)) * 127 + 128).astype(np.uint8)).convert('RGB')
+    original, recompressed = io.BytesIO(), io.BytesIO()
+    texture.save(original, format='JPEG', quality=95)
+    texture.resize((250, 250)).save(recompressed, format='JPEG', quality=50)
+    
+    service.analyze_image(original.getvalue(), "Describe the scene")
+    response = service.analyze_image(recompressed.getvalue(), "Describe the scene")
+    
+    assert response['answer'] == "Shared answer"
+    assert mock_model.return_value.generate_content.call_count == 1
+
+def _solid_jpeg(color):
+    buffer = io.BytesIO()
+    Image.new('RGB', (64, 64), color=color).save(buffer, format='JPEG')
+    return buffer.getvalue()
+
+@patch('google.generativeai.GenerativeModel')
+def test_comparison_cache_is_order_aware(mock_model, mock_gemini_service):
+    mock_model.return_value.generate_content.return_value.text = "Answer"
+    red, blue = _solid_jpeg('red'), _solid_jpeg('blue')
+    
+    mock_gemini_service.analyze_images_comparison(red, blue, "Which is brighter?")
+    mock_gemini_service.analyze_images_comparison(red, blue, "Which is brighter?")
+    mock_gemini_service.analyze_images_comparison(blue, red, "Which is brighter?")
+    
+    assert mock_model.return_value.generate_content.call_count == 2
+
+@patch('google.generativeai.GenerativeModel')
+def test_gallery_grouped_reuses_descriptions(mock_model, mock_gemini_service):
+    mock_model.return_value.generate_content.side_effect = lambda contents, **kwargs: Mock(text=f"answer {len(contents)}")
+    red, green, blue = _solid_jpeg('red'), _solid_jpeg('green'), _solid_jpeg('blue')
+    
+    first = mock_gemini_service.analyze_gallery([red, green, red], "Which is warmest?")
+    second = mock_gemini_service.analyze_gallery([red, green, blue], "Which is coolest?")
+    
+    assert [item['image'] for item in first['descriptions']] == [1, 2]
+    assert [item['image'] for item in second['descriptions']] == [1, 2, 3]
+    # 3 distinct descriptions + 2 text-only comparisons
+    assert mock_model.return_value.generate_content.call_count == 5
+
+@patch('google.generativeai.GenerativeModel')
+def test_gallery_pairwise_deduplicates_pairs(mock_model, mock_gemini_service):
+    mock_model.return_value.generate_content.return_value.text = "Pair answer"
+    red, green, blue = _solid_jpeg('red'), _solid_jpeg('green'), _solid_jpeg('blue')
+    
+    response = mock_gemini_service.analyze_gallery([red, green, blue, green], "Differences?", mode='pairwise')
+    
+    assert [pair['images'] for pair in response['pairs']] == [[1, 2], [1, 3], [2, 3]]
+    assert mock_model.return_value.generate_content.call_count == 3
+
+def test_gallery_needs_two_distinct_images(mock_gemini_service, mock_image):
+    with pytest.raises(ValueError):
+        mock_gemini_service.analyze_gallery([mock_image, mock_image], "Differences?")
+
+@patch('google.generativeai.GenerativeModel')
+def test_structured_response_parsed_and_cached(mock_model, mock_gemini_service, mock_image):
+    mock_model.return_value.generate_content.return_value.text = json.dumps(
+        {'answer': "A red square", 'details': "Solid fill", 'confidence': "High"}
+    )
+    profile = select_generation_profile("Object Detection")
+    
+    response = mock_gemini_service.analyze_image(mock_image, "What's in this image?", profile)
+    cached = mock_gemini_service.analyze_image(mock_image, "What's in this image?", profile)
+    
+    assert response['answer'] == "A red square"
+    assert response['details'] == "Solid fill"
+    assert response['confidence'] == "High"
+    assert cached == response
+    config = mock_model.return_value.generate_content.call_args.kwargs['generation_config']
+    assert config['max_output_tokens'] == profile.max_output_tokens
+    assert config['response_mime_type'] == 'application/json'
+    assert mock_model.return_value.generate_content.call_count == 1
+
+@patch('google.generativeai.GenerativeModel')
+def test_generation_profiles_are_cached_separately(mock_model, mock_gemini_service, mock_image):
+    mock_model.return_value.generate_content.return_value.text = "Answer"
+    
+    mock_gemini_service.analyze_image(mock_image, "Describe", select_generation_profile("General Analysis"))
+    mock_gemini_service.analyze_image(mock_image, "Describe", select_generation_profile("Artistic Analysis"))
+    
+    assert mock_model.return_value.generate_content.call_count == 2
+
+def test_parse_answer_falls_back_to_text():
+    truncated = GeminiService._parse_answer('{"answer": "A red squ')
+    assert truncated == {'answer': '{"answer": "A red squ', 'details': None, 'confidence': None}
+    
+    text = GeminiService._parse_answer("1. Direct Answer: A square\n3. Confidence: medium")
+    assert text['confidence'] == "Medium"
+    assert select_generation_profile("Unknown mode").name == 'general'
+
+@patch('google.generativeai.GenerativeModel')
+def test_stream_is_plain_text_with_parsed_confidence(mock_model, mock_gemini_service, mock_image):
+    mock_model.return_value.generate_content.return_value = _stream_chunks("A square.\n", "Confidence: Low")
+    
+    result = {}
+    list(mock_gemini_service.analyze_image_stream(mock_image, "What's in this image?", result=result))
+    
+    config = mock_model.return_value.generate_content.call_args.kwargs['generation_config']
+    assert 'response_schema' not in config
+    assert result['confidence'] == "Low"
+    assert mock_gemini_service.analyze_image(mock_image, "What's in this image?")['confidence'] == "Low"
+
+@patch('google.generativeai.GenerativeModel')
+def test_concurrent_identical_requests_share_one_call(mock_model, mock_gemini_service, mock_image):
+    release = threading.Event()
+    
+    def slow_generate(contents, **kwargs):
+        release.wait(1)
+        return Mock(text="Shared answer")
+    
+    mock_model.return_value.generate_content.side_effect = slow_generate
+    results = []
+    threads = [
+        threading.Thread(target=lambda: results.append(
+            mock_gemini_service.analyze_image(mock_image, "Describe the scene")['answer']
+        ))
+        for _ in range(6)
+    ]
+    for thread in threads:
+        thread.start()
+    while mock_gemini_service.in_flight_stats()['waiting'] < 5:
+        time.sleep(0.001)
+    release.set()
+    for thread in threads:
+        thread.join()
+    
+    assert results == ["Shared answer"] * 6
+    assert mock_model.return_value.generate_content.call_count == 1
+    assert mock_gemini_service.in_flight_stats()['coalesced'] == 5
+
+def _large_png(width, height):
+    buffer = io.BytesIO()
+    Image.new('RGB', (width, height), color='white').save(buffer, format='PNG')
+    return buffer.getvalue()
+
+@patch('google.generativeai.GenerativeModel')
+def test_tiled_analysis_merges_and_caches_tiles(mock_model, mock_gemini_service):
+    mock_model.return_value.generate_content.side_effect = lambda contents, **kwargs: Mock(
+        text=f"answer from {len(contents) - 1} image(s)"
+    )
+    image = _large_png(2900, 2000)
+    
+    response = mock_gemini_service.analyze_image_tiled(image, "Identify text", tile_size=1536, overlap=128)
+    
+    assert len(response['tiles']) == 4
+    assert response['tiles'][-1]['box'] == [1364, 464, 2900, 2000]
+    assert response['answer'] == "answer from 0 image(s)"
+    # 4 tile requests + 1 text-only merge
+    assert mock_model.return_value.generate_content.call_count == 5
+    sent = [call.args[0] for call in mock_model.return_value.generate_content.call_args_list]
+    assert sorted(Image.open(io.BytesIO(contents[0]['data'])).size for contents in sent if len(contents) == 2) == [
+        (1536, 1536), (1536, 1536), (1536, 1536), (1536, 1536)
+    ]
+    
+    # Asking again reuses every tile answer and the merged answer
+    mock_gemini_service.analyze_image_tiled(image, "Identify text", tile_size=1536, overlap=128)
+    assert mock_model.return_value.generate_content.call_count == 5
+
+@patch('google.generativeai.GenerativeModel')
+def test_tiled_analysis_bounds_concurrency(mock_model, mock_gemini_service):
+    active = []
+    peak = []
+    lock = threading.Lock()
+    
+    def slow_generate(contents, **kwargs):
+        with lock:
+            active.append(1)
+            peak.append(len(active))
+        time.sleep(0.02)
+        with lock:
+            active.pop()
+        return Mock(text="Tile answer")
+    
+    mock_model.return_value.generate_content.side_effect = slow_generate
+    mock_gemini_service.analyze_image_tiled(_large_png(4000, 3000), "Count the windows", max_workers=2,
+                                            tile_size=1536, overlap=128)
+    
+    assert max(peak) <= 2
+    assert mock_model.return_value.generate_content.call_count == 9 + 1
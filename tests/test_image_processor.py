@@ -1,7 +1,12 @@
 import pytest
-from src.image_processor import preprocess_image
+from src.image_processor import (
+    PAYLOAD_PROFILES, ImageTooLargeError, PayloadProfile, TiledImage, estimate_image_tokens, preprocess_image,
+    preprocess_image_cached, preprocess_cache_stats, select_profile, tile_boxes
+)
+import numpy as np
 from PIL import Image
 import io
+from unittest.mock import Mock
 
 def test_preprocess_image_resize(mock_image):
     # Create a large test image
@@ -31,4 +36,157 @@ def test_preprocess_image_format(mock_image):
     
     # Check if image was converted to RGB
     processed_img = Image.open(io.BytesIO(processed))
-    assert processed_img.mode == 'RGB' 
\ No newline at end of file
+    assert processed_img.mode == 'RGB'
+
+def test_preprocess_image_cached_reuses_result(mock_image):
+    before = preprocess_cache_stats()
+    
+    first = preprocess_image_cached(mock_image)
+    second = preprocess_image_cached(io.BytesIO(mock_image))
+    
+    after = preprocess_cache_stats()
+    assert first == second
+    assert after['misses'] == before['misses'] + 1
+    assert after['hits'] == before['hits'] + 1
+
+def test_preprocess_image_cached_keeps_file_position(mock_image):
+    upload = io.BytesIO(mock_image)
+    upload.seek(10)
+    
+    preprocess_image_cached(upload)
+    
+    assert upload.tell() == 10
+
+def test_preprocess_image_passes_compliant_jpeg_through(mock_image):
+    assert preprocess_image(io.BytesIO(mock_image)) == mock_image
+
+def test_preprocess_image_strips_metadata_from_passed_through_jpeg():
+    img = Image.new('RGB', (200, 100), color='green')
+    exif = img.getexif()
+    exif[0x010F] = "Camera Maker"
+    exif[0xA431] = "SERIAL-12345"  # Body serial number
+    img_byte_arr = io.BytesIO()
+    img.save(img_byte_arr, format='JPEG', exif=exif, comment=b"shot at home")
+    raw = img_byte_arr.getvalue()
+    
+    processed = preprocess_image(raw)
+    
+    assert b"SERIAL-12345" not in processed and b"shot at home" not in processed
+    assert len(processed) < len(raw)
+    # Still the original entropy-coded data, not a re-encode
+    assert raw.endswith(processed[processed.index(b'\xff\xda'):])
+    assert Image.open(io.BytesIO(processed)).getexif() == {}
+
+def test_preprocess_image_applies_exif_orientation():
+    img = Image.new('RGB', (200, 100), color='green')
+    exif = img.getexif()
+    exif[0x0112] = 6  # Rotate 90 degrees clockwise to display
+    img_byte_arr = io.BytesIO()
+    img.save(img_byte_arr, format='JPEG', exif=exif)
+    
+    processed_img = Image.open(io.BytesIO(preprocess_image(img_byte_arr.getvalue())))
+    
+    assert processed_img.size == (100, 200)
+
+def test_preprocess_image_large_jpeg_fast_path():
+    large_img = Image.new('RGB', (6400, 4800), color='blue')
+    img_byte_arr = io.BytesIO()
+    large_img.save(img_byte_arr, format='JPEG')
+    
+    processed_img = Image.open(io.BytesIO(preprocess_image(img_byte_arr.getvalue())))
+    
+    assert processed_img.size == (1600, 1200)
+
+def test_preprocess_image_does_not_fingerprint(monkeypatch):
+    # pHash only serves the opt-in near-duplicate lookup, which hashes on demand
+    monkeypatch.setattr('src.image_processor.phash', Mock(side_effect=AssertionError("hashed eagerly")))
+    img_byte_arr = io.BytesIO()
+    Image.new('RGB', (2000, 1000), color='blue').save(img_byte_arr, format='PNG')
+    
+    assert preprocess_image(img_byte_arr.getvalue())
+
+def test_select_profile_by_mode_and_question():
+    assert select_profile("General Analysis", "Identify text").name == 'detail'
+    assert select_profile("Object Detection", "Describe the scene").name == 'detail'
+    assert select_profile("General Analysis", "Describe the scene & Analyze colors").name == 'compact'
+    assert select_profile("Artistic Analysis", "What style is this?").name == 'standard'
+    assert select_profile("General Analysis", "Can you read the labels?").name == 'detail'
+
+def test_select_profile_matches_detail_keywords_as_whole_words():
+    for question in ("Is this bread fresh?", "Which country is this?", "Describe the design",
+                     "What is the context?"):
+        assert select_profile("General Analysis", question).name == 'standard', question
+
+def test_profiles_snap_to_tile_boundaries():
+    for profile in PAYLOAD_PROFILES.values():
+        assert profile.max_size % 768 == 0
+    assert estimate_image_tokens(384, 300) == 258
+    assert estimate_image_tokens(1536, 1152) == 4 * 258
+
+def test_preprocess_image_compact_profile_is_webp():
+    large_img = Image.new('RGB', (3000, 2000), color='blue')
+    img_byte_arr = io.BytesIO()
+    large_img.save(img_byte_arr, format='JPEG')
+    
+    processed_img = Image.open(io.BytesIO(preprocess_image(img_byte_arr, PAYLOAD_PROFILES['compact'])))
+    
+    assert processed_img.format == 'WEBP'
+    assert max(processed_img.size) == 768
+
+def test_preprocess_image_respects_byte_budget():
+    noise = np.random.default_rng(0).integers(0, 256, (1200, 1200, 3), dtype=np.uint8)
+    img_byte_arr = io.BytesIO()
+    Image.fromarray(noise).save(img_byte_arr, format='PNG')
+    profile = PayloadProfile('tiny', 1536, 95, 'JPEG', 100 * 1024)
+    
+    processed = preprocess_image(img_byte_arr, profile)
+    
+    assert len(processed) <= 100 * 1024
+
+def test_tile_boxes_cover_image_with_overlap():
+    boxes = tile_boxes(4000, 3000, tile_size=1536, overlap=128)
+    
+    assert len(boxes) == 3 * 3
+    assert boxes[0][:2] == (0, 0) and boxes[-1][2:] == (4000, 3000)
+    assert all(right - left <= 1536 and lower - upper <= 1536 for left, upper, right, lower in boxes)
+    # Horizontal neighbours overlap by at least the requested margin
+    assert all(boxes[i][2] - boxes[i + 1][0] >= 128 for i in (0, 1))
+    assert tile_boxes(800, 600) == [(0, 0, 800, 600)]
+
+def test_tile_boxes_grow_to_respect_max_tiles():
+    boxes = tile_boxes(20000, 20000, tile_size=1536, overlap=128, max_tiles=16)
+    
+    assert len(boxes) <= 16
+    assert boxes[-1][2:] == (20000, 20000)
+
+def test_tiled_image_crops_lazily_at_native_resolution():
+    img = Image.new('RGB', (2900, 1000), color='white')
+    img_byte_arr = io.BytesIO()
+    img.save(img_byte_arr, format='PNG')
+    
+    tiled = TiledImage(img_byte_arr.getvalue(), tile_size=1536, overlap=128)
+    assert tiled._image is None
+    
+    tile = Image.open(io.BytesIO(tiled.tile(tiled.boxes[0])))
+    
+    assert tiled.size == (2900, 1000)
+    assert len(tiled.boxes) == 2
+    assert tile.format == 'JPEG' and tile.size == (1536, 1000)
+    assert tiled.tile_id(tiled.boxes[0]) != tiled.tile_id(tiled.boxes[1])
+
+def test_tiles_are_reused_across_tiled_images_of_one_upload():
+    img = Image.new('RGB', (3100, 1000), color='teal')
+    img_byte_arr = io.BytesIO()
+    img.save(img_byte_arr, format='PNG')
+    first = TiledImage(img_byte_arr.getvalue(), tile_size=1536, overlap=128)
+    tile = first.tile(first.boxes[0])
+    
+    # A rerun builds a new TiledImage from the same upload
+    second = TiledImage(img_byte_arr.getvalue(), tile_size=1536, overlap=128)
+    
+    assert second.tile(second.boxes[0]) == tile
+    assert second._image is None
+
+def test_preprocess_image_rejects_images_over_pixel_limit(mock_image):
+    with pytest.raises(ImageTooLargeError):
+        preprocess_image(mock_image, max_pixels=50 * 50)
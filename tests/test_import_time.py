@@ -0,0 +1,43 @@
+import pytest
+import subprocess
+import sys
+from pathlib import Path
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+
+# Heavy dependencies that must only load on first use, never at import time
+LAZY_MODULES = {'cv2', 'numpy', 'google.generativeai', 'grpc', 'dotenv', 'http.server'}
+
+# Generous wall-clock ceiling for the service import; it was ~1.4s with the SDK eagerly loaded
+IMPORT_BUDGET_SECONDS = 0.6
+
+def _import_profile(module: str):
+    """Import module in a fresh interpreter and return {module: cumulative seconds} from -X importtime"""
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f"import {module}"],
+        cwd=REPO_ROOT, capture_output=True, text=True, check=True
+    )
+    profile = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        profile[name.strip()] = int(cumulative) / 1e6
+    return profile
+
+@pytest.mark.parametrize("module", ["src.gemini_service", "src.batch", "src.utils"])
+def test_import_does_not_load_heavy_dependencies(module):
+    loaded = _import_profile(module).keys() & LAZY_MODULES
+    assert not loaded, f"{module} eagerly imports {sorted(loaded)}"
+
+def test_service_import_within_budget():
+    # Best of three runs, so one slow filesystem read does not fail the suite
+    timings = [_import_profile("src.gemini_service")["src.gemini_service"] for _ in range(3)]
+    assert min(timings) < IMPORT_BUDGET_SECONDS
+
+def test_importing_utils_does_not_configure_logging():
+    result = subprocess.run(
+        [sys.executable, '-c', "import logging, src.utils; print(len(logging.getLogger().handlers))"],
+        cwd=REPO_ROOT, capture_output=True, text=True, check=True
+    )
+    assert result.stdout.strip() == "0"
@@ -0,0 +1,59 @@
+import pytest
+import urllib.request
+from src.metrics import Metrics, start_metrics_server
+
+def test_metrics_counters_and_observations():
+    registry = Metrics()
+    registry.increment("requests")
+    registry.increment("requests", 2)
+    registry.observe("latency", 0.5)
+    registry.observe("latency", 1.5)
+    
+    snapshot = registry.snapshot()
+    assert snapshot['counters']['requests'] == 3
+    assert snapshot['observations']['latency']['count'] == 2
+    assert snapshot['observations']['latency']['sum'] == 2.0
+    assert snapshot['observations']['latency']['max'] == 1.5
+
+def test_span_records_seconds():
+    registry = Metrics()
+    with registry.span("decode"):
+        pass
+    
+    summary = registry.snapshot()['observations']['decode_seconds']
+    assert summary['count'] == 1
+    assert summary['p50'] == summary['p95'] == summary['last'] >= 0
+
+def test_sinks_receive_events_and_collectors_report_gauges():
+    registry = Metrics()
+    events = []
+    registry.add_sink(events.append)
+    registry.register_collector("cache", lambda: {'hits': 4})
+    registry.increment("cache_hits")
+    registry.observe("network_seconds", 0.2)
+    
+    assert [(e['type'], e['name']) for e in events] == [('counter', 'cache_hits'), ('observation', 'network_seconds')]
+    assert registry.snapshot()['gauges'] == {'cache_hits': 4}
+
+def test_prometheus_text_exposition():
+    registry = Metrics()
+    registry.increment("cache_hits", 3)
+    registry.observe("network_seconds", 0.2)
+    registry.observe("network_seconds", 3.0)
+    
+    text = registry.prometheus_text()
+    assert "clarity_cache_hits_total 3" in text
+    assert 'clarity_network_seconds_bucket{le="0.25"} 1' in text
+    assert 'clarity_network_seconds_bucket{le="+Inf"} 2' in text
+    assert "clarity_network_seconds_count 2" in text
+
+def test_metrics_server_serves_prometheus_text():
+    registry = Metrics()
+    registry.increment("requests")
+    server = start_metrics_server(0, registry, host='127.0.0.1')
+    try:
+        with urllib.request.urlopen(f"http://127.0.0.1:{server.server_address[1]}/metrics") as response:
+            assert "clarity_requests_total 1" in response.read().decode('utf-8')
+    finally:
+        server.shutdown()
+        server.server_close()
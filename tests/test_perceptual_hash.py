@@ -0,0 +1,48 @@
+import pytest
+import io
+import numpy as np
+from PIL import Image
+from src.perceptual_hash import BKTree, NearDuplicateIndex, dhash, hamming_distance, phash
+
+@pytest.fixture
+def textured_image():
+    x = np.linspace(0, 255, 256)
+    pixels = np.stack([np.outer(np.sin(x / 20), np.cos(x / 30)) * 127 + 128] * 3, axis=-1)
+    return Image.fromarray(pixels.astype(np.uint8), 'RGB')
+
+def test_hashes_survive_recompression_and_resize(textured_image):
+    buffer = io.BytesIO()
+    textured_image.resize((200, 200)).save(buffer, format='JPEG', quality=40)
+    resaved = Image.open(io.BytesIO(buffer.getvalue()))
+    
+    assert hamming_distance(phash(textured_image), phash(resaved)) <= 4
+    assert hamming_distance(dhash(textured_image), dhash(resaved)) <= 4
+
+def test_hashes_differ_for_different_images(textured_image):
+    other = textured_image.transpose(Image.Transpose.ROTATE_90)
+    
+    assert hamming_distance(phash(textured_image), phash(other)) > 10
+
+def test_bk_tree_search_matches_linear_scan():
+    rng = np.random.default_rng(1)
+    hashes = [int(value) for value in rng.integers(0, 2 ** 63, 300)]
+    tree = BKTree()
+    for i, value in enumerate(hashes):
+        tree.add(value, i)
+    
+    query = hashes[0] ^ 0b1011
+    expected = sorted(i for i, value in enumerate(hashes) if hamming_distance(query, value) <= 20)
+    
+    assert sorted(item for _, item in tree.search(query, 20)) == expected
+    assert tree.search(query, 3)[0] == (3, 0)
+
+def test_near_duplicate_index_is_bounded():
+    hashes = [int(value) for value in np.random.default_rng(2).integers(0, 2 ** 63, 25)]
+    index = NearDuplicateIndex(max_distance=2, max_entries=10)
+    for i, value in enumerate(hashes):
+        index.add("prompt", value, f"key{i}")
+    
+    assert index.stats()['entries'] <= 10
+    assert index.candidates("prompt", hashes[24] ^ 1) == ["key24"]
+    assert index.candidates("prompt", hashes[0]) == []
+    assert index.candidates("other prompt", hashes[24]) == []
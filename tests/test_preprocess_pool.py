@@ -0,0 +1,132 @@
+import pytest
+import io
+from pathlib import Path
+from PIL import Image
+from src.image_processor import (
+    DEFAULT_PROFILE, ImageTooLargeError, TiledImage, decode_upright, encode_tile, image_fingerprint, preprocess_image,
+    preprocess_image_cached
+)
+from src.metrics import metrics
+from src.preprocess_pool import PreprocessExecutor, _preprocess_job, _run_job
+from src import preprocess_pool
+
+def _jpeg(width, height, color='blue'):
+    img_byte_arr = io.BytesIO()
+    Image.new('RGB', (width, height), color=color).save(img_byte_arr, format='JPEG')
+    return img_byte_arr.getvalue()
+
+@pytest.fixture
+def executor():
+    executor = PreprocessExecutor(max_workers=1)
+    yield executor
+    executor.shutdown()
+
+def test_worker_output_matches_in_process(executor):
+    metrics.reset()
+    raw = _jpeg(3200, 2400)
+    
+    processed = executor.preprocess(raw)
+    
+    assert processed == preprocess_image(raw)
+    assert executor.stats() == {'workers': 1, 'pending': 0, 'queued': 0, 'jobs': 1, 'rejected': 0, 'failed': 0}
+    observations = metrics.snapshot()['observations']
+    # Job timing is measured here; the worker's own spans are replayed into this registry
+    assert {'preprocess_queue_wait_seconds', 'preprocess_job_seconds', 'preprocess_decode_seconds'} <= observations.keys()
+    assert image_fingerprint(processed) is not None
+
+def test_pixel_limit_rejected_without_a_worker():
+    executor = PreprocessExecutor(max_workers=1, max_pixels=1_000_000)
+    
+    with pytest.raises(ImageTooLargeError):
+        executor.preprocess(_jpeg(2000, 1000))
+    
+    assert executor._executor is None
+    assert executor.stats()['rejected'] == 1
+
+def test_tiled_image_pixel_limit_rejected_before_decoding():
+    executor = PreprocessExecutor(max_workers=1, max_pixels=1_000_000)
+    
+    with pytest.raises(ImageTooLargeError):
+        TiledImage(_jpeg(2000, 1000), max_pixels=executor.max_pixels, executor=executor)
+    
+    assert executor._executor is None
+
+def test_tiles_cut_in_worker_match_in_process(executor):
+    raw = _jpeg(3000, 2000, color='purple')
+    pooled = TiledImage(raw, tile_size=1536, overlap=128, executor=executor)
+    
+    tiles = [pooled.tile(box) for box in pooled.boxes]
+    
+    image = decode_upright(raw)
+    assert tiles == [encode_tile(image, box, 1536) for box in pooled.boxes]
+    assert pooled._image is None
+    assert executor.stats()['jobs'] == 1
+
+def test_memory_ceiling_rejected_cleanly_and_worker_survives():
+    executor = PreprocessExecutor(max_workers=1, max_rss_bytes=8 * 1024 * 1024)
+    try:
+        with pytest.raises(ImageTooLargeError, match="worker memory limit"):
+            executor.preprocess(_jpeg(1200, 900))
+        with pytest.raises(ImageTooLargeError):
+            executor.preprocess(_jpeg(1000, 800))
+        assert executor.stats()['rejected'] == 2
+        assert executor.stats()['failed'] == 0
+    finally:
+        executor.shutdown()
+
+def test_cached_preprocessing_through_executor(executor):
+    raw = _jpeg(2000, 1500, color='green')
+    
+    first = preprocess_image_cached(raw, executor=executor)
+    second = preprocess_image_cached(raw, executor=executor)
+    
+    assert first == second
+    assert executor.stats()['jobs'] == 1
+
+def _shared_memory_blocks():
+    return {path.name for path in Path('/dev/shm').glob('psm_*')}
+
+@pytest.mark.skipif(not Path('/dev/shm').is_dir(), reason="needs POSIX shared memory in /dev/shm")
+def test_shared_memory_blocks_are_released(executor):
+    before = _shared_memory_blocks()
+    starved = PreprocessExecutor(max_workers=1, max_rss_bytes=1)
+    try:
+        for color in ('red', 'white'):
+            executor.preprocess(_jpeg(1800, 1800, color=color))
+        with pytest.raises(ImageTooLargeError):
+            starved.preprocess(_jpeg(1800, 1800))
+    finally:
+        starved.shutdown()
+    
+    assert _shared_memory_blocks() <= before
+
+class _FailingWrites:
+    def __setitem__(self, key, value):
+        raise MemoryError
+
+class _UnwritableResult(preprocess_pool.SharedMemory):
+    """A result block whose copy fails, as when the worker hits its address-space cap"""
+    
+    @property
+    def buf(self):
+        return _FailingWrites() if self._created else super().buf
+    
+    def __init__(self, name=None, create=False, size=0):
+        super().__init__(name=name, create=create, size=size)
+        self._created = create
+
+@pytest.mark.skipif(not Path('/dev/shm').is_dir(), reason="needs POSIX shared memory in /dev/shm")
+def test_result_block_is_unlinked_when_the_copy_fails(monkeypatch):
+    raw = _jpeg(400, 300)
+    source = preprocess_pool.SharedMemory(create=True, size=len(raw))
+    source.buf[:len(raw)] = raw
+    before = _shared_memory_blocks()
+    monkeypatch.setattr(preprocess_pool, 'SharedMemory', _UnwritableResult)
+    try:
+        with pytest.raises(ImageTooLargeError):
+            _run_job(source.name, len(raw), _preprocess_job, 10**8, 10**10, DEFAULT_PROFILE)
+    finally:
+        source.close()
+        source.unlink()
+    
+    assert _shared_memory_blocks() <= before
@@ -0,0 +1,125 @@
+import pytest
+import asyncio
+import time
+from unittest.mock import Mock
+from src.rate_limiter import (
+    AdaptiveConcurrencyLimiter, CircuitBreaker, CircuitOpenError, RateLimiter, TokenBucket, retry_after
+)
+
+class ApiError(Exception):
+    def __init__(self, code, details=None):
+        super().__init__(f"HTTP {code}")
+        self.code = code
+        self.details = details or []
+
+def _limiter(**kwargs):
+    kwargs.setdefault('base_delay', 0.001)
+    return RateLimiter(requests_per_minute=6000, tokens_per_minute=1_000_000, **kwargs)
+
+def test_token_bucket_delays_once_burst_is_spent():
+    bucket = TokenBucket(per_minute=60, capacity=2)
+    
+    assert bucket.reserve(1) == 0
+    assert bucket.reserve(1) == 0
+    assert bucket.reserve(1) == pytest.approx(1.0, abs=0.05)
+
+def test_concurrency_limit_halves_on_overload_and_grows_on_success():
+    limiter = AdaptiveConcurrencyLimiter(initial=8)
+    
+    assert limiter.try_acquire()
+    limiter.release(overloaded=True)
+    assert limiter.limit == 4
+    
+    for _ in range(8):
+        limiter.try_acquire()
+        limiter.release()
+    assert limiter.limit == 5
+
+def test_rate_limiter_retries_throttled_calls():
+    fn = Mock(side_effect=[ApiError(429), "ok"])
+    
+    assert _limiter().call(fn) == "ok"
+    assert fn.call_count == 2
+
+def test_rate_limiter_does_not_retry_client_errors():
+    fn = Mock(side_effect=ApiError(400))
+    
+    with pytest.raises(ApiError):
+        _limiter().call(fn)
+    assert fn.call_count == 1
+
+def test_retry_after_hint_is_honoured():
+    hint = Mock(retry_delay=Mock(seconds=2, nanos=500_000_000))
+    
+    assert retry_after(ApiError(429, [hint])) == 2.5
+
+def test_circuit_breaker_fails_fast_then_probes():
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=0)
+    limiter = _limiter(breaker=CircuitBreaker(failure_threshold=2, reset_timeout=60), max_attempts=1)
+    for _ in range(2):
+        with pytest.raises(ApiError):
+            limiter.call(Mock(side_effect=ApiError(503)))
+    
+    fn = Mock(return_value="ok")
+    with pytest.raises(CircuitOpenError):
+        limiter.call(fn)
+    assert not fn.called
+    
+    breaker.record_failure()
+    breaker.record_failure()
+    breaker.check()
+    with pytest.raises(CircuitOpenError):
+        breaker.check()
+    breaker.record_success()
+    assert breaker.state == 'closed'
+
+def test_cancelled_half_open_probe_lets_the_next_probe_through():
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0)
+    breaker.record_failure()
+    limiter = _limiter(breaker=breaker, max_attempts=1)
+    
+    async def hang():
+        await asyncio.sleep(10)
+    
+    async def cancel_probe():
+        task = asyncio.create_task(limiter.call_async(hang))
+        await asyncio.sleep(0.01)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+    
+    async def ok():
+        return "ok"
+    
+    asyncio.run(cancel_probe())
+    assert breaker.state == 'half_open'
+    assert asyncio.run(limiter.call_async(ok)) == "ok"
+    assert breaker.state == 'closed'
+
+def test_attempt_cancelled_before_sending_refunds_quota():
+    limiter = _limiter()
+    limiter._blocked_until = time.monotonic() + 10
+    fn = Mock()
+    
+    async def cancel_while_waiting():
+        task = asyncio.create_task(limiter.call_async(fn, tokens=1_000_000))
+        await asyncio.sleep(0.01)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+    
+    asyncio.run(cancel_while_waiting())
+    assert not fn.called
+    assert limiter.tokens.reserve(1_000_000) == 0
+
+def test_call_async_retries_overload():
+    attempts = []
+    
+    async def flaky():
+        attempts.append(True)
+        if len(attempts) == 1:
+            raise ApiError(503)
+        return "ok"
+    
+    assert asyncio.run(_limiter().call_async(flaky)) == "ok"
+    assert len(attempts) == 2
@@ -0,0 +1,87 @@
+import pytest
+import threading
+import time
+from starlette.testclient import TestClient
+from benchmarks import bench_service
+from benchmarks.stub_backend import StubGenerativeModel
+from src.server import create_app
+
+@pytest.fixture(autouse=True)
+def preprocess_in_thread(monkeypatch):
+    monkeypatch.setenv("CLARITY_PREPROCESS_WORKERS", "0")
+
+def _client(tmp_path, workers=4, queue=8, **stub):
+    backend = StubGenerativeModel(**{'latency_seconds': 0.001, **stub})
+    app = create_app(bench_service.make_service(backend, str(tmp_path)), workers=workers, queue=queue)
+    return TestClient(app), backend
+
+def test_analyze_returns_json_and_shares_the_cache(tmp_path, mock_image):
+    client, backend = _client(tmp_path)
+    
+    first = client.post('/v1/analyze', files={'image': ('a.jpg', mock_image)}, data={'question': "What is it?"})
+    second = client.post('/v1/analyze', files={'image': ('a.jpg', mock_image)}, data={'question': "What is it?"})
+    
+    assert first.status_code == 200
+    assert first.json()['answer'].startswith("Stub answer for 1 image(s)")
+    assert first.json()['confidence'] == "High"
+    assert second.json() == first.json()
+    assert backend.stats()['calls'] == 1
+
+def test_analyze_streams_text(tmp_path, mock_image):
+    client, _ = _client(tmp_path, chunks=4)
+    
+    response = client.post('/v1/analyze?stream=1', files={'image': ('a.jpg', mock_image)},
+                           data={'question': "What is it?"})
+    
+    assert response.status_code == 200
+    assert response.headers['content-type'].startswith('text/plain')
+    assert "Confidence: High" in response.text
+    assert client.get('/health').json()['queue']['pending'] == 0
+
+def test_compare_and_batch(tmp_path):
+    client, backend = _client(tmp_path)
+    red, blue = bench_service.distinct_images(2)
+    
+    compared = client.post('/v1/compare', files={'image1': ('r.jpg', red), 'image2': ('b.jpg', blue)},
+                           data={'question': "Which is brighter?"})
+    batch = client.post(
+        '/v1/batch',
+        files=[('image', ('r.jpg', red)), ('image', ('b.jpg', blue))],
+        data={'question': ["Describe it", "Any text?"]}
+    )
+    
+    assert compared.json()['answer'].startswith("Stub answer for 2 image(s)")
+    results = batch.json()['results']
+    assert [(r['image'], r['question']) for r in results] == [
+        ('r.jpg', "Describe it"), ('r.jpg', "Any text?"), ('b.jpg', "Describe it"), ('b.jpg', "Any text?")
+    ]
+    assert backend.stats()['calls'] == 5
+
+def test_client_errors(tmp_path, mock_image):
+    client, _ = _client(tmp_path)
+    
+    assert client.post('/v1/analyze', data={'question': "What is it?"}).status_code == 400
+    assert client.post('/v1/analyze', files={'image': ('a.jpg', mock_image)}).status_code == 400
+    unreadable = client.post('/v1/analyze', files={'image': ('a.jpg', b"not an image")}, data={'question': "?"})
+    assert unreadable.status_code == 400
+    assert client.post('/v1/batch', data={'question': "Describe it"}).status_code == 400
+
+def test_full_queue_is_rejected_with_429(tmp_path):
+    client, _ = _client(tmp_path, workers=1, queue=0, latency_seconds=0.5, latency_sigma=0)
+    first, second = bench_service.distinct_images(2)
+    responses = {}
+    
+    with client:
+        slow = threading.Thread(target=lambda: responses.setdefault('first', client.post(
+            '/v1/analyze', files={'image': ('a.jpg', first)}, data={'question': "What is it?"}
+        )))
+        slow.start()
+        while client.get('/health').json()['queue']['pending'] == 0:
+            time.sleep(0.01)
+        rejected = client.post('/v1/analyze', files={'image': ('b.jpg', second)}, data={'question': "What is it?"})
+        slow.join()
+    
+    assert rejected.status_code == 429
+    assert rejected.headers['retry-after'] == "1"
+    assert responses['first'].status_code == 200
+    assert client.app.state.admission.stats()['rejected'] == 1
@@ -0,0 +1,99 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from benchmarks import bench_service
+from benchmarks.stub_backend import StubGenerativeModel
+from src.gemini_service import select_generation_profile
+from src.image_processor import preprocess_image_cached, select_profile
+from src.speculation import SpeculativeAnalyzer
+
+MODE = "General Analysis"
+
+def _speculator(tmp_path, latency=0.001, **kwargs):
+    backend = StubGenerativeModel(latency_seconds=latency)
+    service = bench_service.make_service(backend, str(tmp_path))
+    # One worker runs the prompts in order, so draining it is deterministic
+    executor = ThreadPoolExecutor(max_workers=1)
+    return SpeculativeAnalyzer(service, executor=executor, **kwargs), backend, executor
+
+def _drain(executor):
+    executor.submit(lambda: None).result()
+
+def _ask(service, raw, question, result):
+    """Ask the way the app's Analyze button does for a single quick prompt"""
+    image = preprocess_image_cached(raw, select_profile(MODE, question))
+    return list(service.analyze_image_stream(image, question, result=result,
+                                             profile=select_generation_profile(MODE)))
+
+def test_first_click_is_answered_from_the_cache(tmp_path):
+    speculator, backend, executor = _speculator(tmp_path)
+    raw = bench_service.distinct_images(1)[0]
+    
+    assert speculator.speculate(raw, MODE)
+    assert not speculator.speculate(raw, MODE)
+    _drain(executor)
+    result = {}
+    _ask(speculator.service, raw, "Describe the scene", result)
+    
+    assert result['cached'] is True
+    assert backend.stats()['calls'] == 2
+    assert speculator.stats()['answered'] == 2
+
+def test_multi_prompt_click_is_answered_from_the_cache(tmp_path):
+    speculator, backend, executor = _speculator(tmp_path)
+    raw = bench_service.distinct_images(1)[0]
+    prompts = list(speculator.prompts[MODE])
+    
+    speculator.speculate(raw, MODE)
+    _drain(executor)
+    # The app's fan-out path: each prompt gets the image preprocessed for it alone
+    images = {prompt: preprocess_image_cached(raw, select_profile(MODE, prompt)) for prompt in prompts}
+    answers = dict(speculator.service.analyze_prompts(images, prompts, profile=select_generation_profile(MODE)))
+    
+    assert sorted(answers) == sorted(prompts)
+    assert backend.stats()['calls'] == 2
+
+def test_click_joins_speculative_call_in_flight(tmp_path):
+    speculator, backend, executor = _speculator(
+        tmp_path, latency=0.3, prompts={MODE: ("Describe the scene",)}
+    )
+    raw = bench_service.distinct_images(1)[0]
+    
+    speculator.speculate(raw, MODE)
+    deadline = time.monotonic() + 5
+    while speculator.service.in_flight_stats()['in_flight'] == 0 and time.monotonic() < deadline:
+        time.sleep(0.005)
+    result = {}
+    _ask(speculator.service, raw, "Describe the scene", result)
+    
+    assert result['cached'] is True
+    assert backend.stats()['calls'] == 1
+
+def test_new_upload_cancels_pending_prompts(tmp_path):
+    speculator, backend, executor = _speculator(tmp_path)
+    first, second = bench_service.distinct_images(2)
+    release = threading.Event()
+    executor.submit(release.wait)
+    
+    speculator.speculate(first, MODE)
+    speculator.speculate(second, MODE)
+    release.set()
+    _drain(executor)
+    result = {}
+    _ask(speculator.service, second, "Describe the scene", result)
+    
+    assert result['cached'] is True
+    assert speculator.stats()['cancelled'] == 2
+    assert backend.stats()['calls'] == 2
+
+def test_budget_caps_speculative_calls_per_session(tmp_path):
+    speculator, backend, executor = _speculator(tmp_path, budget=3)
+    images = bench_service.distinct_images(3)
+    
+    for raw in images:
+        speculator.speculate(raw, MODE)
+        _drain(executor)
+    
+    assert backend.stats()['calls'] == 3
+    assert speculator.stats()['spent'] == 3
+    assert not speculator.speculate(images[0], "Object Detection")
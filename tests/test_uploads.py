@@ -0,0 +1,139 @@
+import pytest
+import threading
+import time
+from unittest.mock import Mock, patch
+from src.gemini_service import GeminiService
+from src.rate_limiter import RateLimiter
+from src.uploads import EXPIRY_MARGIN_SECONDS, UploadRegistry
+
+def _fake_uploader(expires_in=None):
+    calls = []
+    
+    def upload(data, mime_type):
+        calls.append(data)
+        part = {'file_data': {'mime_type': mime_type, 'file_uri': f"https://files/{len(calls)}"}}
+        return part, time.time() + expires_in if expires_in is not None else None
+    
+    return upload, calls
+
+def test_registry_uploads_once_and_reuses():
+    upload, calls = _fake_uploader()
+    registry = UploadRegistry(uploader=upload, deleter=None)
+    
+    first = registry.get_or_upload("digest", b"image", "image/jpeg")
+    second = registry.get_or_upload("digest", b"image", "image/jpeg")
+    
+    assert first is second
+    assert len(calls) == 1
+    assert registry.stats() == {'uploads': 1, 'reuses': 1, 'evictions': 0, 'entries': 1}
+
+def test_registry_reuploads_expired_handles():
+    upload, calls = _fake_uploader(expires_in=EXPIRY_MARGIN_SECONDS - 1)
+    registry = UploadRegistry(uploader=upload, deleter=None)
+    
+    registry.get_or_upload("digest", b"image", "image/jpeg")
+    registry.get_or_upload("digest", b"image", "image/jpeg")
+    
+    assert len(calls) == 2
+
+def test_registry_is_bounded_and_deletes_evicted_files():
+    upload, _ = _fake_uploader()
+    deleted = threading.Event()
+    registry = UploadRegistry(max_entries=2, uploader=upload, deleter=lambda part: deleted.set())
+    
+    for digest in ("a", "b", "c"):
+        registry.get_or_upload(digest, b"image", "image/jpeg")
+    
+    assert registry.stats()['entries'] == 2
+    assert registry.stats()['evictions'] == 1
+    assert deleted.wait(1)
+
+def test_concurrent_requests_share_one_upload():
+    calls = []
+    
+    def slow_upload(data, mime_type):
+        calls.append(data)
+        time.sleep(0.05)
+        return {'file_data': {'mime_type': mime_type, 'file_uri': "https://files/1"}}, None
+    
+    registry = UploadRegistry(uploader=slow_upload, deleter=None)
+    threads = [threading.Thread(target=registry.get_or_upload, args=("digest", b"image", "image/jpeg"))
+               for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    
+    assert len(calls) == 1
+
+@patch('google.generativeai.GenerativeModel')
+def test_follow_up_questions_reference_the_uploaded_file(mock_model, mock_image):
+    mock_model.return_value.generate_content.return_value.text = "Answer"
+    upload, calls = _fake_uploader()
+    service = GeminiService("mock_api_key", uploads=UploadRegistry(uploader=upload, deleter=None))
+    
+    service.analyze_image(mock_image, "What's in this image?")
+    service.analyze_image(mock_image, "What colour is it?")
+    
+    assert calls == [mock_image]
+    parts = [call.args[0][0] for call in mock_model.return_value.generate_content.call_args_list]
+    assert parts[0] == parts[1] == {'file_data': {'mime_type': 'image/jpeg', 'file_uri': "https://files/1"}}
+
+@patch('google.generativeai.GenerativeModel')
+def test_failed_upload_falls_back_to_inline(mock_model, mock_image):
+    mock_model.return_value.generate_content.return_value.text = "Answer"
+    service = GeminiService("mock_api_key", uploads=UploadRegistry(uploader=Mock(side_effect=OSError("down"))))
+    
+    service.analyze_image(mock_image, "What's in this image?")
+    
+    assert mock_model.return_value.generate_content.call_args.args[0][0]['data'] == mock_image
+
+class NotFound(Exception):
+    code = 404
+
+class ResourceExhausted(Exception):
+    code = 429
+
+@patch('google.generativeai.GenerativeModel')
+def test_throttled_upload_is_retried_by_the_limiter(mock_model, mock_image):
+    mock_model.return_value.generate_content.return_value.text = "Answer"
+    upload, _ = _fake_uploader()
+    uploader = Mock(side_effect=[ResourceExhausted("Quota exceeded"), upload(mock_image, 'image/jpeg')])
+    limiter = RateLimiter(requests_per_minute=6000, tokens_per_minute=1_000_000, base_delay=0.001)
+    service = GeminiService("mock_api_key", limiter=limiter, uploads=UploadRegistry(uploader=uploader, deleter=None))
+    
+    service.analyze_image(mock_image, "What's in this image?")
+    
+    assert uploader.call_count == 2
+    part = mock_model.return_value.generate_content.call_args.args[0][0]
+    assert part['file_data']['file_uri'] == "https://files/1"
+
+@patch('google.generativeai.GenerativeModel')
+def test_rejected_handle_is_uploaded_again(mock_model, mock_image):
+    generate = mock_model.return_value.generate_content
+    generate.side_effect = [NotFound("File not found"), Mock(text="Answer")]
+    upload, calls = _fake_uploader()
+    registry = UploadRegistry(uploader=upload, deleter=None)
+    service = GeminiService("mock_api_key", uploads=registry)
+    
+    result = service.analyze_image(mock_image, "What's in this image?")
+    
+    assert result['answer'] == "Answer"
+    assert calls == [mock_image, mock_image]
+    parts = [call.args[0][0]['file_data']['file_uri'] for call in generate.call_args_list]
+    assert parts == ["https://files/1", "https://files/2"]
+    assert registry.stats()['entries'] == 1
+
+@patch('google.generativeai.configure')
+@patch('google.generativeai.GenerativeModel')
+def test_client_is_configured_before_the_first_upload(mock_model, mock_configure, mock_image):
+    mock_model.return_value.generate_content.return_value.text = "Answer"
+    
+    def upload(data, mime_type):
+        mock_configure.assert_called_once_with(api_key="mock_api_key")
+        return {'file_data': {'mime_type': mime_type, 'file_uri': "https://files/1"}}, None
+    
+    service = GeminiService("mock_api_key", uploads=UploadRegistry(uploader=upload, deleter=None))
+    service.analyze_image(mock_image, "What's in this image?")
+    
+    assert service.upload_stats()['uploads'] == 1
@@ -0,0 +1,123 @@
+import pytest
+import io
+import cv2
+import numpy as np
+from unittest.mock import Mock, patch
+from PIL import Image
+from src.gemini_service import GeminiService
+from src.image_processor import ImageTooLargeError
+from src.preprocess_pool import PreprocessExecutor
+from src.video import _sampled_frames, extract_burst_keyframes, extract_video_keyframes, select_keyframes
+
+# BGR colours of three scenes, the last one a return to the first
+SCENES = [(0, 0, 255), (0, 255, 0), (255, 0, 0)]
+
+def _scene(color, size=(64, 64), seed=0):
+    """A flat colour with a little noise, like a static shot"""
+    noise = np.random.default_rng(seed).integers(-8, 8, (*size, 3))
+    return np.clip(np.array(color) + noise, 0, 255).astype(np.uint8)
+
+def _clip(tmp_path, scenes, frames_per_scene=20, fps=10):
+    path = str(tmp_path / "clip.avi")
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'MJPG'), fps, (320, 240))
+    for number, color in enumerate(scenes):
+        for i in range(frames_per_scene):
+            writer.write(_scene(color, (240, 320), seed=number * 100 + i))
+    writer.release()
+    with open(path, 'rb') as f:
+        return f.read()
+
+def test_select_keyframes_finds_scene_changes():
+    signatures = np.stack([_scene(SCENES[i // 10], seed=i) for i in range(30)])
+    
+    assert select_keyframes(signatures) == [0, 10, 20]
+    assert select_keyframes(signatures, max_keyframes=2) == [0, 10]
+    assert select_keyframes(signatures[:10]) == [0]
+
+def test_select_keyframes_drops_returning_scenes():
+    colors = [SCENES[0], SCENES[1], SCENES[0]]
+    signatures = np.stack([_scene(colors[i // 10], seed=i) for i in range(30)])
+    
+    assert select_keyframes(signatures) == [0, 10]
+
+def test_extract_video_keyframes_samples_and_preprocesses_only_keyframes(tmp_path):
+    video = _clip(tmp_path, SCENES)
+    
+    with patch('src.video.preprocess_image', side_effect=lambda data, profile: data) as preprocess:
+        keyframes = extract_video_keyframes(video, suffix='.avi')
+    
+    assert [keyframe.index for keyframe in keyframes] == [0, 20, 40]
+    assert [keyframe.timestamp for keyframe in keyframes] == [0.0, 2.0, 4.0]
+    assert preprocess.call_count == 3
+    assert Image.open(io.BytesIO(keyframes[1].image)).size == (320, 240)
+
+def test_extract_burst_keyframes_skips_near_identical_shots():
+    burst = []
+    for i, color in enumerate([SCENES[0], SCENES[0], SCENES[1], SCENES[1], SCENES[2]]):
+        buffer = io.BytesIO()
+        Image.fromarray(_scene(color[::-1], (120, 160), seed=i)).save(buffer, format='JPEG')
+        burst.append(buffer.getvalue())
+    
+    keyframes = extract_burst_keyframes(burst)
+    
+    assert [keyframe.index for keyframe in keyframes] == [0, 2, 4]
+    assert all(keyframe.timestamp is None for keyframe in keyframes)
+
+def test_extract_burst_keyframes_checks_pixel_limit_before_decoding():
+    executor = PreprocessExecutor(max_workers=1, max_pixels=100 * 100)
+    buffer = io.BytesIO()
+    Image.new('RGB', (200, 100), color='red').save(buffer, format='JPEG')
+    
+    with pytest.raises(ImageTooLargeError):
+        extract_burst_keyframes([buffer.getvalue()], executor=executor)
+    
+    assert executor._executor is None
+
+_VideoCapture = cv2.VideoCapture
+
+class _UnknownLengthCapture:
+    """A capture whose container does not report its frame count"""
+    
+    def __init__(self, path):
+        self._capture = _VideoCapture(path)
+        self.grabs = 0
+    
+    def __getattr__(self, name):
+        return getattr(self._capture, name)
+    
+    def get(self, prop):
+        return 0 if prop == cv2.CAP_PROP_FRAME_COUNT else self._capture.get(prop)
+    
+    def grab(self):
+        self.grabs += 1
+        return self._capture.grab()
+
+def test_sampling_stops_at_max_frames_when_length_is_unknown(tmp_path):
+    _clip(tmp_path, SCENES)
+    path = str(tmp_path / "clip.avi")
+    captures = []
+    
+    def open_capture(path):
+        captures.append(_UnknownLengthCapture(path))
+        return captures[-1]
+    
+    with patch('src.video.MAX_SAMPLED_FRAMES', 4), patch('cv2.VideoCapture', side_effect=open_capture):
+        sampled = list(_sampled_frames(path, sample_fps=2.0))
+    
+    assert [index for index, _, _ in sampled] == [0, 5, 10, 15]
+    assert captures[0].grabs == 20
+
+@patch('google.generativeai.GenerativeModel')
+def test_analyze_frames_sends_one_batched_request(mock_model, mock_image):
+    mock_model.return_value.generate_content.return_value.text = "Sequence answer"
+    service = GeminiService("mock_api_key")
+    frames = [mock_image, mock_image[:-2] + b'\x00\xd9']
+    
+    result = service.analyze_frames(frames, "What happens?", timestamps=[0.0, 2.5])
+    service.analyze_frames(frames, "What happens?", timestamps=[0.0, 2.5])
+    
+    assert result['answer'] == "Sequence answer"
+    contents = mock_model.return_value.generate_content.call_args.args[0]
+    assert len(contents) == 3
+    assert "frame 2 at 2.5s" in contents[-1]
+    assert mock_model.return_value.generate_content.call_count == 1